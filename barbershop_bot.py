@@ -1,24 +1,123 @@
 import os
+import sys
+import base64
+import hashlib
+import hmac
+import struct
+import contextvars
+import resource
 import logging
+import socket
+import sqlite3
+import csv
+import glob
 import json
+import asyncio
+import bisect
+import fcntl
+import functools
+import threading
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
-from datetime import datetime
+from collections import Counter, OrderedDict, namedtuple
+from datetime import date, datetime
+from itertools import chain, compress, islice, repeat, zip_longest
+from operator import itemgetter
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, CallbackQueryHandler
+from telegram.error import BadRequest
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, CallbackQueryHandler, TypeHandler, BaseUpdateProcessor
 import time
 
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
 # Load environment variables
 from dotenv import load_dotenv
 load_dotenv()
 
+# Configure logging: one JSON object per line (LOG_FORMAT=text for plain
+# lines), tagged with the update or job being handled. String fields are
+# cut to LOG_FIELD_LIMIT characters, and frequent events logged with
+# extra=SAMPLED are kept once every LOG_SAMPLE_EVERY times.
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FIELD_LIMIT = int(os.getenv('LOG_FIELD_LIMIT', '1000'))
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', '10'))
+SAMPLED = {"sampled": True}
+
+correlation_id = contextvars.ContextVar("correlation_id", default=None)
+
+def truncate(value: str, limit: int) -> str:
+    if len(value) <= limit:
+        return value
+    return f"{value[:limit]}…(+{len(value) - limit})"
+
+class CorrelationFilter(logging.Filter):
+    """Tag records with the id of the update or job being handled."""
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Keep one in every `every` records of each sampled event.
+
+    Sampled records are counted per message template; warnings and errors
+    are always kept. Attached to the logger, so dropped records are never
+    formatted.
+    """
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(1, every)
+        self.counts = Counter()
+
+    def filter(self, record):
+        if not getattr(record, "sampled", False) or record.levelno >= logging.WARNING:
+            return True
+        count = self.counts[record.msg]
+        self.counts[record.msg] = count + 1
+        record.sample_every = self.every
+        return count % self.every == 0
+
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON lines, truncating string fields."""
+    RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "correlation_id", "sampled"}
+
+    def __init__(self, field_limit: int):
+        super().__init__()
+        self.field_limit = field_limit
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": truncate(record.getMessage(), self.field_limit),
+        }
+        if getattr(record, "correlation_id", None):
+            entry["correlation_id"] = record.correlation_id
+        for key, value in vars(record).items():
+            if key not in self.RESERVED:
+                entry[key] = value if isinstance(value, (int, float, bool, type(None))) else truncate(str(value), self.field_limit)
+        if record.exc_info:
+            entry["exception"] = truncate(self.formatException(record.exc_info), self.field_limit)
+        return json.dumps(entry, ensure_ascii=False)
+
+class TextFormatter(logging.Formatter):
+    """The plain log format, truncating the message."""
+    def __init__(self, field_limit: int):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(correlation_id)s - %(message)s')
+        self.field_limit = field_limit
+
+    def formatMessage(self, record):
+        record.message = truncate(record.message, self.field_limit)
+        return super().formatMessage(record)
+
+log_handler = logging.StreamHandler()
+log_handler.addFilter(CorrelationFilter())
+log_handler.setFormatter(JsonFormatter(LOG_FIELD_LIMIT) if LOG_FORMAT == "json" else TextFormatter(LOG_FIELD_LIMIT))
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_handler])
+# httpx logs every Telegram API request at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+logger.addFilter(SamplingFilter(LOG_SAMPLE_EVERY))
+
 # Configuration
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'barber2020')
@@ -44,16 +143,217 @@ BTN_ADD = "➕ زيد واحد"
 BTN_REFRESH = "🔄 شارجي"
 BTN_BACK = "🔙 ارجع"
 BTN_ADMIN = "👋 مرحبا بيك في لوحة التحكم"
+BTN_CHECK_IN = "✅ راني هنا"
+BTN_NEXT_CUSTOMER = "⏭️ لي موراه"
+BTN_FOLLOW_QUEUE = "🔔 تبع دوري"
+BTN_UNFOLLOW_QUEUE = "🔕 حبس المتابعة"
+BTN_NEXT_PAGE = "➡️ الصفحة الجاية"
+BTN_PREV_PAGE = "⬅️ الصفحة اللي فاتت"
+
+# Telegram rejects messages longer than 4096 UTF-16 code units, so long
+# listings are split into pages that stay below PAGE_LENGTH
+MAX_MESSAGE_LENGTH = 4096
+PAGE_LENGTH = min(int(os.getenv('PAGE_LENGTH', '4000')), MAX_MESSAGE_LENGTH)
+
+ADMIN_KEYBOARD = [
+    [BTN_VIEW_WAITING, BTN_VIEW_DONE],
+    [BTN_VIEW_BARBER1, BTN_VIEW_BARBER2],
+    [BTN_NEXT_CUSTOMER],
+    [BTN_ADD, BTN_REFRESH]
+]
+
+# Tickets shown per page of the admin waiting panel (each one takes a row
+# of three buttons and Telegram allows 100 buttons per message). Names are
+# kept to MAX_NAME_LENGTH characters so a full page stays below PAGE_LENGTH
+WAITING_PANEL_SIZE = 20
+MAX_NAME_LENGTH = 50
+
+# Shared state: admin sessions, notification state, ticket numbers and the
+# scheduled-jobs lease live in this SQLite database (WAL mode) so several
+# bot instances on one host can share them. Only the instance holding the
+# lease runs the scheduled jobs; it is renewed every time a job runs, so
+# JOB_LEASE_TTL must be longer than the 60 second notification interval.
+# Telegram hands a token's updates to one getUpdates poller at a time
+# (another gets 409 Conflict), so only one instance should poll; the shared
+# store lets instances overlap during restarts and deploys without
+# duplicate tickets or notifications, as long as each uses its own
+# OUTBOX_PATH. Expired keys are purged every STATE_PURGE_INTERVAL seconds.
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'bot_state.db')
+INSTANCE_ID = os.getenv('INSTANCE_ID') or f"{socket.gethostname()}-{os.getpid()}"
+JOB_LEASE_TTL = int(os.getenv('JOB_LEASE_TTL', '90'))
+ADMIN_SESSION_TTL = int(os.getenv('ADMIN_SESSION_TTL', str(12 * 60 * 60)))
+STATE_PURGE_INTERVAL = 60 * 60
+
+# Rate limiting: each chat gets a token bucket refilled at RATE_LIMIT_RATE
+# tokens per second holding at most RATE_LIMIT_BURST tokens. Over-limit
+# requests are answered from the last response rendered for that chat if
+# it is younger than RESPONSE_CACHE_TTL seconds.
+RATE_LIMIT_RATE = float(os.getenv('RATE_LIMIT_RATE', '0.2'))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', '3'))
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '60'))
+RATE_LIMIT_MAX_CHATS = int(os.getenv('RATE_LIMIT_MAX_CHATS', '10000'))
+
+# Write-ahead outbox: bookings and status changes are written to this
+# append-only log first and applied to the sheet in the background, so the
+# bot keeps accepting bookings while Google Sheets is slow or down. One
+# instance at a time can use a log: another one started on the same
+# OUTBOX_PATH fails to start (and retries) until the first exits, then
+# replays whatever it left behind
+OUTBOX_PATH = os.getenv('OUTBOX_PATH', 'outbox.log')
+OUTBOX_FSYNC_DELAY = float(os.getenv('OUTBOX_FSYNC_DELAY', '0.05'))
+OUTBOX_REPLAY_INTERVAL = int(os.getenv('OUTBOX_REPLAY_INTERVAL', '15'))
+
+# Live queue messages: edits are sent LIVE_QUEUE_DEBOUNCE seconds after a
+# queue changes, at most once every LIVE_QUEUE_MIN_INTERVAL seconds per
+# chat and at most LIVE_QUEUE_EDITS_PER_FLUSH at a time, for up to
+# LIVE_QUEUE_MAX_SUBSCRIBERS followed messages
+LIVE_QUEUE_DEBOUNCE = float(os.getenv('LIVE_QUEUE_DEBOUNCE', '3'))
+LIVE_QUEUE_MIN_INTERVAL = float(os.getenv('LIVE_QUEUE_MIN_INTERVAL', '10'))
+LIVE_QUEUE_EDITS_PER_FLUSH = int(os.getenv('LIVE_QUEUE_EDITS_PER_FLUSH', '20'))
+LIVE_QUEUE_MAX_SUBSCRIBERS = int(os.getenv('LIVE_QUEUE_MAX_SUBSCRIBERS', '1000'))
+
+# Average time a barber spends on one customer, used for wait estimates
+MINUTES_PER_CUSTOMER = 10
+
+# Ticket timers: customers are reminded when their estimated wait drops to
+# each of NOTIFICATION_LEADS minutes and told when it's their turn. A called
+# customer who doesn't tap "راني هنا" within TURN_EXPIRY_MINUTES loses the
+# turn (marked No-show) if someone else is waiting; 0 turns expiry off.
+NOTIFICATION_LEADS = {"20min": 20, "10min": 10}
+TURN_EXPIRY_MINUTES = int(os.getenv('TURN_EXPIRY_MINUTES', '5'))
+TICKET_STATE_TTL = 24 * 60 * 60
+
+# Appointment slots: customers can reserve a SLOT_MINUTES slot between
+# OPENING_TIME and CLOSING_TIME up to SLOT_DAYS_AHEAD days ahead; they are
+# offered SLOTS_OFFERED free slots at a time. Walk-ins are served in the
+# gaps between reserved slots.
+SLOT_MINUTES = int(os.getenv('SLOT_MINUTES', '20'))
+OPENING_TIME = os.getenv('OPENING_TIME', '09:00')
+CLOSING_TIME = os.getenv('CLOSING_TIME', '21:00')
+SLOT_DAYS_AHEAD = int(os.getenv('SLOT_DAYS_AHEAD', '7'))
+SLOTS_OFFERED = int(os.getenv('SLOTS_OFFERED', '6'))
+
+# Analytics: the booking history is read from the sheet and from the
+# CSV exports in HISTORY_DIR (same columns as the sheet) in chunks of
+# ANALYTICS_CHUNK_ROWS rows. The daily report is sent at REPORT_TIME to
+# the chats listed in ADMIN_CHAT_IDS (comma separated).
+HISTORY_DIR = os.getenv('HISTORY_DIR')
+ANALYTICS_CHUNK_ROWS = int(os.getenv('ANALYTICS_CHUNK_ROWS', '5000'))
+REPORT_TIME = datetime.strptime(os.getenv('REPORT_TIME', '23:00'), "%H:%M").time()
+ADMIN_CHAT_IDS = [int(chat_id) for chat_id in os.getenv('ADMIN_CHAT_IDS', '').split(',') if chat_id.strip()]
+
+# Profiling: /profile samples every thread's stack each PROFILE_INTERVAL
+# seconds for a number of seconds (at most PROFILE_MAX_SECONDS) or updates,
+# writes the folded stacks to PROFILE_DIR and replies with the PROFILE_TOP_N
+# busiest functions. PROFILE_ON_START profiles that many seconds after boot.
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.01'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_TOP_N = int(os.getenv('PROFILE_TOP_N', '15'))
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', '600'))
+PROFILE_ON_START = int(os.getenv('PROFILE_ON_START', '0'))
+
+# Updates are handled concurrently by up to UPDATE_WORKERS at a time; updates
+# from the same chat still run one after another in arrival order
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '16'))
+
+# Per-user state: user_data is kept for at most USER_DATA_MAX_USERS users
+# (least recently seen dropped first) and dropped after USER_DATA_TTL idle
+# seconds. Conversations end after CONVERSATION_TIMEOUT idle seconds, and
+# users seen more recently than that, like logged-in admins, are kept.
+USER_DATA_MAX_USERS = int(os.getenv('USER_DATA_MAX_USERS', '10000'))
+USER_DATA_TTL = int(os.getenv('USER_DATA_TTL', str(24 * 60 * 60)))
+CONVERSATION_TIMEOUT = int(os.getenv('CONVERSATION_TIMEOUT', str(30 * 60)))
+USER_DATA_SWEEP_INTERVAL = 600
+
+# Callback data: inline buttons carry a packed (version, action, shop,
+# barber, number, page) record in base64url instead of free text, where
+# number is a ticket or a slot's minute and barber is an index into BARBERS
+# (0 for none). Admin actions are signed with CALLBACK_SECRET, which
+# defaults to one derived from the bot token. Buttons of another
+# CALLBACK_VERSION or SHOP_ID are treated as stale. Action ids are part of
+# the protocol: new actions go at the end.
+CALLBACK_VERSION = 1
+CALLBACK_STRUCT = struct.Struct(">BBBBIH")
+CALLBACK_SIGNATURE_SIZE = 8
+SHOP_ID = int(os.getenv('SHOP_ID', '0'))
+CALLBACK_SECRET = (
+    os.getenv('CALLBACK_SECRET', '').encode()
+    or hashlib.sha256(f"callback:{TELEGRAM_TOKEN}".encode()).digest()
+)
+(CB_BARBER, CB_MODE_WALKIN, CB_MODE_SLOT, CB_SLOT, CB_SLOT_AFTER,
+ CB_QUEUE_VIEW, CB_PAGE_QUEUE, CB_PAGE_ADMIN, CB_FOLLOW, CB_UNFOLLOW,
+ CB_CHECK_IN, CB_SELECT, CB_WAITING_PAGE, CB_REFRESH_WAITING, CB_BULK_DONE,
+ CB_BULK_DELETE, CB_NEXT_CUSTOMER, CB_CLEAR_DONE, CB_STATUS, CB_DELETE,
+ CB_DELETE_DONE, CB_PAGE_WAIT) = range(1, 23)
+SIGNED_ACTIONS = frozenset({
+    CB_PAGE_ADMIN, CB_SELECT, CB_WAITING_PAGE, CB_REFRESH_WAITING, CB_BULK_DONE,
+    CB_BULK_DELETE, CB_NEXT_CUSTOMER, CB_CLEAR_DONE, CB_STATUS, CB_DELETE, CB_DELETE_DONE
+})
+CallbackData = namedtuple("CallbackData", "action barber number page")
 
 # Conversation States
-SELECTING_BARBER, ENTERING_NAME, ENTERING_PHONE, ADMIN_VERIFICATION = range(4)
+SELECTING_BARBER, ENTERING_NAME, ENTERING_PHONE, ADMIN_VERIFICATION, SELECTING_MODE, SELECTING_SLOT = range(6)
+
+# Callback Data
+BARBER_IDS = {barber_key: i for i, barber_key in enumerate(BARBERS, 1)}
+BARBER_KEYS = {i: barber_key for barber_key, i in BARBER_IDS.items()}
+
+def callback_signature(payload: bytes) -> bytes:
+    return hmac.new(CALLBACK_SECRET, payload, hashlib.sha256).digest()[:CALLBACK_SIGNATURE_SIZE]
+
+def encode_callback(action: int, barber: str = None, number: int = 0, page: int = 0) -> str:
+    """Pack a button's action and arguments into callback data (at most 24 characters)."""
+    payload = CALLBACK_STRUCT.pack(
+        CALLBACK_VERSION, action, SHOP_ID, BARBER_IDS.get(barber, 0), int(number), page
+    )
+    if action in SIGNED_ACTIONS:
+        payload += callback_signature(payload)
+    return base64.urlsafe_b64encode(payload).rstrip(b"=").decode()
+
+@functools.lru_cache(maxsize=4096)
+def decode_callback(data: str):
+    """Unpack callback data made by encode_callback, or return None if it is stale, foreign or forged."""
+    try:
+        raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+        version, action, shop, barber, number, page = CALLBACK_STRUCT.unpack_from(raw)
+    except (ValueError, struct.error):
+        return None
+    if version != CALLBACK_VERSION or shop != SHOP_ID:
+        return None
+    payload, signature = raw[:CALLBACK_STRUCT.size], raw[CALLBACK_STRUCT.size:]
+    if action in SIGNED_ACTIONS:
+        if not hmac.compare_digest(signature, callback_signature(payload)):
+            return None
+    elif signature:
+        return None
+    return CallbackData(action, BARBER_KEYS.get(barber), number, page)
+
+def callback_pattern(*actions):
+    """A CallbackQueryHandler pattern matching buttons of the given actions."""
+    def matches(data) -> bool:
+        decoded = decode_callback(data) if isinstance(data, str) else None
+        return decoded is not None and decoded.action in actions
+    return matches
 
 # Google Sheets Service
 class SheetsService:
     def __init__(self):
+        self.client = None
+        self._sheet = None
+        self.last_values = None
+        # Bumped each time apply_records stores the rows it wrote, so reads
+        # that started before can tell their rows are older
+        self.generation = 0
+        self.values_lock = threading.Lock()
+        self.pending_read = None
+        self.slot_index = None
+        self.slot_index_source = None  # (last_values, outbox length) it was built from
+
+    def connect(self):
         if not GOOGLE_CREDS_JSON:
             raise ValueError("GOOGLE_CREDENTIALS environment variable not found")
-        
+
         creds_dict = json.loads(GOOGLE_CREDS_JSON)
         creds = ServiceAccountCredentials.from_json_keyfile_dict(
             creds_dict, 
@@ -61,188 +361,1384 @@ class SheetsService:
         )
         
         self.client = gspread.authorize(creds)
-        self.sheet = self.client.open("3ami tayeb").sheet1
+        self._sheet = self.client.open("3ami tayeb").sheet1
+
+    @property
+    def sheet(self):
+        """The worksheet, connected on first use so importing the module needs no credentials."""
+        if self._sheet is None:
+            self.connect()
+        return self._sheet
 
     def refresh_connection(self):
         try:
             self.sheet.get_all_values()
         except Exception as e:
-            logger.error(f"Error refreshing connection: {e}")
-            creds_dict = json.loads(GOOGLE_CREDS_JSON)
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(
-                creds_dict, 
-                ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-            )
-            self.client = gspread.authorize(creds)
-            self.sheet = self.client.open("3ami tayeb").sheet1
+            logger.error("Error refreshing connection: %s", e)
+            self.connect()
 
     def get_all_bookings(self):
-        self.refresh_connection()
-        return self.sheet.get_all_values()
-
-    def append_booking(self, booking_data):
-        self.refresh_connection()
-        self.sheet.append_row(booking_data)
+        """Read the bookings, including changes still waiting in the outbox.
 
-    def update_booking_status(self, row_index, status):
-        """Update the status of a booking in the sheet."""
-        self.refresh_connection()
+        If the sheet can't be read, the last successful read is used instead
+        so customers can still be served while Google Sheets is down.
+        """
+        generation = self.generation
         try:
-            # Get all values to find the correct row
-            all_values = self.sheet.get_all_values()
-            logger.info(f"All values in sheet: {all_values}")
-            logger.info(f"Looking for row with index {row_index}")
-            
-            # Find the row with matching ticket number
-            for i, row in enumerate(all_values[1:], start=2):  # Skip header row
-                logger.info(f"Checking row {i}: {row}")
-                if str(row[6]) == str(row_index):  # Check ticket number column
-                    logger.info(f"Found matching row at index {i}")
-                    logger.info(f"Updating status to {status}")
-                    self.sheet.update_cell(i, 6, status)  # Update status column
-                    logger.info("Status updated successfully")
-                    return True
-            
-            logger.error(f"No matching row found for ticket {row_index}")
+            self.refresh_connection()
+            values = self.sheet.get_all_values()
+            with self.values_lock:
+                # Rows read before a replay finished would bring back rows
+                # it changed, after their records left the outbox
+                if self.generation == generation:
+                    self.last_values = values
         except Exception as e:
-            logger.error(f"Error updating status: {str(e)}")
-            logger.error(f"Error type: {type(e)}")
-            return False
+            if self.last_values is None:
+                raise
+            logger.warning("Sheet unavailable, using last known bookings: %s", e)
+        return self.get_cached_bookings()
 
-    def delete_booking(self, row_index):
-        """Delete a booking from the sheet."""
-        self.refresh_connection()
+    def get_cached_bookings(self):
+        """Return the last read bookings with pending outbox changes applied, without a sheet read."""
+        if self.last_values is None:
+            return self.get_all_bookings()
+        rows = [row for _, row in Outbox.apply(self.last_values[1:], outbox.pending_records())]
+        return self.last_values[:1] + rows
+
+    def get_slot_index(self):
+        """SlotIndex of the cached bookings, rebuilt only after they change.
+
+        They change when a read or replay stores new rows and when a record
+        is logged to the outbox, so between changes a lookup is logarithmic.
+        """
+        source = self.slot_index_source
+        if source is None or source[0] is not self.last_values or source[1] != len(outbox.pending):
+            bookings = self.get_cached_bookings()[1:]
+            self.slot_index = SlotIndex(bookings)
+            self.slot_index_source = (self.last_values, len(outbox.pending))
+        return self.slot_index
+
+    def max_ticket_number(self):
+        """Return the highest ticket number in the sheet, or 0 if it can't be read."""
         try:
-            # Get all values to find the correct row
-            all_values = self.sheet.get_all_values()
-            logger.info(f"All values in sheet: {all_values}")
-            logger.info(f"Looking for row with index {row_index}")
-            
-            # Find the row with matching ticket number
-            for i, row in enumerate(all_values[1:], start=2):  # Skip header row
-                logger.info(f"Checking row {i}: {row}")
-                if str(row[6]) == str(row_index):  # Check ticket number column
-                    logger.info(f"Found matching row at index {i}")
-                    logger.info("Deleting row")
-                    self.sheet.delete_rows(i)
-                    logger.info("Row deleted successfully")
-                    return True
-            
-            logger.error(f"No matching row found for ticket {row_index}")
-            return False
+            bookings = self.get_all_bookings()
         except Exception as e:
-            logger.error(f"Error deleting booking: {str(e)}")
-            logger.error(f"Error type: {type(e)}")
-            return False
+            logger.warning("Could not read ticket numbers from the sheet: %s", e)
+            return 0
+        return max((int(row[6]) for row in bookings[1:] if row[6].isdigit()), default=0)
+
+    def _delete_rows(self, row_indexes):
+        """Delete several sheet rows with a single batchUpdate request."""
+        # Delete bottom-up so each deletion leaves the remaining indexes valid
+        requests = [
+            {
+                "deleteDimension": {
+                    "range": {
+                        "sheetId": self.sheet.id,
+                        "dimension": "ROWS",
+                        "startIndex": row - 1,
+                        "endIndex": row
+                    }
+                }
+            }
+            for row in sorted(row_indexes, reverse=True)
+        ]
+        self.sheet.spreadsheet.batch_update({"requests": requests})
+
+    @staticmethod
+    def _same_row(a, b):
+        """Compare two rows, ignoring the empty cells the sheet pads rows with."""
+        def strip(row):
+            row = list(row)
+            while row and row[-1] == "":
+                row.pop()
+            return row
+        return strip(a) == strip(b)
+
+    def apply_records(self, records):
+        """Apply outbox records to the sheet.
+
+        The records are replayed against a fresh read of the sheet and only
+        the difference is written: changed rows in one batched update,
+        removed rows in one batched delete and new rows in one append.
+        Bookings are matched by ticket number, so applying the same records
+        twice leaves the sheet unchanged. Rows are located again by ticket
+        right before writing, in case a hand edit or another instance moved
+        them since the read.
+        """
+        self.refresh_connection()
+        all_values = self.sheet.get_all_values()
+        entries = Outbox.apply(all_values[1:], records)
+
+        changed = [
+            row for origin, row in entries
+            if origin is not None and not self._same_row(row, all_values[origin + 1])
+        ]
+        kept = {origin for origin, _ in entries if origin is not None}
+        removed = [all_values[origin + 1][6] for origin in range(len(all_values) - 1) if origin not in kept]
+        new_rows = [row for origin, row in entries if origin is None]
+
+        sheet_rows = {ticket: i for i, ticket in enumerate(self.sheet.col_values(7), 1) if i > 1 and ticket}
+        updates = [
+            {"range": f"A{sheet_rows[row[6]]}", "values": [row]}
+            for row in changed if row[6] in sheet_rows
+        ]
+        deleted = [sheet_rows[ticket] for ticket in removed if ticket in sheet_rows]
+        new_rows = [row for row in new_rows if row[6] not in sheet_rows]
+
+        # Updates go first so the row indexes are still valid, and appends
+        # last since they don't depend on any index
+        if updates:
+            self.sheet.batch_update(updates)
+        if deleted:
+            self._delete_rows(deleted)
+        if new_rows:
+            self.sheet.append_rows(new_rows)
+
+        with self.values_lock:
+            self.generation += 1
+            self.last_values = all_values[:1] + [row for _, row in entries]
+        logger.info(
+            "Applied %s outbox records: %s updated, %s deleted, %s added",
+            len(records), len(updates), len(deleted), len(new_rows)
+        )
+
+    def iter_booking_chunks(self, chunk_rows: int):
+        """Yield the booking rows in chunks, reading one range of rows per request."""
+        self.refresh_connection()
+        start = 2  # Skip header row
+        while True:
+            chunk = self.sheet.get(f"A{start}:H{start + chunk_rows - 1}")
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_rows:
+                return
+            start += chunk_rows
+
+    async def read_bookings(self):
+        """Run get_all_bookings in a worker thread so the event loop keeps serving other chats.
+
+        Callers arriving while a read is in flight share its result instead
+        of starting another one.
+        """
+        if self.pending_read is None:
+            self.pending_read = asyncio.ensure_future(asyncio.to_thread(self.get_all_bookings))
+            self.pending_read.add_done_callback(self._read_done)
+        return await asyncio.shield(self.pending_read)
 
-    def get_waiting_bookings(self):
-        bookings = self.get_all_bookings()
+    def _read_done(self, future):
+        self.pending_read = None
+
+    async def get_waiting_bookings(self):
+        bookings = await self.read_bookings()
         return [row for row in bookings[1:] if row[5] == "Waiting"]
 
-    def get_done_bookings(self):
-        bookings = self.get_all_bookings()
+    async def get_done_bookings(self):
+        bookings = await self.read_bookings()
         return [row for row in bookings[1:] if row[5] == "Done"]
 
-    def get_barber_bookings(self, barber_name):
-        bookings = self.get_all_bookings()
+    async def get_barber_bookings(self, barber_name):
+        bookings = await self.read_bookings()
         return [row for row in bookings[1:] if row[3] == barber_name]
 
-    def generate_ticket_number(self):
-        bookings = self.get_all_bookings()
-        return len(bookings)
+# Shared State Store
+class SQLiteStore:
+    """State shared between bot instances, kept in a SQLite database.
+
+    Values are strings grouped by namespace, optionally expiring. Every
+    method is a single transaction, so instances sharing the database file
+    see each other's writes immediately. Another backend only needs to
+    provide the same methods.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        """The database connection, opened on first use so importing the module creates no files."""
+        if self._db is None:
+            self._db = self.connect()
+        return self._db
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS kv (
+                namespace TEXT, key TEXT, value TEXT, expires REAL,
+                PRIMARY KEY (namespace, key)
+            );
+            CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER);
+            CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires REAL);
+        """)
+        return db
+
+    def get(self, namespace: str, key: str):
+        row = self.db.execute(
+            "SELECT value FROM kv WHERE namespace = ? AND key = ? AND (expires IS NULL OR expires > ?)",
+            (namespace, key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, namespace: str, key: str, value: str, ttl: float = None):
+        expires = time.time() + ttl if ttl else None
+        self.db.execute(
+            "INSERT OR REPLACE INTO kv (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+            (namespace, key, value, expires)
+        )
+
+    def add(self, namespace: str, key: str, value: str, ttl: float = None) -> bool:
+        """Set a key only if it is missing or expired; return whether it was set."""
+        now = time.time()
+        expires = now + ttl if ttl else None
+        cursor = self.db.execute(
+            "INSERT INTO kv (namespace, key, value, expires) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires = excluded.expires "
+            "WHERE kv.expires IS NOT NULL AND kv.expires <= ?",
+            (namespace, key, value, expires, now)
+        )
+        return cursor.rowcount == 1
+
+    def delete(self, namespace: str, key: str):
+        self.db.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def keys(self, namespace: str):
+        rows = self.db.execute(
+            "SELECT key FROM kv WHERE namespace = ? AND (expires IS NULL OR expires > ?)",
+            (namespace, time.time())
+        )
+        return [row[0] for row in rows]
+
+    def purge_expired(self):
+        self.db.execute("DELETE FROM kv WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+
+    def next_value(self, name: str, floor: int = 0) -> int:
+        """Atomically return a counter's next value, above floor."""
+        row = self.db.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ? + 1) "
+            "ON CONFLICT (name) DO UPDATE SET value = MAX(value, ?) + 1 RETURNING value",
+            (name, floor, floor)
+        ).fetchone()
+        return row[0]
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Take or renew a lease; return whether owner holds it now."""
+        now = time.time()
+        cursor = self.db.execute(
+            "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+            "WHERE leases.owner = excluded.owner OR leases.expires <= ?",
+            (name, owner, now + ttl, now)
+        )
+        return cursor.rowcount == 1
+
+    def release_lease(self, name: str, owner: str):
+        self.db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+# Write-ahead Outbox
+class Outbox:
+    """Append-only log of booking changes waiting to be applied to the sheet.
+
+    Each record is one JSON line, and the log is read back and opened for
+    appending by open(). Writers arriving within fsync_delay of each other
+    share a single fsync. A checkpoint file next to the log
+    stores the offset up to which records have been applied, and the log
+    is truncated once everything in it has reached the sheet.
+
+    Records are:
+      {"op": "book", "row": [...]}                    add a booking
+      {"op": "status", "tickets": [...], "status": s}  change statuses
+                                                       (and the done time)
+      {"op": "delete", "tickets": [...]}               delete bookings
+      {"op": "clear_done", "day": "YYYY-MM-DD"}        delete a day's done bookings
+    """
+    def __init__(self, path: str, fsync_delay: float):
+        self.path = path
+        self.checkpoint_path = f"{path}.checkpoint"
+        self.fsync_delay = fsync_delay
+        self.pending = []  # (end offset, record) not yet applied to the sheet
+        self.last_ticket = 0
+        self.flush_waiter = None
+        self.replay_lock = asyncio.Lock()
+        self.file = None
+
+    def open(self):
+        """Recover the records left from the last run and open the log for appending.
+
+        The log is locked until the process exits; raises RuntimeError if
+        another instance holds it.
+        """
+        if self.file is not None:
+            return
+        file = open(self.path, "ab")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            raise RuntimeError(f"outbox {self.path} is in use by another instance") from None
+        self._load()
+        file.seek(0, os.SEEK_END)  # _load may have cut a torn record off
+        self.file = file
+
+    def _load(self):
+        """Read the records that were logged but not applied before the last shutdown."""
+        checkpoint = {"offset": 0, "last_ticket": 0}
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                checkpoint = json.load(f)
+        self.last_ticket = checkpoint["last_ticket"]
+        if not os.path.exists(self.path):
+            return
+
+        # A checkpoint past the end of the log means the process stopped
+        # between truncating the log and writing the new checkpoint
+        offset = checkpoint["offset"]
+        if offset > os.path.getsize(self.path):
+            offset = 0
+
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete record")
+                    record = json.loads(line)
+                except ValueError:
+                    # Only the last write can be torn by a crash; it was
+                    # never acknowledged, so drop it
+                    logger.warning("Dropping torn outbox record at offset %s", offset)
+                    break
+                offset += len(line)
+                self.pending.append((offset, record))
+                self._track_ticket(record)
+        os.truncate(self.path, offset)
+        if self.pending:
+            logger.info("Recovered %s outbox records", len(self.pending))
+
+    def _track_ticket(self, record):
+        if record["op"] == "book":
+            self.last_ticket = max(self.last_ticket, int(record["row"][6]))
+
+    def _write_checkpoint(self, offset: int):
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"offset": offset, "last_ticket": self.last_ticket}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        waiter, self.flush_waiter = self.flush_waiter, None
+        waiter.set_result(None)
+
+    def allocate_ticket(self, store, sheet_max_ticket: int) -> int:
+        """Return a ticket number above every ticket in the sheet, the log and the store.
+
+        The shared counter keeps instances from handing out the same number.
+        """
+        self.last_ticket = store.next_value("ticket", max(self.last_ticket, sheet_max_ticket))
+        return self.last_ticket
+
+    async def append(self, record):
+        """Log a record, returning once it is durable on disk."""
+        self.file.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        self.pending.append((self.file.tell(), record))
+        self._track_ticket(record)
+
+        if self.flush_waiter is None:
+            loop = asyncio.get_running_loop()
+            self.flush_waiter = loop.create_future()
+            loop.call_later(self.fsync_delay, self._flush)
+        await asyncio.shield(self.flush_waiter)
+
+    def pending_records(self):
+        return [record for _, record in self.pending]
+
+    async def replay(self, sheets):
+        """Apply pending records to the sheet and advance the checkpoint.
+
+        Returns the number of records applied.
+        """
+        async with self.replay_lock:
+            batch = list(self.pending)
+            if not batch:
+                return 0
+            await asyncio.to_thread(sheets.apply_records, [record for _, record in batch])
+
+            del self.pending[:len(batch)]
+            if self.pending:
+                self._write_checkpoint(batch[-1][0])
+            else:
+                # Everything reached the sheet, start the log over
+                self.file.flush()
+                self.file.truncate(0)
+                self.file.seek(0)
+                self._write_checkpoint(0)
+            return len(batch)
+
+    @staticmethod
+    def apply(rows, records):
+        """Replay records over booking rows.
+
+        Returns (origin, row) pairs for the resulting bookings, where origin
+        is the index of the row in rows it came from, or None for a booking
+        added by the records.
+        """
+        entries = [(i, list(row)) for i, row in enumerate(rows)]
+        for record in records:
+            op = record["op"]
+            if op == "book":
+                ticket = record["row"][6]
+                if not any(row[6] == ticket for _, row in entries):
+                    entries.append((None, list(record["row"])))
+            elif op == "status":
+                tickets = set(record["tickets"])
+                for _, row in entries:
+                    if row[6] in tickets:
+                        row[5] = record["status"]
+                        if record["status"] == "Done" and record.get("time"):
+                            # Column H holds the time the booking was done
+                            row.extend([""] * (8 - len(row)))
+                            row[7] = record["time"]
+            elif op == "delete":
+                tickets = set(record["tickets"])
+                entries = [(origin, row) for origin, row in entries if row[6] not in tickets]
+            elif op == "clear_done":
+                entries = [
+                    (origin, row) for origin, row in entries
+                    if not (row[5] == "Done" and row[4].startswith(record["day"]))
+                ]
+        return entries
 
 # Notification Service
 class NotificationService:
+    """Sends queue notifications, remembering what was sent in the shared store."""
+    def __init__(self, store):
+        self.store = store
+
+    def claim_notification(self, user_id: str, notification_type: str, ttl: int) -> bool:
+        """Reserve a notification so no other instance sends it; False if already sent."""
+        return self.store.add("notifications", f"{user_id}_{notification_type}", str(time.time()), ttl)
+
+    def claimed_at(self, user_id: str, notification_type: str):
+        """When a notification was claimed, or None if it wasn't."""
+        value = self.store.get("notifications", f"{user_id}_{notification_type}")
+        return float(value) if value is not None else None
+
+    async def notify_turn(self, context, appointment):
+        """Tell the customer at the head of a queue that it's their turn."""
+        user_id = appointment[0]
+        if TURN_EXPIRY_MINUTES:
+            text = (f"🎉 {appointment[1]}، دورك توا!\n"
+                    f"روح لـ {appointment[3]}.\n"
+                    f"إذا ما جيتش في {TURN_EXPIRY_MINUTES} دقايق، كتخسر دورك. ملي توصل كليكي على {BTN_CHECK_IN}.")
+            reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(BTN_CHECK_IN, callback_data=encode_callback(CB_CHECK_IN, number=appointment[6]))]])
+        else:
+            text = (f"🎉 {appointment[1]}، دورك توا!\n"
+                    f"روح لـ {appointment[3]}.")
+            reply_markup = None
+        await context.bot.send_message(chat_id=int(user_id), text=text, reply_markup=reply_markup)
+        logger.info("Sent turn notification to user %s", user_id)
+
+    async def send_reminder(self, context, appointment, notification_type: str):
+        """Warn a customer that their turn comes in NOTIFICATION_LEADS[notification_type] minutes."""
+        user_id = appointment[0]
+        minutes = NOTIFICATION_LEADS[notification_type]
+        unit = "دقايق" if minutes <= 10 else "دقيقة"
+        await context.bot.send_message(
+            chat_id=int(user_id),
+            text=f"🔔 {appointment[1]}! دورك قريب يجي مع {appointment[3]} في {minutes} {unit}.\n"
+                 f"ابدا تقرب للصالون باش ما تخسرش دورك."
+        )
+        logger.info("Sent %s warning to user %s", notification_type, user_id)
+
+# Metrics
+class Metrics:
+    """Process-wide counters and gauges, reported by the /stats admin command."""
     def __init__(self):
-        self.notification_cache = {}
+        self.values = {}
+
+    def increment(self, name: str, amount: int = 1):
+        self.values[name] = self.values.get(name, 0) + amount
+
+    def set(self, name: str, value):
+        self.values[name] = value
+
+    def snapshot(self):
+        return dict(sorted(self.values.items()))
+
+# Rate Limiting
+class RateLimiter:
+    """Per-chat token buckets.
+
+    Buckets are kept in least-recently-used order and the oldest one is
+    dropped once max_chats is reached; an idle bucket is full anyway, so
+    forgetting it doesn't change the outcome.
+    """
+    def __init__(self, rate: float, burst: int, max_chats: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_chats = max_chats
+        self.buckets = OrderedDict()
+
+    def allow(self, chat_id) -> bool:
+        now = time.monotonic()
+        tokens, last = self.buckets.pop(chat_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[chat_id] = (tokens, now)
+        if len(self.buckets) > self.max_chats:
+            self.buckets.popitem(last=False)
+        return allowed
+
+class ResponseCache:
+    """Last rendered answer per chat and request, kept for a short time."""
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def key(update: Update):
+        """Identify a request by its chat and the button or command that sent it."""
+        if update.callback_query:
+            return update.effective_chat.id, update.callback_query.data
+        return update.effective_chat.id, update.message.text
+
+    def put(self, update: Update, text: str, reply_markup=None):
+        key = self.key(update)
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic() + self.ttl, text, reply_markup)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, update: Update):
+        entry = self.entries.get(self.key(update))
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1], entry[2]
+
+# Update Processing
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently while keeping each chat's updates in order.
+
+    Conversation steps such as ENTERING_NAME and ENTERING_PHONE depend on the
+    previous update of the same chat having finished, so every chat gets a
+    lock, taken in arrival order. Locks are dropped as soon as a chat has
+    nothing in flight, so there is at most one per pending update.
+
+    A worker slot is taken only once the chat's lock is held: the base
+    class takes its semaphore before do_process_update, where updates
+    queued behind a busy chat would sit on slots other chats need, so
+    that one is left effectively unbounded.
+    """
+    def __init__(self, max_concurrent_updates: int):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        super().__init__(2 ** 31 - 1)
+        self.workers = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self.chat_locks = {}
+
+    @staticmethod
+    def chat_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        if isinstance(update, Update):
+            correlation_id.set(f"update-{update.update_id}")
+        key = self.chat_key(update)
+        if key is None:
+            async with self.workers:
+                await coroutine
+            return
+
+        lock, users = self.chat_locks.get(key, (None, 0))
+        lock = lock or asyncio.Lock()
+        self.chat_locks[key] = (lock, users + 1)
+        try:
+            async with lock, self.workers:
+                await coroutine
+        finally:
+            lock, users = self.chat_locks[key]
+            if users == 1:
+                del self.chat_locks[key]
+            else:
+                self.chat_locks[key] = (lock, users - 1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# Per-user State
+def resident_memory_kb() -> int:
+    """Current resident memory of the process, or the peak where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class UserDataJanitor:
+    """Bounds the memory held in user_data and chat_data.
+
+    Users are kept in least-recently-seen order. Once more than max_users
+    are tracked the oldest are dropped, and users idle for ttl seconds are
+    dropped by a periodic sweep. Users seen within protect seconds may be in
+    a conversation and are never dropped, and neither are logged-in admins.
+    """
+    def __init__(self, max_users: int, ttl: int, protect: int):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.protect = protect
+        self.last_seen = OrderedDict()   # user id -> monotonic time
+        self.evicted = 0
 
-    def save_notification_status(self, user_id: str, notification_type: str):
-        self.notification_cache[f"{user_id}_{notification_type}"] = datetime.now().timestamp()
+    def touch(self, user_id: int):
+        self.last_seen.pop(user_id, None)
+        self.last_seen[user_id] = time.monotonic()
+
+    def evict(self, application) -> int:
+        """Drop the state of users over the limit or idle too long; returns how many."""
+        now = time.monotonic()
+        dropped = 0
+        while self.last_seen:
+            user_id, seen = next(iter(self.last_seen.items()))
+            idle = now - seen
+            if idle < self.protect or (idle < self.ttl and len(self.last_seen) <= self.max_users):
+                break
+            del self.last_seen[user_id]
+            if state_store.get("admin_sessions", str(user_id)) is not None:
+                self.last_seen[user_id] = now
+                continue
+            application.drop_user_data(user_id)
+            # Private chats share the user's id
+            application.drop_chat_data(user_id)
+            dropped += 1
+        self.evicted += dropped
 
-    def was_recently_notified(self, user_id: str, notification_type: str) -> bool:
-        key = f"{user_id}_{notification_type}"
-        if key not in self.notification_cache:
+        # Without persistence nothing ever empties the ids PTB queues for it,
+        # which would grow by every user and chat the bot has seen
+        if application.persistence is None:
+            for name in ("_user_ids_to_be_updated_in_persistence", "_user_ids_to_be_deleted_in_persistence",
+                         "_chat_ids_to_be_updated_in_persistence", "_chat_ids_to_be_deleted_in_persistence"):
+                getattr(application, name, set()).clear()
+        return dropped
+
+# Profiling
+class SamplingProfiler:
+    """Samples the Python stacks of all threads from a background thread.
+
+    Nothing runs while the profiler is stopped. Samples whose innermost frame
+    is an idle wait (the event loop's selector, worker threads waiting for
+    work) are counted but left out of the profile, so it shows busy time only.
+    """
+    IDLE_MODULES = ("selectors", "threading", "queue", "concurrent.futures.thread")
+    MAX_DEPTH = 64
+
+    def __init__(self, interval: float, directory: str, top_n: int):
+        self.interval = interval
+        self.directory = directory
+        self.top_n = top_n
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = 0
+        self.updates_left = None
+        self.chat_id = None
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self, updates=None, chat_id=None) -> bool:
+        """Start sampling; returns False if a profile is already running."""
+        if self.running:
             return False
-        time_diff = datetime.now().timestamp() - self.notification_cache[key]
-        return time_diff < 300  # 5 minutes cooldown
+        self.stacks = Counter()
+        self.samples = 0
+        self.updates_left = updates
+        self.chat_id = chat_id
+        self.started = time.monotonic()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.MAX_DEPTH:
+                    stack.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                self.samples += 1
+                if stack and stack[0].split(":")[0] not in self.IDLE_MODULES:
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def count_update(self) -> bool:
+        """Count one processed update; True once the requested number is reached."""
+        if self.updates_left is None:
+            return False
+        self.updates_left -= 1
+        return self.updates_left <= 0
+
+    def stop(self):
+        """Stop sampling, write the folded stacks and return (path, summary lines)."""
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        elapsed = time.monotonic() - self.started
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path, self.summary(elapsed)
+
+    def summary(self, elapsed: float):
+        busy = sum(self.stacks.values())
+        own, inclusive, packages = Counter(), Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for name in set(frames):
+                inclusive[name] += count
+            for package in {name.split(":")[0].split(".")[0] for name in frames}:
+                packages[package] += count
+
+        def top(counter):
+            return [f"{count * 100 // busy}% {name}" for name, count in counter.most_common(self.top_n)]
+
+        lines = [f"🔬 البروفايل: {elapsed:.0f} ثانية، {self.samples} عينة، {busy} منها خدامة", ""]
+        if not busy:
+            return lines + ["ما كان حتى خدمة فهاد الوقت."]
+        return (lines + ["📦 المكتبات:"] + top(packages)
+                + ["", "⏱️ الدوال (مع اللي كتعيط ليه):"] + top(inclusive)
+                + ["", "🔥 الدوال (بوحدها):"] + top(own))
+
+# Appointment Slots
+def _time_of_day_minutes(value: str) -> int:
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
+
+OPENING_MINUTE = _time_of_day_minutes(OPENING_TIME)
+CLOSING_MINUTE = _time_of_day_minutes(CLOSING_TIME)
+
+def current_minute() -> int:
+    return _timestamp_minutes(datetime.now().strftime("%Y-%m-%d %H:%M"))
+
+def minutes_to_timestamp(minutes: int) -> str:
+    """Inverse of _timestamp_minutes."""
+    day = date.fromordinal(minutes // (24 * 60))
+    return f"{day.isoformat()} {minutes % (24 * 60) // 60:02d}:{minutes % 60:02d}"
+
+def booking_slot(row) -> str:
+    """Reserved time of a slot booking (column I), or "" for a walk-in."""
+    return row[8] if len(row) > 8 else ""
+
+class SlotIndex:
+    """Reserved appointment slots of each barber, as sorted start minutes.
+
+    Every slot lasts SLOT_MINUTES. Conflict checks bisect the barber's
+    list, so they take logarithmic time, and searching for free slots or
+    a walk-in's start only walks the reservations in the searched range.
+    """
+    def __init__(self, rows=()):
+        self.starts = {}
+        for row in rows:
+            slot = booking_slot(row)
+            if row[5] == "Waiting" and slot:
+                self.starts.setdefault(row[3], []).append(_timestamp_minutes(slot))
+        for starts in self.starts.values():
+            starts.sort()
+
+    def add(self, barber: str, start: int):
+        bisect.insort(self.starts.setdefault(barber, []), start)
+
+    def remove(self, barber: str, start: int):
+        starts = self.starts.get(barber, [])
+        i = bisect.bisect_left(starts, start)
+        if i < len(starts) and starts[i] == start:
+            del starts[i]
+
+    def conflicts(self, barber: str, start: int, length: int = SLOT_MINUTES) -> bool:
+        """Whether [start, start + length) overlaps a reserved slot."""
+        starts = self.starts.get(barber, [])
+        i = bisect.bisect_left(starts, start)
+        if i > 0 and starts[i - 1] + SLOT_MINUTES > start:
+            return True
+        return i < len(starts) and starts[i] < start + length
+
+    def next_free(self, barber: str, after: int, count: int):
+        """Return up to count free slot starts at or after minute after, within opening hours."""
+        starts = self.starts.get(barber, [])
+        day = 24 * 60
+        start = -(-after // SLOT_MINUTES) * SLOT_MINUTES
+        i = bisect.bisect_right(starts, start - SLOT_MINUTES)
+        last = after + SLOT_DAYS_AHEAD * day
+        free = []
+        while len(free) < count and start < last:
+            minute_of_day = start % day
+            # Jumps to the opening time are rounded up to the slot grid
+            if minute_of_day < OPENING_MINUTE:
+                start = -(-(start + OPENING_MINUTE - minute_of_day) // SLOT_MINUTES) * SLOT_MINUTES
+                continue
+            if minute_of_day + SLOT_MINUTES > CLOSING_MINUTE:
+                start = -(-(start + day - minute_of_day + OPENING_MINUTE) // SLOT_MINUTES) * SLOT_MINUTES
+                continue
+            while i < len(starts) and starts[i] + SLOT_MINUTES <= start:
+                i += 1
+            if i < len(starts) and starts[i] < start + SLOT_MINUTES:
+                start = -(-(starts[i] + SLOT_MINUTES) // SLOT_MINUTES) * SLOT_MINUTES
+                continue
+            free.append(start)
+            start += SLOT_MINUTES
+        return free
+
+    def walk_in_starts(self, barber: str, now: int, count: int):
+        """Estimated start minutes of the next count walk-ins, served in order
+        in the gaps between reserved slots."""
+        starts = self.starts.get(barber, [])
+        i = bisect.bisect_right(starts, now - SLOT_MINUTES)
+        t = now
+        walk_ins = []
+        for _ in range(count):
+            while i < len(starts) and starts[i] < t + MINUTES_PER_CUSTOMER:
+                t = max(t, starts[i] + SLOT_MINUTES)
+                i += 1
+            walk_ins.append(t)
+            t += MINUTES_PER_CUSTOMER
+        return walk_ins
+
+def estimate_waits(queue, now: int = None):
+    """Estimated minutes until each booking in a barber's queue is served.
+
+    Slot bookings wait for their slot; walk-ins share the barber's time
+    with the reserved slots.
+    """
+    if not queue:
+        return []
+    now = current_minute() if now is None else now
+    walk_ins = [row for row in queue if not booking_slot(row)]
+    walk_in_starts = iter(SlotIndex(queue).walk_in_starts(queue[0][3], now, len(walk_ins)))
+    return [
+        max(0, _timestamp_minutes(booking_slot(row)) - now) if booking_slot(row) else next(walk_in_starts) - now
+        for row in queue
+    ]
+
+def serving_order(queue, now: int = None):
+    """A barber's waiting bookings in the order they will be served.
+
+    Bookings are sorted by estimated start, so a slot reserved for later
+    comes after the walk-ins served before it; ties keep sheet order.
+    """
+    waits = estimate_waits(queue, now)
+    return [queue[i] for i in sorted(range(len(queue)), key=waits.__getitem__)]
+
+def is_bookable_slot(start: int) -> bool:
+    """Whether start is a slot that could be offered: on the slot grid,
+    within opening hours, in the future and at most SLOT_DAYS_AHEAD days away."""
+    now = current_minute()
+    minute_of_day = start % (24 * 60)
+    return (
+        now < start <= now + SLOT_DAYS_AHEAD * 24 * 60
+        and start % SLOT_MINUTES == 0
+        and OPENING_MINUTE <= minute_of_day <= CLOSING_MINUTE - SLOT_MINUTES
+    )
+
+def format_slot(minutes: int) -> str:
+    """Short label for a slot, e.g. "اليوم 14:20" or "10-21 09:40"."""
+    timestamp = minutes_to_timestamp(minutes)
+    day = "اليوم" if timestamp[:10] == datetime.now().strftime("%Y-%m-%d") else timestamp[5:10]
+    return f"{day} {timestamp[11:]}"
+
+def slot_suffix(row) -> str:
+    """Reserved time to append to a listed booking, if it has one."""
+    slot = booking_slot(row)
+    return f" - 🕐 {format_slot(_timestamp_minutes(slot))}" if slot else ""
+
+# Live Queue Messages
+def render_live_message(booking, queue) -> str:
+    """Text of a followed queue message for a waiting booking."""
+    position, wait_time = find_position(queue, booking[0])
+    return (
+        f"🔔 كنتبعو دورك مع {booking[3]}\n"
+        f"🎫 رقم تيكيتك: {booking[6]}\n"
+        f"🔢 مرتبتك في لاشان: {position}\n"
+        f"⏳ وقت الانتظار المقدر: {format_wait_time(wait_time)}"
+    )
+
+class LiveQueue:
+    """Messages that follow a customer's place in a barber's queue.
 
-    def clear_notifications_for_user(self, user_id: str):
-        keys_to_remove = [key for key in self.notification_cache.keys() if key.startswith(f"{user_id}_")]
-        for key in keys_to_remove:
-            del self.notification_cache[key]
+    Each subscribed chat has one message that is edited in place when its
+    barber's queue changes. Changes are debounced, edits to one chat are
+    spaced at least min_interval apart and each flush sends at most
+    edits_per_flush edits; anything held back is retried in a later flush.
+    The registry keeps at most max_subscribers chats, dropping the one
+    that subscribed longest ago, and forgets a chat once its ticket is
+    done or deleted.
+    """
+    def __init__(self, debounce: float, min_interval: float, edits_per_flush: int, max_subscribers: int):
+        self.debounce = debounce
+        self.min_interval = min_interval
+        self.edits_per_flush = edits_per_flush
+        self.max_subscribers = max_subscribers
+        self.subscribers = OrderedDict()  # chat_id -> subscription dict
+        self.changed = set()
+        self.flush_job = None
 
-    async def send_notifications(self, context, waiting_appointments):
+    def subscribe(self, chat_id: int, booking, message_id: int, text: str):
+        self.subscribers.pop(chat_id, None)
+        self.subscribers[chat_id] = {
+            "user_id": booking[0],
+            "barber": booking[3],
+            "ticket": booking[6],
+            "message_id": message_id,
+            "text": text,
+            "edited": time.monotonic()
+        }
+        if len(self.subscribers) > self.max_subscribers:
+            self.subscribers.popitem(last=False)
+        metrics.set("live_queue.subscribers", len(self.subscribers))
+
+    def unsubscribe(self, chat_id: int):
+        self.subscribers.pop(chat_id, None)
+        metrics.set("live_queue.subscribers", len(self.subscribers))
+
+    def mark_changed(self, job_queue, barbers=None):
+        """Schedule an update of the messages following the given barbers' queues."""
+        self.changed.update(barbers if barbers is not None else BARBERS.values())
+        if self.subscribers and self.flush_job is None and job_queue is not None:
+            self.flush_job = job_queue.run_once(self.flush, self.debounce)
+
+    async def flush(self, context):
+        """Edit the followed messages whose queue changed."""
+        self.flush_job = None
+        changed, self.changed = self.changed, set()
+        if not self.subscribers:
+            return
+
+        bookings = sheets_service.get_cached_bookings()[1:]
+        queue_index = build_queue_index(row for row in bookings if row[5] == "Waiting")
+        now = time.monotonic()
+        edits = 0
+        for chat_id, subscription in list(self.subscribers.items()):
+            barber = subscription["barber"]
+            if barber not in changed:
+                continue
+            queue = queue_index.get(barber, [])
+            booking = next((row for row in queue if row[6] == subscription["ticket"]), None)
+            if booking is None:
+                text, reply_markup = f"ℹ️ تيكيتك {subscription['ticket']} ما بقاش في لاشان.", None
+            else:
+                text = render_live_message(booking, queue)
+                reply_markup = InlineKeyboardMarkup(UNFOLLOW_KEYBOARD)
+                if text == subscription["text"]:
+                    continue
+            if edits >= self.edits_per_flush or now - subscription["edited"] < self.min_interval:
+                # Try again later rather than exceed the edit rate
+                self.changed.add(barber)
+                metrics.increment("live_queue.deferred_edits")
+                continue
+
+            edits += 1
+            try:
+                await context.bot.edit_message_text(
+                    text, chat_id=chat_id, message_id=subscription["message_id"], reply_markup=reply_markup
+                )
+                metrics.increment("live_queue.edits")
+            except BadRequest as e:
+                if "not modified" not in str(e):
+                    logger.warning("Stopped following queue for chat %s: %s", chat_id, e)
+                    booking = None
+            except Exception as e:
+                logger.warning("Stopped following queue for chat %s: %s", chat_id, e)
+                booking = None
+            subscription["text"] = text
+            subscription["edited"] = now
+            if booking is None:
+                self.unsubscribe(chat_id)
+
+        if self.changed and self.flush_job is None:
+            self.flush_job = context.job_queue.run_once(self.flush, self.min_interval)
+
+# Ticket Timers
+class TicketTimers:
+    """run_once jobs for each waiting ticket: reminders before the estimated
+    turn, the turn notification, and the expiry of a called customer who
+    doesn't check in.
+
+    Jobs are kept by ticket. When bookings change, only the barbers whose
+    queue changed are rescheduled, so no job scans all tickets on a timer.
+    """
+    def __init__(self):
+        self.queues = {}   # barber -> ((ticket, slot), ...) as last scheduled
+        self.jobs = {}     # ticket -> {kind: (due time, job)}
+        self.sent = {}     # ticket -> kinds that fired or were skipped
+
+    def sync(self, job_queue, rows):
+        """Reschedule the tickets of every barber whose waiting queue changed."""
+        if job_queue is None:
+            return
+        queue_index = build_queue_index(row for row in rows if row[5] == "Waiting")
+        for barber in set(self.queues) | set(queue_index):
+            queue = queue_index.get(barber, [])
+            signature = tuple((row[6], booking_slot(row)) for row in queue)
+            previous = self.queues.pop(barber, ())
+            if signature:
+                self.queues[barber] = signature
+            if signature == previous:
+                continue
+            for ticket in {ticket for ticket, _ in previous} - {ticket for ticket, _ in signature}:
+                self.forget(ticket)
+            self.schedule(job_queue, queue)
+        metrics.set("ticket_timers.jobs", sum(map(len, self.jobs.values())))
+
+    def schedule(self, job_queue, queue):
+        now = time.time() - datetime.now().second
+        for position, (row, wait) in enumerate(zip(queue, estimate_waits(queue))):
+            ticket = row[6]
+            sent = self.sent.setdefault(ticket, set())
+            wanted = {}
+            if position == 0:
+                if "turn" not in sent:
+                    wanted["turn"] = wait
+            else:
+                # Of the reminders already due only the closest one is sent,
+                # and none after a closer one went out
+                closer = False
+                for kind, lead in sorted(NOTIFICATION_LEADS.items(), key=lambda item: item[1]):
+                    if kind in sent or closer:
+                        sent.add(kind)
+                        closer = True
+                    else:
+                        wanted[kind] = wait - lead
+                        closer = wait <= lead
+
+            jobs = self.jobs.setdefault(ticket, {})
+            for kind in [kind for kind in jobs if kind not in wanted and kind != "expire"]:
+                jobs.pop(kind)[1].schedule_removal()
+            for kind, minutes in wanted.items():
+                due = now + max(0, minutes) * 60
+                if kind in jobs and abs(jobs[kind][0] - due) < 60:
+                    continue
+                self.start(job_queue, ticket, kind, due)
+
+    def start(self, job_queue, ticket: str, kind: str, due: float):
+        jobs = self.jobs.setdefault(ticket, {})
+        if kind in jobs:
+            jobs.pop(kind)[1].schedule_removal()
+        job = job_queue.run_once(self.fire, max(0, due - time.time()), data=(ticket, kind), name=f"ticket_{ticket}_{kind}")
+        jobs[kind] = (due, job)
+
+    def arm_expiry(self, job_queue, ticket: str, called: float = None):
+        """Expire the turn TURN_EXPIRY_MINUTES after the customer was called (now by default)."""
+        self.start(job_queue, ticket, "expire", (called or time.time()) + TURN_EXPIRY_MINUTES * 60)
+
+    def cancel(self, ticket: str, kind: str):
+        entry = self.jobs.get(ticket, {}).pop(kind, None)
+        if entry:
+            entry[1].schedule_removal()
+
+    def forget(self, ticket: str):
+        for _, job in self.jobs.pop(ticket, {}).values():
+            job.schedule_removal()
+        self.sent.pop(ticket, None)
+
+    async def fire(self, context):
+        ticket, kind = context.job.data
+        correlation_id.set(f"ticket-{ticket}-{kind}")
+        self.jobs.get(ticket, {}).pop(kind, None)
+        rows = sheets_service.get_cached_bookings()[1:]
+        row = next((row for row in rows if row[6] == ticket and row[5] == "Waiting"), None)
+        if row is None:
+            self.forget(ticket)
+            return
+        if kind == "expire":
+            await expire_turn(context, row, rows)
+            return
+
+        self.sent.setdefault(ticket, set()).add(kind)
+        # Another instance, or this one before a restart, may have sent it
+        # already; a called customer still has to check in in time
+        if not notification_service.claim_notification(row[0], f"{kind}-{ticket}", TICKET_STATE_TTL):
+            if kind == "turn" and TURN_EXPIRY_MINUTES and state_store.get("checkins", ticket) is None:
+                self.arm_expiry(context.job_queue, ticket, notification_service.claimed_at(row[0], f"{kind}-{ticket}"))
+            return
         try:
-            # Clean up old notifications
-            current_user_ids = [appointment[0] for appointment in waiting_appointments]
-            for key in list(self.notification_cache.keys()):
-                user_id = key.split('_')[0]
-                if user_id not in current_user_ids:
-                    del self.notification_cache[key]
-        
-            # Send notifications to users
-            for position, appointment in enumerate(waiting_appointments):
-                user_id = appointment[0]
-                user_name = appointment[1]
-                barber = appointment[3]
-                
-                try:
-                    # Notify user when it's their turn
-                    if position == 0 and not self.was_recently_notified(user_id, "turn"):
-                        await context.bot.send_message(
-                            chat_id=int(user_id),
-                            text=f"🎉 {user_name}، دورك توا!\n"
-                                 f"روح لـ {barber}.\n"
-                                 f"إذا ما جيتش في 5 دقايق، تقدر تخسر دورك."
-                        )
-                        self.save_notification_status(user_id, "turn")
-                        logging.info(f"Sent turn notification to user {user_id}")
-                    
-                    # Notify user 10 minutes before their turn
-                    elif position == 1 and not self.was_recently_notified(user_id, "10min"):
-                        await context.bot.send_message(
-                            chat_id=int(user_id),
-                            text=f"🔔 {user_name}! دورك قريب يجي مع {barber} في 10 دقايق.\n"
-                                 f"ابدا تقرب للصالون باش ما تخسرش دورك."
-                        )
-                        self.save_notification_status(user_id, "10min")
-                        logging.info(f"Sent 10-min warning to user {user_id}")
-                    
-                    # Notify user 20 minutes before their turn
-                    elif position == 2 and not self.was_recently_notified(user_id, "20min"):
-                        await context.bot.send_message(
-                            chat_id=int(user_id),
-                            text=f"🔔 {user_name}! دورك قريب يجي مع {barber} في 20 دقيقة.\n"
-                                 f"ابدا تقرب للصالون باش ما تخسرش دورك."
-                        )
-                        self.save_notification_status(user_id, "20min")
-                        logging.info(f"Sent 20-min warning to user {user_id}")
-                
-                except Exception as e:
-                    logging.error(f"Error sending notification to user {user_id}: {str(e)}")
+            if kind == "turn":
+                await notification_service.notify_turn(context, row)
+                if TURN_EXPIRY_MINUTES:
+                    self.arm_expiry(context.job_queue, ticket)
+            else:
+                await notification_service.send_reminder(context, row, kind)
         except Exception as e:
-            logging.error(f"Error in send_notifications: {str(e)}")
+            logger.error("Error sending %s notification for ticket %s: %s", kind, ticket, e)
+
+# Booking Analytics
+@functools.lru_cache(maxsize=4096)
+def _day_minutes(day: str) -> int:
+    return date.fromisoformat(day).toordinal() * 24 * 60
+
+def _timestamp_minutes(timestamp: str):
+    """Minutes since 0001-01-01 for a "YYYY-MM-DD HH:MM" timestamp, or None."""
+    try:
+        return _day_minutes(timestamp[:10]) + int(timestamp[11:13]) * 60 + int(timestamp[14:16])
+    except ValueError:
+        return None
+
+class BookingReport:
+    """Throughput, wait, no-show and utilisation figures over booking history.
+
+    Rows are fed in chunks and each chunk is processed column by column
+    with map/compress/Counter rather than a Python loop over rows; only the
+    first booking and last done time of each barber's day and the wait
+    times are collected row by row. Only counters, those times and the
+    list of wait times are kept between chunks.
+    """
+    def __init__(self, today: str):
+        self.today = today
+        self.bookings = Counter()      # day -> bookings made
+        self.served = Counter()        # day -> bookings done
+        self.no_shows = 0
+        self.expired = Counter()       # day -> bookings marked No-show
+        self.waits = []                # minutes from booking until served
+        self.busy = Counter()          # barber -> minutes spent serving
+        self.first_booking = {}        # (barber, day) -> earliest booking minute
+        self.last_done = {}            # (barber, day) -> latest done minute
+
+    def add_chunk(self, rows):
+        rows = [row for row in rows if len(row) >= 7]
+        if not rows:
+            return
+        # Older rows and gspread ranges without a Done Time stop at 7 cells
+        columns = chain(zip_longest(*rows, fillvalue=""), repeat(("",) * len(rows)))
+        _, _, _, barbers, times, statuses, _, done_times = islice(columns, 8)
+        days = list(map(itemgetter(slice(10)), times))
+        self.bookings.update(days)
+
+        done = list(map("Done".__eq__, statuses))
+        self.served.update(compress(days, done))
+        self.busy.update({barber: count * MINUTES_PER_CUSTOMER for barber, count in Counter(compress(barbers, done)).items()})
+
+        # Bookings that were never served by the end of their day, or that
+        # were expired at the counter, count as no-shows
+        no_show = list(map("No-show".__eq__, statuses))
+        self.expired.update(compress(days, no_show))
+        past = map(self.today.__gt__, days)
+        self.no_shows += sum(no_show) + sum(compress(past, map("Waiting".__eq__, statuses)))
+
+        booked = list(map(_timestamp_minutes, times))
+        finished = list(map(_timestamp_minutes, done_times))
+        for key, minute in zip(zip(barbers, days), booked):
+            if minute is not None and minute < self.first_booking.get(key, minute + 1):
+                self.first_booking[key] = minute
+        for key, minute in compress(zip(zip(barbers, days), finished), done):
+            if minute is not None and minute > self.last_done.get(key, -1):
+                self.last_done[key] = minute
+
+        # Time until the barber started, i.e. without the customer's own service
+        self.waits.extend(
+            max(0, end - start - MINUTES_PER_CUSTOMER)
+            for start, end in compress(zip(booked, finished), done)
+            if start is not None and end is not None
+        )
+
+    def summary(self):
+        waits = sorted(self.waits)
+        # Today's bookings count once they are served or expired
+        closed = sum(count for day, count in self.bookings.items() if day < self.today) + sum(
+            count for day, count in (self.served + self.expired).items() if day >= self.today
+        )
+        open_minutes = Counter()
+        for (barber, day), end in self.last_done.items():
+            start = self.first_booking.get((barber, day), end)
+            open_minutes[barber] += max(end - start, MINUTES_PER_CUSTOMER)
+        return {
+            "days": len(self.bookings),
+            "daily_served": dict(sorted(self.served.items())),
+            "average_wait": sum(waits) / len(waits) if waits else None,
+            "p90_wait": waits[min(len(waits) - 1, int(len(waits) * 0.9))] if waits else None,
+            "no_show_rate": self.no_shows / closed if closed else None,
+            "utilisation": {
+                barber: min(1.0, self.busy[barber] / minutes)
+                for barber, minutes in sorted(open_minutes.items())
+            }
+        }
+
+def iter_history_chunks(chunk_rows: int, include_sheet: bool = True):
+    """Yield booking rows in chunks from the history exports and the sheet."""
+    for path in sorted(glob.glob(os.path.join(HISTORY_DIR, "*.csv"))) if HISTORY_DIR else []:
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            while True:
+                chunk = list(islice(reader, chunk_rows))
+                if not chunk:
+                    break
+                yield [row for row in chunk if row and row[0] != "User ID"]
+    if include_sheet:
+        yield from sheets_service.iter_booking_chunks(chunk_rows)
+
+def build_report(today: str = None):
+    """Stream the booking history through a BookingReport and return its summary."""
+    report = BookingReport(today or datetime.now().strftime("%Y-%m-%d"))
+    for chunk in iter_history_chunks(ANALYTICS_CHUNK_ROWS):
+        report.add_chunk(chunk)
+    return report.summary()
+
+def format_report(summary) -> str:
+    """Render a report summary as a message for admins."""
+    lines = ["📈 التقرير:", ""]
+    daily_served = summary["daily_served"]
+    if daily_served:
+        lines.append(f"✂️ معدل الزبائن في النهار: {sum(daily_served.values()) / len(daily_served):.1f}")
+        for day, count in list(daily_served.items())[-7:]:
+            lines.append(f"   {day}: {count}")
+    if summary["average_wait"] is not None:
+        lines.append(f"⏳ معدل الانتظار: {summary['average_wait']:.0f} دقيقة")
+        lines.append(f"⏳ 90% استناو أقل من: {summary['p90_wait']} دقيقة")
+    if summary["no_show_rate"] is not None:
+        lines.append(f"🚫 لي ما جاوش: {summary['no_show_rate']:.0%}")
+    for barber, utilisation in summary["utilisation"].items():
+        lines.append(f"💇‍♂️ {barber} خدام: {utilisation:.0%} من الوقت")
+    if len(lines) == 2:
+        lines.append("ما كاين حتى معلومات")
+    return "\n".join(lines)
 
 # Initialize services
 sheets_service = SheetsService()
-notification_service = NotificationService()
+state_store = SQLiteStore(STATE_DB_PATH)
+outbox = Outbox(OUTBOX_PATH, OUTBOX_FSYNC_DELAY)
+notification_service = NotificationService(state_store)
+metrics = Metrics()
+ticket_timers = TicketTimers()
+live_queue = LiveQueue(LIVE_QUEUE_DEBOUNCE, LIVE_QUEUE_MIN_INTERVAL, LIVE_QUEUE_EDITS_PER_FLUSH, LIVE_QUEUE_MAX_SUBSCRIBERS)
+rate_limiter = RateLimiter(RATE_LIMIT_RATE, RATE_LIMIT_BURST, RATE_LIMIT_MAX_CHATS)
+response_cache = ResponseCache(RESPONSE_CACHE_TTL, RATE_LIMIT_MAX_CHATS)
+profiler = SamplingProfiler(PROFILE_INTERVAL, PROFILE_DIR, PROFILE_TOP_N)
+user_data_janitor = UserDataJanitor(USER_DATA_MAX_USERS, USER_DATA_TTL, CONVERSATION_TIMEOUT)
+
+def leader_only(job):
+    """Run a scheduled job only on the instance holding the jobs lease."""
+    @functools.wraps(job)
+    async def wrapper(context):
+        correlation_id.set(f"job-{job.__name__}")
+        if not state_store.acquire_lease("jobs", INSTANCE_ID, JOB_LEASE_TTL):
+            metrics.increment("jobs.skipped_not_leader")
+            return
+        return await job(context)
+    return wrapper
+
+def rate_limited(handler):
+    """Answer over-limit requests from the response cache instead of running handler."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context):
+        if rate_limiter.allow(update.effective_chat.id):
+            metrics.increment("rate_limit.allowed")
+            return await handler(update, context)
+
+        metrics.increment("rate_limit.limited")
+        cached = response_cache.get(update)
+        if cached is not None:
+            metrics.increment("rate_limit.cache_hits")
+        logger.info("Rate limited %s for chat %s", handler.__name__, update.effective_chat.id, extra=SAMPLED)
+
+        query = update.callback_query
+        if query:
+            await query.answer("⏳ بالشوية عليك، عاود من بعد شوية.")
+            if cached is not None:
+                try:
+                    await query.edit_message_text(cached[0], reply_markup=cached[1])
+                except BadRequest as e:
+                    if "not modified" not in str(e):
+                        raise
+        elif cached is not None:
+            await update.message.reply_text(cached[0], reply_markup=cached[1])
+        else:
+            await update.message.reply_text("⏳ بالشوية عليك، عاود من بعد شوية.")
+        return ConversationHandler.END
+    return wrapper
+
+async def track_user(update: Update, context):
+    """Mark the sender as recently seen and drop the oldest users' state if over the limit."""
+    if update.effective_user:
+        user_data_janitor.touch(update.effective_user.id)
+        if len(user_data_janitor.last_seen) > user_data_janitor.max_users:
+            user_data_janitor.evict(context.application)
+
+def record_memory_metrics(application):
+    metrics.set("memory.rss_kb", resident_memory_kb())
+    metrics.set("user_data.tracked_users", len(user_data_janitor.last_seen))
+    metrics.set("user_data.entries", len(application.user_data))
+    metrics.set("user_data.evicted", user_data_janitor.evicted)
+
+async def sweep_user_data(context):
+    """Drop idle users' state and log memory use."""
+    dropped = user_data_janitor.evict(context.application)
+    record_memory_metrics(context.application)
+    logger.info("Dropped state of %s idle users, %s tracked, RSS %s kB",
+                dropped, len(user_data_janitor.last_seen), metrics.values['memory.rss_kb'])
+
+async def replay_outbox(context):
+    """Apply logged booking changes to the sheet, keeping them if it is unreachable."""
+    try:
+        applied = await outbox.replay(sheets_service)
+        if applied:
+            logger.info("Replayed %s outbox records", applied)
+    except Exception as e:
+        logger.warning("Sheet unavailable, %s changes waiting in outbox: %s", len(outbox.pending), e)
+
+async def record_change(context, record):
+    """Log a booking change and return the bookings as they are once it applies.
+
+    The change is written to the sheet in the background; the returned rows
+    come from the last sheet read plus the outbox, without another read.
+    """
+    record.setdefault("time", datetime.now().strftime("%Y-%m-%d %H:%M"))
+    await outbox.append(record)
+    context.application.create_task(replay_outbox(context))
+    rows = sheets_service.get_cached_bookings()[1:]
+    ticket_timers.sync(context.job_queue, rows)
+    live_queue.mark_changed(context.job_queue)
+    return rows
 
 # Handlers
+@rate_limited
 async def start(update: Update, context):
     """Start the conversation and show available options."""
-    logger.info(f"Start command received from user {update.message.chat_id}")
+    logger.info("Start command received from user %s", update.message.chat_id, extra=SAMPLED)
     user_id = str(update.message.chat_id)
     
     # Get user's active booking
-    waiting_appointments = sheets_service.get_waiting_bookings()
-    logger.info(f"Found {len(waiting_appointments)} waiting appointments")
+    waiting_appointments = await sheets_service.get_waiting_bookings()
+    logger.info("Found %s waiting appointments", len(waiting_appointments), extra=SAMPLED)
     
     # Check if user has an active booking
     user_booking = None
     for booking in waiting_appointments:
         if booking[0] == user_id:
             user_booking = booking
-            logger.info(f"Found active booking for user {user_id}: {booking}")
+            logger.info("Found active booking for user %s: %s", user_id, booking, extra=SAMPLED)
             break
     
     # Base keyboard
@@ -253,17 +1749,18 @@ async def start(update: Update, context):
     
     # Add management buttons if user has an active booking
     if user_booking:
-        logger.info(f"Adding management buttons for user {user_id}")
+        logger.info("Adding management buttons for user %s", user_id, extra=SAMPLED)
         keyboard.append([BTN_DELETE, BTN_CHANGE_STATUS])
     else:
-        logger.info(f"No active booking found for user {user_id}")
+        logger.info("No active booking found for user %s", user_id, extra=SAMPLED)
     
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text(
+    message = (
         "👋 مرحبا بيك عند الحلاق!\n"
-        "🤔 شنو تحب دير:",
-        reply_markup=reply_markup
+        "🤔 شنو تحب دير:"
     )
+    response_cache.put(update, message, reply_markup)
+    await update.message.reply_text(message, reply_markup=reply_markup)
     return ConversationHandler.END
 
 async def cancel(update: Update, context):
@@ -272,33 +1769,201 @@ async def cancel(update: Update, context):
     
 async def check_existing_appointment(user_id: str) -> bool:
     """Check if user already has an active appointment."""
-    waiting_appointments = sheets_service.get_waiting_bookings()
+    waiting_appointments = await sheets_service.get_waiting_bookings()
     return any(appointment[0] == user_id for appointment in waiting_appointments)
 
 async def get_barber_queue(barber_name: str):
-    """Get waiting appointments for a specific barber."""
-    waiting_appointments = sheets_service.get_waiting_bookings()
-    return [appointment for appointment in waiting_appointments if appointment[3] == barber_name]
+    """Get waiting appointments for a specific barber, in serving order."""
+    waiting_appointments = await sheets_service.get_waiting_bookings()
+    return serving_order([appointment for appointment in waiting_appointments if appointment[3] == barber_name])
 
 async def get_position_and_wait_time(user_id: str, barber_name: str = None):
     """Get user's position and estimated wait time for a specific barber or all barbers."""
-    if barber_name:
-        waiting_appointments = await get_barber_queue(barber_name)
-    else:
-        waiting_appointments = sheets_service.get_waiting_bookings()
+    waiting_appointments = await sheets_service.get_waiting_bookings()
+    if not barber_name:
+        barber_name = next((row[3] for row in waiting_appointments if row[0] == user_id), None)
     
-    position = next((i for i, row in enumerate(waiting_appointments) if row[0] == user_id), -1)
-    
-    if position == -1:
+    queue = [row for row in waiting_appointments if row[3] == barber_name]
+    return find_position(queue, user_id)
+
+# Paged rendering
+def format_wait_time(wait_time: int) -> str:
+    """Format a wait time in minutes the way the bot shows it to customers."""
+    if wait_time < 60:
+        return f"{wait_time} دقيقة"
+    return f"{wait_time // 60} ساعة و {wait_time % 60} دقيقة"
+
+def message_length(text: str) -> int:
+    """Length of text as Telegram counts it (UTF-16 code units)."""
+    return len(text.encode('utf-16-le')) // 2
+
+def shorten(text: str, limit: int) -> str:
+    """Cut text to at most limit characters, marking the cut with an ellipsis."""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def iter_pages(lines, limit: int = PAGE_LENGTH):
+    """Yield pages of text built from lines, splitting only at line boundaries."""
+    page, size = [], 0
+    for line in lines:
+        length = message_length(line)
+        if length > limit:
+            # A single line can't be split at a boundary, so cut it short
+            line = line[:limit // 2 - 1] + "…"
+            length = message_length(line)
+        if page and size + length + 1 > limit:
+            yield "\n".join(page)
+            page, size = [], 0
+        page.append(line)
+        size += length + 1
+    if page:
+        yield "\n".join(page)
+
+def get_page(lines, page_number: int, limit: int = PAGE_LENGTH):
+    """Return the text of one page and whether another page follows it.
+
+    Only the lines up to the end of the requested page (plus one line of
+    look-ahead) are consumed from the generator.
+    """
+    pages = iter_pages(lines, limit)
+    text = next(islice(pages, page_number, None), None)
+    has_next = next(pages, None) is not None
+    return text, has_next
+
+PAGE_ACTIONS = {"queue": CB_PAGE_QUEUE, "admin": CB_PAGE_ADMIN, "wait": CB_PAGE_WAIT}
+
+def page_keyboard(view: str, page_number: int, has_next: bool, extra_rows=()):
+    """Build the previous/next buttons for a paged view."""
+    kind, barber_key = view.split("_", 1)
+    action = PAGE_ACTIONS[kind]
+    barber = None if barber_key == "all" else barber_key
+    buttons = []
+    if page_number > 0:
+        buttons.append(InlineKeyboardButton(BTN_PREV_PAGE, callback_data=encode_callback(action, barber, page=page_number - 1)))
+    if has_next:
+        buttons.append(InlineKeyboardButton(BTN_NEXT_PAGE, callback_data=encode_callback(action, barber, page=page_number + 1)))
+    keyboard = ([buttons] if buttons else []) + list(extra_rows)
+    return InlineKeyboardMarkup(keyboard) if keyboard else None
+
+FOLLOW_KEYBOARD = [[InlineKeyboardButton(BTN_FOLLOW_QUEUE, callback_data=encode_callback(CB_FOLLOW))]]
+UNFOLLOW_KEYBOARD = [[InlineKeyboardButton(BTN_UNFOLLOW_QUEUE, callback_data=encode_callback(CB_UNFOLLOW))]]
+
+def build_queue_index(waiting_appointments):
+    """Group waiting appointments by barber, each in serving order."""
+    queue_index = {barber_name: [] for barber_name in BARBERS.values()}
+    for appointment in waiting_appointments:
+        queue_index.setdefault(appointment[3], []).append(appointment)
+    return {barber_name: serving_order(queue) for barber_name, queue in queue_index.items()}
+
+def find_position(queue, user_id: str):
+    """Return the user's position in serving order and wait time in a barber's queue."""
+    waits = estimate_waits(queue)
+    order = sorted(range(len(queue)), key=waits.__getitem__)
+    position = next((position for position, i in enumerate(order) if queue[i][0] == user_id), None)
+    if position is None:
         return None, None
-    
-    # Calculate wait time based on number of people ahead (each person = 10 mins)
-    wait_time = (position) * 10
-    return position + 1, wait_time
+    return position + 1, waits[order[position]]
+
+def iter_queue_lines(user_id: str, barber_keys, queue_index):
+    """Yield the lines of the customer queue view for the given barbers."""
+    if len(barber_keys) == 1:
+        barber_name = BARBERS[barber_keys[0]]
+        queue = queue_index.get(barber_name, [])
+        yield f"📋 لاشان {barber_name}:"
+        yield ""
+        if not queue:
+            yield "ما كاين حتى واحد في لاشان"
+        for i, appointment in enumerate(queue, 1):
+            status = "👤" if appointment[0] == user_id else "⏳"
+            yield f"{i}. {status} {appointment[1]} - رقم: {appointment[6]}{slot_suffix(appointment)}"
+
+        position, wait_time = find_position(queue, user_id)
+        yield ""
+        if position is not None:
+            yield f"🔢 مرتبتك: {position}"
+            yield f"⏳ وقت الانتظار: {format_wait_time(wait_time)}"
+        else:
+            yield "❌ ما عندكش رنديفو مع هذا الحلاق."
+        return
+
+    yield "📋 لاشان الحلاقين:"
+    yield ""
+    for barber_key in barber_keys:
+        barber_name = BARBERS[barber_key]
+        queue = queue_index.get(barber_name, [])
+        yield f"💇‍♂️ {barber_name}:"
+        if not queue:
+            yield "ما كاين حتى واحد في لاشان"
+        for i, appointment in enumerate(queue, 1):
+            status = "👤" if appointment[0] == user_id else "⏳"
+            yield f"{i}. {status} {appointment[1]} - رقم: {appointment[6]}{slot_suffix(appointment)}"
+        yield ""
+
+    has_booking = False
+    for barber_key in barber_keys:
+        barber_name = BARBERS[barber_key]
+        position, wait_time = find_position(queue_index.get(barber_name, []), user_id)
+        if position is not None:
+            has_booking = True
+            yield f"🔢 مرتبتك مع {barber_name}: {position}"
+            yield f"⏳ وقت الانتظار: {format_wait_time(wait_time)}"
+    if not has_booking:
+        yield "❌ ما عندكش رنديفو."
+
+def iter_wait_lines(user_id: str, barber_keys, queue_index):
+    """Yield the lines of the wait time view for the given barbers."""
+    yield "⏳ وقت الانتظار:"
+    yield ""
+    for barber_key in barber_keys:
+        barber_name = BARBERS[barber_key]
+        queue = queue_index.get(barber_name, [])
+        yield f"💇‍♂️ {barber_name}:"
+        if not queue:
+            yield "ما كاين حتى واحد في لاشان"
+        for i, (appointment, wait_time) in enumerate(zip(queue, estimate_waits(queue)), 1):
+            status = "👤" if appointment[0] == user_id else "⏳"
+            yield f"{i}. {status} {appointment[1]} - وقت الانتظار: {format_wait_time(wait_time)}"
+        yield ""
+
+def iter_barber_booking_lines(barber_name: str, barber_appointments):
+    """Yield the lines of the admin listing of a barber's bookings."""
+    yield f"👤 زبائن {barber_name}:"
+    yield ""
+    for i, appointment in enumerate(barber_appointments, 1):
+        status = "⏳ يستنا" if appointment[5] == "Waiting" else "✅ خلص"
+        yield f"{i}. {appointment[1]} - {status} - رقم: {appointment[6]}"
+
+async def render_view_page(view: str, page_number: int, user_id: str):
+    """Render one page of a paged view.
+
+    Views are "queue_all", "queue_<barber key>" and "wait_all" for
+    customers and "admin_<barber key>" for the admin listing of a
+    barber's bookings.
+    """
+    extra_rows = []
+    if view.startswith("admin_"):
+        barber_name = BARBERS[view.replace("admin_", "", 1)]
+        rows = await sheets_service.get_barber_bookings(barber_name)
+        make_lines = lambda: iter_barber_booking_lines(barber_name, rows)
+    else:
+        kind, barber_key = view.split("_", 1)
+        barber_keys = list(BARBERS) if barber_key == "all" else [barber_key]
+        waiting_appointments = await sheets_service.get_waiting_bookings()
+        queue_index = build_queue_index(waiting_appointments)
+        iter_lines = iter_wait_lines if kind == "wait" else iter_queue_lines
+        make_lines = lambda: iter_lines(user_id, barber_keys, queue_index)
+        if any(appointment[0] == user_id for appointment in waiting_appointments):
+            extra_rows = FOLLOW_KEYBOARD
+
+    text, has_next = get_page(make_lines(), page_number)
+    if text is None:
+        # The listing shrank since the page buttons were sent
+        page_number = 0
+        text, has_next = get_page(make_lines(), page_number)
+    return text, page_keyboard(view, page_number, has_next, extra_rows)
 
 async def choose_barber(update: Update, context):
     """Handle the initial appointment booking request."""
-    logger.info(f"Book appointment button clicked by user {update.message.chat_id}")
+    logger.info("Book appointment button clicked by user %s", update.message.chat_id, extra=SAMPLED)
     user_id = str(update.message.chat_id)
     
     # Check if this is an admin adding an appointment
@@ -326,8 +1991,8 @@ async def choose_barber(update: Update, context):
         return ConversationHandler.END
     
     keyboard = [
-        [InlineKeyboardButton(f"👨‍💇‍♂️ {BARBERS['barber_1']}", callback_data="barber_1")],
-        [InlineKeyboardButton(f"👨‍💇‍♂️ {BARBERS['barber_2']}", callback_data="barber_2")]
+        [InlineKeyboardButton(f"👨‍💇‍♂️ {BARBERS['barber_1']}", callback_data=encode_callback(CB_BARBER, "barber_1"))],
+        [InlineKeyboardButton(f"👨‍💇‍♂️ {BARBERS['barber_2']}", callback_data=encode_callback(CB_BARBER, "barber_2"))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -342,16 +2007,99 @@ async def barber_selection(update: Update, context):
     query = update.callback_query
     try:
         await query.answer()
-        context.user_data["barber"] = BARBERS[query.data]
-        await query.edit_message_text("✏️ كتب سميتك من فضلك:")
-        return ENTERING_NAME
+        context.user_data["barber"] = BARBERS[decode_callback(query.data).barber]
+        context.user_data.pop("slot", None)
+        keyboard = [
+            [InlineKeyboardButton("🚶 دوري دابا", callback_data=encode_callback(CB_MODE_WALKIN))],
+            [InlineKeyboardButton("🕐 اختار وقت", callback_data=encode_callback(CB_MODE_SLOT))]
+        ]
+        await query.edit_message_text("⏱️ تحب تدخل في لاشان ولا تحجز وقت؟", reply_markup=InlineKeyboardMarkup(keyboard))
+        return SELECTING_MODE
     except Exception as e:
-        logger.error(f"Error in barber_selection: {e}")
+        logger.error("Error in barber_selection: %s", e)
         await query.edit_message_text("❌ عندنا مشكل. حاول مرة أخرى.")
         return ConversationHandler.END
 
+def slot_keyboard(barber: str, after: int):
+    """Buttons for the next free slots of a barber from minute after on."""
+    free = sheets_service.get_slot_index().next_free(barber, after, SLOTS_OFFERED)
+    keyboard = [
+        [InlineKeyboardButton(f"🕐 {format_slot(start)}", callback_data=encode_callback(CB_SLOT, number=start))]
+        for start in free
+    ]
+    if len(free) == SLOTS_OFFERED:
+        keyboard.append([InlineKeyboardButton("➡️ أوقات من بعد", callback_data=encode_callback(CB_SLOT_AFTER, number=free[-1] + SLOT_MINUTES))])
+    return InlineKeyboardMarkup(keyboard) if keyboard else None
+
+async def handle_booking_mode(update: Update, context):
+    """Continue a booking as a walk-in or by picking a time slot."""
+    query = update.callback_query
+    await query.answer()
+    if decode_callback(query.data).action == CB_MODE_WALKIN:
+        await query.edit_message_text("✏️ كتب سميتك من فضلك:")
+        return ENTERING_NAME
+
+    reply_markup = slot_keyboard(context.user_data["barber"], current_minute() + 1)
+    if reply_markup is None:
+        await query.edit_message_text("❌ ما بقاش وقت فارغ هاد الأيام. تقدر تدخل في لاشان.")
+        return ConversationHandler.END
+    await query.edit_message_text("🕐 اختار الوقت لي يناسبك:", reply_markup=reply_markup)
+    return SELECTING_SLOT
+
+async def handle_slot_selection(update: Update, context):
+    """Remember the chosen slot, or show later slots."""
+    query = update.callback_query
+    await query.answer()
+    data = decode_callback(query.data)
+    if data.action == CB_SLOT_AFTER:
+        reply_markup = slot_keyboard(context.user_data["barber"], max(data.number, current_minute() + 1))
+        if reply_markup is None:
+            await query.edit_message_text("❌ ما بقاش وقت فارغ هاد الأيام. تقدر تدخل في لاشان.")
+            return ConversationHandler.END
+        await query.edit_message_text("🕐 اختار الوقت لي يناسبك:", reply_markup=reply_markup)
+        return SELECTING_SLOT
+
+    start = data.number
+    if not is_bookable_slot(start):
+        logger.warning("Rejected slot %s from user %s", start, query.from_user.id)
+        reply_markup = slot_keyboard(context.user_data["barber"], current_minute() + 1)
+        if reply_markup is None:
+            await query.edit_message_text("❌ ما بقاش وقت فارغ هاد الأيام. تقدر تدخل في لاشان.")
+            return ConversationHandler.END
+        await query.edit_message_text("❌ هاد الوقت ما بقاش متاح. اختار وقت آخر:", reply_markup=reply_markup)
+        return SELECTING_SLOT
+    context.user_data["slot"] = minutes_to_timestamp(start)
+    await query.edit_message_text(f"🕐 الوقت: {format_slot(start)}\n✏️ كتب سميتك من فضلك:")
+    return ENTERING_NAME
+
+def claim_slot(barber: str, slot: str, ticket: str) -> bool:
+    """Reserve a slot for a ticket, failing if another booking holds it.
+
+    The index catches conflicts with known bookings; the claim in the shared
+    store catches another instance booking the same slot at the same time.
+    """
+    start = _timestamp_minutes(slot)
+    if sheets_service.get_slot_index().conflicts(barber, start):
+        return False
+    key = f"{barber}|{slot}"
+    ttl = max(60, (start + SLOT_MINUTES - current_minute()) * 60)
+    if state_store.add("slots", key, ticket, ttl):
+        return True
+    # A claim by a ticket that is no longer booked is left over from a
+    # deleted booking
+    holder = state_store.get("slots", key)
+    bookings = sheets_service.get_cached_bookings()[1:]
+    if holder is not None and any(row[6] == holder and row[5] == "Waiting" for row in bookings):
+        return False
+    state_store.set("slots", key, ticket, ttl)
+    return True
+
 async def handle_name(update: Update, context):
-    context.user_data["name"] = update.message.text
+    name = update.message.text
+    if len(name) > MAX_NAME_LENGTH:
+        await update.message.reply_text(f"❌ السمية طويلة بزاف.\n✏️ كتب سميتك (حتى {MAX_NAME_LENGTH} حرف):")
+        return ENTERING_NAME
+    context.user_data["name"] = name
     await update.message.reply_text("📱 كتب رقم تيلفونك (مثال: 0677366125):")
     return ENTERING_PHONE
 
@@ -366,101 +2114,49 @@ async def handle_phone(update: Update, context):
     name = context.user_data["name"]
     barber = context.user_data["barber"]
     
-    # Get current bookings to generate next ticket number
-    all_bookings = sheets_service.get_all_bookings()
-    ticket_number = len(all_bookings)  # This will be 1 for the first booking
+    # Tickets keep increasing even when the sheet can't be read
+    ticket_number = outbox.allocate_ticket(state_store, await asyncio.to_thread(sheets_service.max_ticket_number))
 
     booking_data = [user_id, name, phone, barber, datetime.now().strftime("%Y-%m-%d %H:%M"), "Waiting", str(ticket_number)]
-    sheets_service.append_booking(booking_data)
+    slot = context.user_data.pop("slot", None)
+    if slot:
+        if not claim_slot(barber, slot, str(ticket_number)):
+            reply_markup = slot_keyboard(barber, current_minute() + 1)
+            await update.message.reply_text("❌ هاد الوقت تحجز. اختار وقت آخر:", reply_markup=reply_markup)
+            return SELECTING_SLOT if reply_markup else ConversationHandler.END
+        # Column H (done time) stays empty until the booking is done
+        booking_data += ["", slot]
+    rows = await record_change(context, {"op": "book", "row": booking_data})
     
     # Get position and estimated wait time
-    position, wait_time = await get_position_and_wait_time(user_id, barber)
-    hours = wait_time // 60 if wait_time else 0
-    minutes = wait_time % 60 if wait_time else 0
-    time_msg = f"{wait_time} دقيقة" if wait_time and wait_time < 60 else f"{hours} ساعة و {minutes} دقيقة"
+    queue = [row for row in rows if row[3] == barber and row[5] == "Waiting"]
+    position, wait_time = find_position(queue, user_id)
+    time_msg = format_wait_time(wait_time)
                 
     await update.message.reply_text(
         f"✅ تم حجز موعدك!\n"
         f"🎫 رقم تيكيتك: {ticket_number}\n"
         f"💇‍♂️ الحلاق: {barber}\n"
-        f"🔢 مرتبتك في لاشان: {position}\n"
+        f"🔢 مرتبتك في لاشان: {position}{slot_suffix(booking_data)}\n"
         f"⏳ وقت الانتظار المقدر: {time_msg}\n\n"
         f"يمكنك إدارة حجزك من القائمة الرئيسية باستخدام الأزرار:"
         f"\n❌ امسح الحجز - لحذف الحجز"
-        f"\n✅ خلاص - لتحديث حالة الحجز"
+        f"\n✅ خلاص - لتحديث حالة الحجز",
+        reply_markup=InlineKeyboardMarkup(FOLLOW_KEYBOARD)
     )
     return ConversationHandler.END
 
-async def handle_delete_request(update: Update, context):
-    query = update.callback_query
-    await query.answer()
-    
-    # Extract ticket number from callback data
-    ticket_number = query.data.replace("delete_booking_", "")
-    
-    try:
-        # Delete the booking
-        await sheets_service.delete_booking(ticket_number)
-        
-        # Update the message to show it was deleted
-        await query.edit_message_text(
-            f"✅ تم حذف الرنديفو رقم {ticket_number} بنجاح",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔄 تحديث", callback_data="view_all_queues")
-            ]])
-        )
-    except Exception as e:
-        logger.error(f"Error deleting booking: {str(e)}")
-        await query.edit_message_text(
-            "❌ حدث خطأ أثناء حذف الرنديفو. حاول مرة أخرى.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔄 تحديث", callback_data="view_all_queues")
-            ]])
-        )
-
-async def handle_done_request(update: Update, context):
-    query = update.callback_query
-    await query.answer()
-    
-    # Extract ticket number from callback data
-    ticket_number = query.data.replace("done_booking_", "")
-    
-    try:
-        # Update the booking status to done
-        await sheets_service.update_booking_status(ticket_number, "تم")
-        
-        # Update the message to show it was marked as done
-        await query.edit_message_text(
-            f"✅ تم تأكيد انتهاء الرنديفو رقم {ticket_number}",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔄 تحديث", callback_data="view_all_queues")
-            ]])
-        )
-    except Exception as e:
-        logger.error(f"Error marking booking as done: {str(e)}")
-        await query.edit_message_text(
-            "❌ حدث خطأ أثناء تأكيد انتهاء الرنديفو. حاول مرة أخرى.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔄 تحديث", callback_data="view_all_queues")
-            ]])
-        )
-
 async def is_admin(user_id: str, context) -> bool:
     """Check if user is an admin."""
-    return context.user_data.get('is_admin', False)
+    return state_store.get("admin_sessions", user_id) is not None
 
 async def admin_panel(update: Update, context):
     """Handle the admin panel request."""
-    logger.info(f"Admin panel requested by user {update.message.chat_id}")
+    logger.info("Admin panel requested by user %s", update.message.chat_id, extra=SAMPLED)
     
     # Check if user is already authenticated as admin
     if await is_admin(str(update.message.chat_id), context):
-        keyboard = [
-            [BTN_VIEW_WAITING, BTN_VIEW_DONE],
-            [BTN_VIEW_BARBER1, BTN_VIEW_BARBER2],
-            [BTN_ADD, BTN_REFRESH]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        reply_markup = ReplyKeyboardMarkup(ADMIN_KEYBOARD, resize_keyboard=True)
         await update.message.reply_text(
             "👋 مرحبا بيك في لوحة التحكم:",
             reply_markup=reply_markup
@@ -473,29 +2169,101 @@ async def admin_panel(update: Update, context):
 
 async def verify_admin_password(update: Update, context):
     """Verify the admin password and show admin panel if correct."""
-    logger.info(f"Password verification attempt by user {update.message.chat_id}")
+    logger.info("Password verification attempt by user %s", update.message.chat_id)
     
     if update.message.text == ADMIN_PASSWORD:
-        # Set admin status in user_data
-        context.user_data['is_admin'] = True
-        logger.info(f"Successful admin login by user {update.message.chat_id}")
+        # Record the admin session in the shared store
+        state_store.set("admin_sessions", str(update.message.chat_id), "1", ADMIN_SESSION_TTL)
+        logger.info("Successful admin login by user %s", update.message.chat_id)
         
-        keyboard = [
-            [BTN_VIEW_WAITING, BTN_VIEW_DONE],
-            [BTN_VIEW_BARBER1, BTN_VIEW_BARBER2],
-            [BTN_ADD, BTN_REFRESH]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        reply_markup = ReplyKeyboardMarkup(ADMIN_KEYBOARD, resize_keyboard=True)
         await update.message.reply_text(
             "👋 مرحبا بيك في لوحة التحكم:",
             reply_markup=reply_markup
         )
     else:
-        logger.warning(f"Failed password attempt by user {update.message.chat_id}")
+        logger.warning("Failed password attempt by user %s", update.message.chat_id)
         await update.message.reply_text("❌ كلمة السر ماشي صحيحة.")
     
     return ConversationHandler.END
 
+def render_waiting_panel(waiting_appointments, selected, page_number: int = 0, notice: str = None):
+    """Render the admin waiting list as one message with per-ticket and bulk actions."""
+    if not waiting_appointments:
+        text = "ما كاين حتى واحد في لاشان"
+        if notice:
+            text = f"{notice}\n\n{text}"
+        refresh_keyboard = [[InlineKeyboardButton(BTN_REFRESH, callback_data=encode_callback(CB_REFRESH_WAITING))]]
+        return text, InlineKeyboardMarkup(refresh_keyboard)
+
+    page_count = (len(waiting_appointments) + WAITING_PANEL_SIZE - 1) // WAITING_PANEL_SIZE
+    page_number = max(0, min(page_number, page_count - 1))
+    start = page_number * WAITING_PANEL_SIZE
+
+    lines = [notice, ""] if notice else []
+    lines.append("📋 لاشان الانتظار:")
+    keyboard = []
+    for i, appointment in enumerate(waiting_appointments[start:start + WAITING_PANEL_SIZE], start + 1):
+        ticket = appointment[6]
+        # Names typed into the sheet by hand can be any length
+        name = shorten(appointment[1], MAX_NAME_LENGTH)
+        lines.append(f"{i}. {name} - {appointment[3]} - رقم: {ticket}{slot_suffix(appointment)}")
+        mark = "☑️" if ticket in selected else "⬜"
+        keyboard.append([
+            InlineKeyboardButton(f"{mark} {ticket}", callback_data=encode_callback(CB_SELECT, number=ticket)),
+            InlineKeyboardButton(BTN_CHANGE_STATUS, callback_data=encode_callback(CB_STATUS, number=ticket)),
+            InlineKeyboardButton(BTN_DELETE, callback_data=encode_callback(CB_DELETE, number=ticket))
+        ])
+
+    navigation = []
+    if page_number > 0:
+        navigation.append(InlineKeyboardButton(BTN_PREV_PAGE, callback_data=encode_callback(CB_WAITING_PAGE, page=page_number - 1)))
+    if page_number < page_count - 1:
+        navigation.append(InlineKeyboardButton(BTN_NEXT_PAGE, callback_data=encode_callback(CB_WAITING_PAGE, page=page_number + 1)))
+    if navigation:
+        keyboard.append(navigation)
+    if selected:
+        keyboard.append([
+            InlineKeyboardButton(f"{BTN_CHANGE_STATUS} ({len(selected)})", callback_data=encode_callback(CB_BULK_DONE)),
+            InlineKeyboardButton(f"{BTN_DELETE} ({len(selected)})", callback_data=encode_callback(CB_BULK_DELETE))
+        ])
+    keyboard.append([InlineKeyboardButton(BTN_REFRESH, callback_data=encode_callback(CB_REFRESH_WAITING))])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+def get_selected_tickets(admin_id: str):
+    """Return the tickets an admin ticked in the waiting panel."""
+    return set(json.loads(state_store.get("admin_selection", admin_id) or "[]"))
+
+def set_selected_tickets(admin_id: str, tickets):
+    state_store.set("admin_selection", admin_id, json.dumps(sorted(tickets)), ADMIN_SESSION_TTL)
+
+async def show_waiting_panel(query, context, waiting_appointments=None, notice: str = None):
+    """Edit the admin waiting panel in place.
+
+    The rendered rows are kept in user_data so selecting tickets and
+    switching pages don't need another sheet read. Selected tickets are
+    kept in the shared store so any instance can act on them.
+    """
+    if waiting_appointments is None:
+        waiting_appointments = await sheets_service.get_waiting_bookings()
+    context.user_data["waiting_panel"] = waiting_appointments
+
+    # Forget selections for tickets that left the queue
+    admin_id = str(query.from_user.id)
+    tickets = {appointment[6] for appointment in waiting_appointments}
+    selected = get_selected_tickets(admin_id) & tickets
+    set_selected_tickets(admin_id, selected)
+
+    text, reply_markup = render_waiting_panel(
+        waiting_appointments, selected, context.user_data.get("waiting_page", 0), notice
+    )
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Refreshing an unchanged panel is not an error
+        if "not modified" not in str(e):
+            raise
+
 async def view_waiting_bookings(update: Update, context):
     """Show waiting appointments with management options."""
     # Check if user is admin
@@ -503,58 +2271,133 @@ async def view_waiting_bookings(update: Update, context):
         await update.message.reply_text("❌ ما عندكش الصلاحيات باش تشوف هاد الصفحة.")
         return
     
-    waiting_appointments = sheets_service.get_waiting_bookings()
+    waiting_appointments = await sheets_service.get_waiting_bookings()
     if not waiting_appointments:
         await update.message.reply_text("ما كاين حتى واحد في لاشان")
         return
-        
-    # Send header message
-    await update.message.reply_text("📋 لاشان الانتظار:")
-    
-    # Send each appointment as a separate message with its own buttons
-    for i, appointment in enumerate(waiting_appointments, 1):
-        # Format the appointment details
-        message = f"📍 المرتبة: {i}\n"
-        message += f"👤 الاسم: {appointment[1]}\n"
-        message += f"💇‍♂️ الحلاق: {appointment[3]}\n"
-        message += f"🎫 رقم التذكرة: {appointment[6]}"
-        
-        # Create keyboard for this appointment
-        keyboard = [
-            [
-                InlineKeyboardButton(f"✅ خلاص", callback_data=f"status_{appointment[6]}"),
-                InlineKeyboardButton(f"❌ امسح", callback_data=f"delete_{appointment[6]}")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Send message with buttons
-        await update.message.reply_text(message, reply_markup=reply_markup)
-    
-    # Add refresh button at the bottom
-    refresh_keyboard = [[InlineKeyboardButton("🔄 شارجي", callback_data="refresh_waiting")]]
-    refresh_markup = InlineKeyboardMarkup(refresh_keyboard)
-    await update.message.reply_text("──────────────", reply_markup=refresh_markup)
+
+    context.user_data["waiting_panel"] = waiting_appointments
+    context.user_data["waiting_page"] = 0
+    set_selected_tickets(str(update.message.chat_id), set())
+    text, reply_markup = render_waiting_panel(waiting_appointments, set())
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def handle_waiting_panel(update: Update, context):
+    """Handle ticket selection, paging and refresh in the waiting panel."""
+    query = update.callback_query
+
+    if not await is_admin(str(query.from_user.id), context):
+        await query.answer()
+        await query.edit_message_text("❌ ما عندكش الصلاحيات باش تشوف هاد الصفحة.")
+        return
+
+    data = decode_callback(query.data)
+    waiting_appointments = context.user_data.get("waiting_panel")
+    if data.action == CB_REFRESH_WAITING or waiting_appointments is None:
+        waiting_appointments = None
+    elif data.action == CB_SELECT:
+        admin_id = str(query.from_user.id)
+        set_selected_tickets(admin_id, get_selected_tickets(admin_id) ^ {str(data.number)})
+    elif data.action == CB_WAITING_PAGE:
+        context.user_data["waiting_page"] = data.page
+
+    await query.answer()
+    await show_waiting_panel(query, context, waiting_appointments)
+
+async def handle_bulk_action(update: Update, context):
+    """Mark done or delete every selected ticket as one change."""
+    query = update.callback_query
+
+    if not await is_admin(str(query.from_user.id), context):
+        await query.answer()
+        await query.edit_message_text("❌ ما عندكش الصلاحيات باش تغير الحالة.")
+        return
+
+    admin_id = str(query.from_user.id)
+    selected = get_selected_tickets(admin_id)
+    if not selected:
+        await query.answer("ما اخترت حتى واحد")
+        return
+    await query.answer()
+
+    if decode_callback(query.data).action == CB_BULK_DONE:
+        rows = await record_change(context, {"op": "status", "tickets": sorted(selected), "status": "Done"})
+        notice = f"✅ تم تغيير الحالة لـ {len(selected)} حجز"
+    else:
+        rows = await record_change(context, {"op": "delete", "tickets": sorted(selected)})
+        notice = f"✅ تم حذف {len(selected)} حجز"
+
+    waiting_appointments = [row for row in rows if row[5] == "Waiting"]
+    set_selected_tickets(admin_id, set())
+    await show_waiting_panel(query, context, waiting_appointments, notice)
+
+async def choose_next_customer(update: Update, context):
+    """Ask which barber is ready for the next customer."""
+    if not await is_admin(str(update.message.chat_id), context):
+        await update.message.reply_text("❌ ما عندكش الصلاحيات باش تشوف هاد الصفحة.")
+        return
+
+    keyboard = [
+        [InlineKeyboardButton(f"💇‍♂️ {barber_name}", callback_data=encode_callback(CB_NEXT_CUSTOMER, barber_key))]
+        for barber_key, barber_name in BARBERS.items()
+    ]
+    await update.message.reply_text("⏭️ شكون الحلاق لي فرغ؟", reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def handle_next_customer(update: Update, context):
+    """Mark the head of a barber's queue done and call the next customer."""
+    query = update.callback_query
+    await query.answer()
+
+    if not await is_admin(str(query.from_user.id), context):
+        await query.edit_message_text("❌ ما عندكش الصلاحيات باش تغير الحالة.")
+        return
+
+    barber_name = BARBERS.get(decode_callback(query.data).barber)
+    if barber_name is None:
+        logger.error("Unknown barber in callback data: %s", query.data)
+        await query.edit_message_text("❌ عندنا مشكل. حاول مرة أخرى.")
+        return
+
+    queue = serving_order([
+        row for row in sheets_service.get_cached_bookings()[1:]
+        if row[3] == barber_name and row[5] == "Waiting"
+    ])
+    done_row = queue[0] if queue else None
+    if done_row is None:
+        await query.edit_message_text(f"ما كاين حتى واحد في لاشان {barber_name}")
+        return
+
+    rows = await record_change(context, {"op": "status", "tickets": [done_row[6]], "status": "Done"})
+    queue = serving_order([row for row in rows if row[3] == barber_name and row[5] == "Waiting"])
+    message = f"✅ {done_row[1]} (رقم: {done_row[6]}) خلص مع {barber_name}"
+    if queue:
+        message += f"\n🔔 دابا دور {queue[0][1]} (رقم: {queue[0][6]})"
+    else:
+        message += "\nما بقى حتى واحد في لاشان"
+
+    keyboard = [[InlineKeyboardButton(BTN_NEXT_CUSTOMER, callback_data=query.data)]]
+    await query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def view_done_bookings(update: Update, context):
     if not await is_admin(str(update.message.chat_id), context):
         await update.message.reply_text("❌ ما عندكش الصلاحيات باش تشوف هاد الصفحة.")
         return
     
-    done_appointments = sheets_service.get_done_bookings()
+    done_appointments = await sheets_service.get_done_bookings()
     if not done_appointments:
         await update.message.reply_text("ما كاين حتى واحد خلص")
         return
 
-    # Send header message
-    await update.message.reply_text("✅ لي خلصو:")
+    # Send header message with the bulk clear action
+    clear_keyboard = [[InlineKeyboardButton("🧹 امسح لي خلصو اليوم", callback_data=encode_callback(CB_CLEAR_DONE))]]
+    await update.message.reply_text("✅ لي خلصو:", reply_markup=InlineKeyboardMarkup(clear_keyboard))
 
     # Send each completed appointment with a delete button
     for i, appointment in enumerate(done_appointments, 1):
         message = f"{i}. {appointment[1]} - {appointment[3]} - رقم: {appointment[6]}"
         
         # Create keyboard with delete button
-        keyboard = [[InlineKeyboardButton(f"❌ امسح", callback_data=f"delete_done_{appointment[6]}")]]
+        keyboard = [[InlineKeyboardButton(f"❌ امسح", callback_data=encode_callback(CB_DELETE_DONE, number=appointment[6]))]]
         reply_markup = InlineKeyboardMarkup(keyboard)
             
         # Send message with delete button
@@ -565,18 +2408,34 @@ async def view_barber_bookings(update: Update, context):
         await update.message.reply_text("❌ ما عندكش الصلاحيات باش تشوف هاد الصفحة.")
         return
     
-    barber_name = BARBERS["barber_1"] if update.message.text == BTN_VIEW_BARBER1 else BARBERS["barber_2"]
-    barber_appointments = sheets_service.get_barber_bookings(barber_name)
+    barber_key = "barber_1" if update.message.text == BTN_VIEW_BARBER1 else "barber_2"
+    barber_name = BARBERS[barber_key]
+    barber_appointments = await sheets_service.get_barber_bookings(barber_name)
     
     if not barber_appointments:
         await update.message.reply_text(f"ما كاين حتى واحد مع {barber_name}")
         return
 
-    message = f"👤 زبائن {barber_name}:\n\n"
-    for i, appointment in enumerate(barber_appointments, 1):
-        status = "⏳ يستنا" if appointment[5] == "Waiting" else "✅ خلص"
-        message += f"{i}. {appointment[1]} - {status} - رقم: {appointment[6]}\n"
-    await update.message.reply_text(message)
+    view = f"admin_{barber_key}"
+    message, has_next = get_page(iter_barber_booking_lines(barber_name, barber_appointments), 0)
+    await update.message.reply_text(message, reply_markup=page_keyboard(view, 0, has_next))
+
+async def handle_clear_done_today(update: Update, context):
+    """Delete all of today's done bookings as one change."""
+    query = update.callback_query
+    await query.answer()
+
+    if not await is_admin(str(query.from_user.id), context):
+        await query.edit_message_text("❌ ما عندكش الصلاحيات باش تمسح الحجز.")
+        return
+
+    today = datetime.now().strftime("%Y-%m-%d")
+    deleted = sum(
+        1 for row in sheets_service.get_cached_bookings()[1:]
+        if row[5] == "Done" and row[4].startswith(today)
+    )
+    await record_change(context, {"op": "clear_done", "day": today})
+    await query.edit_message_text(f"✅ تمسحو {deleted} حجز لي خلصو اليوم")
 
 async def handle_status_change(update: Update, context):
     query = update.callback_query
@@ -588,26 +2447,19 @@ async def handle_status_change(update: Update, context):
         return
     
     try:
-        # Extract ticket number from callback data
-        ticket_number = int(query.data.split('_')[1])
-        logger.info(f"Attempting to change status for ticket {ticket_number}")
-        logger.info(f"Callback data: {query.data}")
+        ticket_number = decode_callback(query.data).number
+        logger.info("Attempting to change status for ticket %s", ticket_number)
         
         # Update the status in the sheet
-        if sheets_service.update_booking_status(ticket_number, "Done"):
-            logger.info("Status change successful")
-            # Show success message
-            await query.edit_message_text("✅ تم تغيير الحالة بنجاح")
-            
-            # Refresh the waiting list
-            await view_waiting_bookings(update, context)
-        else:
-            logger.error("Failed to update status in sheet")
-            await query.edit_message_text("❌ عندنا مشكل في تغيير الحالة. حاول مرة أخرى.")
+        rows = await record_change(context, {"op": "status", "tickets": [str(ticket_number)], "status": "Done"})
+        logger.info("Status change successful")
+        waiting_appointments = [row for row in rows if row[5] == "Waiting"]
+        # Refresh the waiting list in place
+        await show_waiting_panel(query, context, waiting_appointments, "✅ تم تغيير الحالة بنجاح")
         
     except Exception as e:
-        logger.error(f"Error in handle_status_change: {str(e)}")
-        logger.error(f"Error type: {type(e)}")
+        logger.error("Error in handle_status_change: %s", e)
+        logger.error("Error type: %s", type(e))
         await query.edit_message_text("❌ عندنا مشكل. حاول مرة أخرى.")
 
 async def handle_delete_booking(update: Update, context):
@@ -620,190 +2472,285 @@ async def handle_delete_booking(update: Update, context):
         return
     
     try:
-        # Extract ticket number from callback data
-        callback_data = query.data
-        logger.info(f"Received callback data: {callback_data}")
-        
-        if not callback_data.startswith("delete_"):
-            logger.error(f"Invalid callback data format: {callback_data}")
-            await query.edit_message_text("❌ عندنا مشكل في حذف الحجز. حاول مرة أخرى.")
-            return
+        ticket_number = decode_callback(query.data).number
+        logger.info("Attempting to delete ticket %s", ticket_number)
         
-        try:
-            ticket_number = int(callback_data.split("_")[1])
-            logger.info(f"Attempting to delete ticket {ticket_number}")
-            
-            # Delete the booking from the sheet
-            if sheets_service.delete_booking(ticket_number):
-                logger.info("Booking deletion successful")
-                # Show success message
-                await query.edit_message_text("✅ تم حذف الحجز بنجاح")
-                
-                # Refresh the waiting list
-                await view_waiting_bookings(update, context)
-            else:
-                logger.error("Failed to delete booking from sheet")
-                await query.edit_message_text("❌ عندنا مشكل في حذف الحجز. حاول مرة أخرى.")
-        except (IndexError, ValueError) as e:
-            logger.error(f"Error extracting ticket number: {e}")
-            await query.edit_message_text("❌ عندنا مشكل في حذف الحجز. حاول مرة أخرى.")
+        # Delete the booking from the sheet
+        rows = await record_change(context, {"op": "delete", "tickets": [str(ticket_number)]})
+        logger.info("Booking deletion successful")
+        waiting_appointments = [row for row in rows if row[5] == "Waiting"]
+        # Refresh the waiting list in place
+        await show_waiting_panel(query, context, waiting_appointments, "✅ تم حذف الحجز بنجاح")
         
     except Exception as e:
-        logger.error(f"Error in handle_delete_booking: {str(e)}")
-        logger.error(f"Error type: {type(e)}")
+        logger.error("Error in handle_delete_booking: %s", e)
+        logger.error("Error type: %s", type(e))
         await query.edit_message_text("❌ عندنا مشكل. حاول مرة أخرى.")
 
+async def view_stats(update: Update, context):
+    """Show the bot's runtime metrics to admins."""
+    if not await is_admin(str(update.message.chat_id), context):
+        await update.message.reply_text("❌ ما عندكش الصلاحيات باش تشوف هاد الصفحة.")
+        return
+
+    metrics.set("rate_limit.tracked_chats", len(rate_limiter.buckets))
+    metrics.set("response_cache.entries", len(response_cache.entries))
+    record_memory_metrics(context.application)
+    lines = [f"{name}: {value}" for name, value in metrics.snapshot().items()]
+    message, _ = get_page(["📊 الإحصائيات:", ""] + lines, 0)
+    await update.message.reply_text(message)
+
+async def view_report(update: Update, context):
+    """Compute the booking report on demand for admins."""
+    if not await is_admin(str(update.message.chat_id), context):
+        await update.message.reply_text("❌ ما عندكش الصلاحيات باش تشوف هاد الصفحة.")
+        return
+
+    try:
+        summary = await asyncio.to_thread(build_report)
+    except Exception as e:
+        logger.error("Error building report: %s", e)
+        await update.message.reply_text("❌ عندنا مشكل. حاول مرة أخرى.")
+        return
+    await update.message.reply_text(format_report(summary))
+
+@leader_only
+async def send_daily_report(context):
+    """Send the booking report to the configured admin chats."""
+    try:
+        message = format_report(await asyncio.to_thread(build_report))
+    except Exception as e:
+        logger.error("Error in send_daily_report: %s", e)
+        return
+    for chat_id in ADMIN_CHAT_IDS:
+        try:
+            await context.bot.send_message(chat_id=chat_id, text=message)
+        except Exception as e:
+            logger.error("Error sending report to %s: %s", chat_id, e)
+
+async def start_profile(update: Update, context):
+    """Profile the bot for /profile [seconds | <n>u updates], or stop early with /profile stop."""
+    if not await is_admin(str(update.message.chat_id), context):
+        await update.message.reply_text("❌ ما عندكش الصلاحيات باش تشوف هاد الصفحة.")
+        return
+
+    arg = context.args[0].lower() if context.args else str(PROFILE_DEFAULT_SECONDS)
+    if arg == "stop":
+        if not profiler.running:
+            await update.message.reply_text("ما كاين حتى بروفايل خدام.")
+            return
+        await finish_profile(context)
+        return
+    if profiler.running:
+        await update.message.reply_text("⏳ كاين بروفايل خدام. /profile stop باش توقفو.")
+        return
+
+    try:
+        if arg.endswith("u"):
+            updates, seconds = int(arg[:-1]), PROFILE_MAX_SECONDS
+        else:
+            updates, seconds = None, min(int(arg), PROFILE_MAX_SECONDS)
+    except ValueError:
+        updates, seconds = None, 0
+    if seconds < 1 or (updates is not None and updates < 1):
+        await update.message.reply_text("❌ استعمل: /profile 30 (ثواني) ولا /profile 100u (طلبات)")
+        return
+
+    start_profiler(context.application, seconds, updates, update.message.chat_id)
+    what = f"{updates} طلب" if updates else f"{seconds} ثانية"
+    await update.message.reply_text(f"🔬 بدا البروفايل لمدة {what}.")
+
+def start_profiler(application, seconds, updates=None, chat_id=None):
+    """Start the profiler and schedule its end; the update counter only exists meanwhile."""
+    profiler.start(updates, chat_id)
+    if updates:
+        application.add_handler(profile_update_counter, group=-1)
+    application.job_queue.run_once(finish_profile, seconds, name="profile")
+    logger.info("Profiling for %ss or %s updates", seconds, updates)
+
+async def count_profiled_update(update: Update, context):
+    """End an update-bounded profile once enough updates came in."""
+    if profiler.running and profiler.count_update():
+        await finish_profile(context)
+
+profile_update_counter = TypeHandler(Update, count_profiled_update, block=False)
+
+async def finish_profile(context):
+    """Stop the profiler and send its summary and stacks file."""
+    if not profiler.running:
+        return
+    for job in context.job_queue.get_jobs_by_name("profile"):
+        job.schedule_removal()
+    if profile_update_counter in context.application.handlers.get(-1, []):
+        context.application.remove_handler(profile_update_counter, group=-1)
+
+    path, lines = await asyncio.to_thread(profiler.stop)
+    logger.info("Profile written to %s", path)
+    message, _ = get_page(lines, 0)
+    chat_ids = [profiler.chat_id] if profiler.chat_id else ADMIN_CHAT_IDS
+    for chat_id in chat_ids:
+        try:
+            await context.bot.send_message(chat_id=chat_id, text=message)
+            with open(path, "rb") as f:
+                await context.bot.send_document(chat_id=chat_id, document=f, filename=os.path.basename(path))
+        except Exception as e:
+            logger.error("Error sending profile to %s: %s", chat_id, e)
+
 async def handle_refresh(update: Update, context):
     await update.message.reply_text("🔄 تم تحديث البيانات")
 
+@rate_limited
 async def check_queue(update: Update, context):
     # Create keyboard with queue options
     keyboard = [
-        [InlineKeyboardButton("📋 شوف لاشان كامل", callback_data="view_all_queues")],
-        [InlineKeyboardButton(f"💇‍♂️ شوف لاشان {BARBERS['barber_1']}", callback_data=f"view_queue_{BARBERS['barber_1']}")],
-        [InlineKeyboardButton(f"💇‍♂️ شوف لاشان {BARBERS['barber_2']}", callback_data=f"view_queue_{BARBERS['barber_2']}")]
+        [InlineKeyboardButton("📋 شوف لاشان كامل", callback_data=encode_callback(CB_QUEUE_VIEW))],
+        [InlineKeyboardButton(f"💇‍♂️ شوف لاشان {BARBERS['barber_1']}", callback_data=encode_callback(CB_QUEUE_VIEW, "barber_1"))],
+        [InlineKeyboardButton(f"💇‍♂️ شوف لاشان {BARBERS['barber_2']}", callback_data=encode_callback(CB_QUEUE_VIEW, "barber_2"))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
+    response_cache.put(update, "📋 شوف لاشان الحلاقين:", reply_markup)
     await update.message.reply_text(
         "📋 شوف لاشان الحلاقين:",
         reply_markup=reply_markup
     )
 
+@rate_limited
 async def handle_queue_view(update: Update, context):
     query = update.callback_query
     await query.answer()
     
     user_id = str(query.from_user.id)
-    data = query.data
-    
-    if data == "view_all_queues":
-        # Show both queues
-        barber1_queue = await get_barber_queue(BARBERS['barber_1'])
-        barber2_queue = await get_barber_queue(BARBERS['barber_2'])
-        
-        message = "📋 لاشان الحلاقين:\n\n"
-        
-        # Show queue for Barber 1
-        message += f"💇‍♂️ {BARBERS['barber_1']}:\n"
-        if not barber1_queue:
-            message += "ما كاين حتى واحد في لاشان\n"
-        else:
-            for i, appointment in enumerate(barber1_queue, 1):
-                status = "👤" if appointment[0] == user_id else "⏳"
-                message += f"{i}. {status} {appointment[1]} - رقم: {appointment[6]}\n"
-        
-        message += "\n"
-        
-        # Show queue for Barber 2
-        message += f"💇‍♂️ {BARBERS['barber_2']}:\n"
-        if not barber2_queue:
-            message += "ما كاين حتى واحد في لاشان\n"
-        else:
-            for i, appointment in enumerate(barber2_queue, 1):
-                status = "👤" if appointment[0] == user_id else "⏳"
-                message += f"{i}. {status} {appointment[1]} - رقم: {appointment[6]}\n"
-        
-        # Add user's position and wait time if they have an appointment
-        position1, wait_time1 = await get_position_and_wait_time(user_id, BARBERS['barber_1'])
-        position2, wait_time2 = await get_position_and_wait_time(user_id, BARBERS['barber_2'])
-        
-        if position1 is not None:
-            hours1 = wait_time1 // 60
-            minutes1 = wait_time1 % 60
-            time_msg1 = f"{wait_time1} دقيقة" if wait_time1 < 60 else f"{hours1} ساعة و {minutes1} دقيقة"
-            message += f"\n🔢 مرتبتك مع {BARBERS['barber_1']}: {position1}\n"
-            message += f"⏳ وقت الانتظار: {time_msg1}\n"
-        
-        if position2 is not None:
-            hours2 = wait_time2 // 60
-            minutes2 = wait_time2 % 60
-            time_msg2 = f"{wait_time2} دقيقة" if wait_time2 < 60 else f"{hours2} ساعة و {minutes2} دقيقة"
-            message += f"\n🔢 مرتبتك مع {BARBERS['barber_2']}: {position2}\n"
-            message += f"⏳ وقت الانتظار: {time_msg2}\n"
-        
-        if position1 is None and position2 is None:
-            message += "\n❌ ما عندكش رنديفو."
-    else:
-        # Show specific barber's queue
-        barber_name = data.replace("view_queue_", "")
-        barber_queue = await get_barber_queue(barber_name)
-        
-        message = f"📋 لاشان {barber_name}:\n\n"
-        if not barber_queue:
-            message += "ما كاين حتى واحد في لاشان\n"
-        else:
-            for i, appointment in enumerate(barber_queue, 1):
-                status = "👤" if appointment[0] == user_id else "⏳"
-                message += f"{i}. {status} {appointment[1]} - رقم: {appointment[6]}\n"
-        
-        # Add user's position and wait time if they have an appointment
-        position, wait_time = await get_position_and_wait_time(user_id, barber_name)
-        if position is not None:
-            hours = wait_time // 60
-            minutes = wait_time % 60
-            time_msg = f"{wait_time} دقيقة" if wait_time < 60 else f"{hours} ساعة و {minutes} دقيقة"
-            message += f"\n🔢 مرتبتك: {position}\n"
-            message += f"⏳ وقت الانتظار: {time_msg}\n"
-        else:
-            message += "\n❌ ما عندكش رنديفو مع هذا الحلاق."
-    
-    await query.edit_message_text(message)
+    # No barber means all queues
+    view = f"queue_{decode_callback(query.data).barber or 'all'}"
+
+    message, reply_markup = await render_view_page(view, 0, user_id)
+    response_cache.put(update, message, reply_markup)
+    await query.edit_message_text(message, reply_markup=reply_markup)
+
+@rate_limited
+async def handle_page(update: Update, context):
+    """Show another page of a paged listing."""
+    query = update.callback_query
+    await query.answer()
+
+    data = decode_callback(query.data)
+    kind = next(kind for kind, action in PAGE_ACTIONS.items() if action == data.action)
+    view, page_number = f"{kind}_{data.barber or 'all'}", data.page
+
+    if kind == "admin" and not await is_admin(str(query.from_user.id), context):
+        await query.edit_message_text("❌ ما عندكش الصلاحيات باش تشوف هاد الصفحة.")
+        return
+
+    message, reply_markup = await render_view_page(view, page_number, str(query.from_user.id))
+    response_cache.put(update, message, reply_markup)
+    await query.edit_message_text(message, reply_markup=reply_markup)
 
+@rate_limited
 async def estimated_wait_time(update: Update, context):
     user_id = str(update.message.chat_id)
-    
-    # Get queues for both barbers
-    barber1_queue = await get_barber_queue(BARBERS['barber_1'])
-    barber2_queue = await get_barber_queue(BARBERS['barber_2'])
-    
-    message = "⏳ وقت الانتظار:\n\n"
-    
-    # Show wait times for Barber 1
-    message += f"💇‍♂️ {BARBERS['barber_1']}:\n"
-    if not barber1_queue:
-        message += "ما كاين حتى واحد في لاشان\n"
-    else:
-        for i, appointment in enumerate(barber1_queue, 1):
-            wait_time = (i - 1) * 10
-            hours = wait_time // 60
-            minutes = wait_time % 60
-            time_msg = f"{wait_time} دقيقة" if wait_time < 60 else f"{hours} ساعة و {minutes} دقيقة"
-            status = "👤" if appointment[0] == user_id else "⏳"
-            message += f"{i}. {status} {appointment[1]} - وقت الانتظار: {time_msg}\n"
-    
-    message += "\n"
-    
-    # Show wait times for Barber 2
-    message += f"💇‍♂️ {BARBERS['barber_2']}:\n"
-    if not barber2_queue:
-        message += "ما كاين حتى واحد في لاشان\n"
-    else:
-        for i, appointment in enumerate(barber2_queue, 1):
-            wait_time = (i - 1) * 10
-            hours = wait_time // 60
-            minutes = wait_time % 60
-            time_msg = f"{wait_time} دقيقة" if wait_time < 60 else f"{hours} ساعة و {minutes} دقيقة"
-            status = "👤" if appointment[0] == user_id else "⏳"
-            message += f"{i}. {status} {appointment[1]} - وقت الانتظار: {time_msg}\n"
-    
-    await update.message.reply_text(message)
+    message, reply_markup = await render_view_page("wait_all", 0, user_id)
+    response_cache.put(update, message, reply_markup)
+    await update.message.reply_text(message, reply_markup=reply_markup)
+
+async def handle_follow_queue(update: Update, context):
+    """Turn the message into one that follows the customer's place in the queue."""
+    query = update.callback_query
+    await query.answer()
+
+    user_id = str(query.from_user.id)
+    chat_id = query.message.chat_id
+    if decode_callback(query.data).action == CB_UNFOLLOW:
+        live_queue.unsubscribe(chat_id)
+        await query.edit_message_text("🔕 حبسنا المتابعة.")
+        return
+
+    bookings = sheets_service.get_cached_bookings()[1:]
+    booking = next((row for row in bookings if row[0] == user_id and row[5] == "Waiting"), None)
+    if booking is None:
+        await query.edit_message_text("❌ ما عندكش رنديفو.")
+        return
+
+    queue = [row for row in bookings if row[3] == booking[3] and row[5] == "Waiting"]
+    text = render_live_message(booking, queue)
+    live_queue.subscribe(chat_id, booking, query.message.message_id, text)
+    reply_markup = InlineKeyboardMarkup(UNFOLLOW_KEYBOARD)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def expire_turn(context, row, rows):
+    """Give the turn of a called customer who didn't check in to the next one."""
+    ticket = row[6]
+    if state_store.get("checkins", ticket) is not None:
+        return
+    queue = serving_order([other for other in rows if other[3] == row[3] and other[5] == "Waiting"])
+    if queue[0][6] != ticket:
+        return
+    if len(queue) == 1:
+        # Nobody else is waiting, so the barber keeps waiting for them
+        ticket_timers.arm_expiry(context.job_queue, ticket)
+        return
+    if not state_store.add("expired_turns", ticket, str(time.time()), TICKET_STATE_TTL):
+        return
+
+    logger.info("Ticket %s didn't check in, marking it as a no-show", ticket)
+    metrics.increment("ticket_timers.expired")
+    await record_change(context, {"op": "status", "tickets": [ticket], "status": "No-show"})
+    try:
+        await context.bot.send_message(
+            chat_id=int(row[0]),
+            text=f"⌛ {row[1]}، فاتك الدور حيت ما جيتيش في {TURN_EXPIRY_MINUTES} دقايق.\n"
+                 "تقدر دير رنديفو جديد."
+        )
+    except Exception as e:
+        logger.error("Error sending expiry notice to user %s: %s", row[0], e)
+
+async def handle_check_in(update: Update, context):
+    """Confirm a called customer is at the shop so their turn doesn't expire."""
+    query = update.callback_query
+    ticket = str(decode_callback(query.data).number)
+    row = next(
+        (row for row in sheets_service.get_cached_bookings()[1:]
+         if row[6] == ticket and row[5] == "Waiting" and row[0] == str(query.from_user.id)),
+        None
+    )
+    if row is None:
+        await query.answer("❌ هاد الدور ما بقاش.")
+        await query.edit_message_reply_markup(reply_markup=None)
+        return
+
+    state_store.set("checkins", ticket, str(time.time()), TICKET_STATE_TTL)
+    ticket_timers.cancel(ticket, "expire")
+    await query.answer("✅ مرحبا بيك!")
+    await query.edit_message_reply_markup(reply_markup=None)
+
+@leader_only
+async def purge_expired_state(context):
+    """Delete expired keys, such as per-ticket claims, from the shared store."""
+    state_store.purge_expired()
+
+async def release_job_lease(application):
+    """Let another instance take over the scheduled jobs without waiting for the lease to lapse."""
+    state_store.release_lease("jobs", INSTANCE_ID)
 
+@leader_only
 async def check_and_notify_users(context):
     try:
-        waiting_appointments = sheets_service.get_waiting_bookings()
-        await notification_service.send_notifications(context, waiting_appointments)
+        waiting_appointments = await sheets_service.get_waiting_bookings()
+        # Pick up changes made directly in the sheet; the timers of queues
+        # that didn't change are left alone
+        ticket_timers.sync(context.job_queue, waiting_appointments)
+        live_queue.mark_changed(context.job_queue)
     except Exception as e:
-        logging.error(f"Error in check_and_notify_users: {str(e)}")
+        logger.error("Error in check_and_notify_users: %s", e)
 
 # Add these functions to handle button callbacks properly
 async def handle_booking_button(update: Update, context):
     """Handle the booking button click."""
-    logger.info(f"Booking button clicked by user {update.message.chat_id}")
+    logger.info("Booking button clicked by user %s", update.message.chat_id, extra=SAMPLED)
     try:
         return await choose_barber(update, context)
     except Exception as e:
-        logger.error(f"Error handling booking button: {e}")
+        logger.error("Error handling booking button: %s", e)
         await update.message.reply_text("❌ عندنا مشكل. حاول مرة أخرى.")
         return ConversationHandler.END
 
@@ -829,82 +2776,52 @@ async def handle_delete_done_booking(update: Update, context):
         return
     
     try:
-        # Extract ticket number from callback data
-        callback_data = query.data
-        logger.info(f"Received callback data: {callback_data}")
+        ticket_number = decode_callback(query.data).number
+        logger.info("Attempting to delete done ticket %s", ticket_number)
         
-        if not callback_data.startswith("delete_done_"):
-            logger.error(f"Invalid callback data format: {callback_data}")
-            await query.edit_message_text("❌ عندنا مشكل في حذف الحجز. حاول مرة أخرى.")
-            return
-        
-        try:
-            ticket_number = int(callback_data.split("_")[2])
-            logger.info(f"Attempting to delete done ticket {ticket_number}")
-            
-            # Delete the booking from the sheet
-            if sheets_service.delete_booking(ticket_number):
-                logger.info("Done booking deletion successful")
-                # Show success message
-                await query.edit_message_text("✅ تم حذف الحجز بنجاح")
-                
-                # Refresh the done list
-                await view_done_bookings(update, context)
-            else:
-                logger.error("Failed to delete done booking from sheet")
-                await query.edit_message_text("❌ عندنا مشكل في حذف الحجز. حاول مرة أخرى.")
-        except (IndexError, ValueError) as e:
-            logger.error(f"Error extracting ticket number: {e}")
-            await query.edit_message_text("❌ عندنا مشكل في حذف الحجز. حاول مرة أخرى.")
+        # Delete the booking through the outbox
+        await record_change(context, {"op": "delete", "tickets": [str(ticket_number)]})
+        logger.info("Done booking deletion successful")
+        # Show success message
+        await query.edit_message_text("✅ تم حذف الحجز بنجاح")
         
     except Exception as e:
-        logger.error(f"Error in handle_delete_done_booking: {str(e)}")
-        logger.error(f"Error type: {type(e)}")
+        logger.error("Error in handle_delete_done_booking: %s", e)
+        logger.error("Error type: %s", type(e))
         await query.edit_message_text("❌ عندنا مشكل. حاول مرة أخرى.")
 
-async def handle_delete_confirmation(update: Update, context):
-    """Handle the confirmation of booking deletion."""
+# Callback Dispatch: booking conversation buttons are matched by the
+# conversation handler, every other button goes through this table
+CALLBACK_HANDLERS = {
+    CB_QUEUE_VIEW: handle_queue_view,
+    CB_PAGE_QUEUE: handle_page,
+    CB_PAGE_ADMIN: handle_page,
+    CB_PAGE_WAIT: handle_page,
+    CB_FOLLOW: handle_follow_queue,
+    CB_UNFOLLOW: handle_follow_queue,
+    CB_CHECK_IN: handle_check_in,
+    CB_SELECT: handle_waiting_panel,
+    CB_WAITING_PAGE: handle_waiting_panel,
+    CB_REFRESH_WAITING: handle_waiting_panel,
+    CB_BULK_DONE: handle_bulk_action,
+    CB_BULK_DELETE: handle_bulk_action,
+    CB_NEXT_CUSTOMER: handle_next_customer,
+    CB_CLEAR_DONE: handle_clear_done_today,
+    CB_STATUS: handle_status_change,
+    CB_DELETE: handle_delete_booking,
+    CB_DELETE_DONE: handle_delete_done_booking,
+}
+
+async def dispatch_callback(update: Update, context):
+    """Route a button press to its handler, dropping stale and forged buttons."""
     query = update.callback_query
-    await query.answer()
-    
-    try:
-        # Extract ticket number from callback data
-        callback_data = query.data
-        logger.info(f"Received callback data: {callback_data}")
-        
-        if not callback_data.startswith(("confirm_delete_", "cancel_delete_")):
-            logger.error(f"Invalid callback data format: {callback_data}")
-            await query.edit_message_text("❌ عندنا مشكل. حاول مرة أخرى.")
-            return
-            
-        try:
-            ticket_number = int(callback_data.split("_")[2])
-            logger.info(f"Processing deletion for ticket {ticket_number}")
-            
-            if callback_data.startswith("confirm_delete_"):
-                # Delete the booking from the sheet
-                if sheets_service.delete_booking(ticket_number):
-                    logger.info(f"Successfully deleted ticket {ticket_number}")
-                    # Show success message
-                    await query.edit_message_text("✅ تم حذف حجزك بنجاح")
-                    # Refresh the menu to remove the buttons
-                    await start(update, context)
-                else:
-                    logger.error(f"Failed to delete ticket {ticket_number}")
-                    await query.edit_message_text("❌ عندنا مشكل في حذف الحجز. حاول مرة أخرى.")
-            else:
-                # User cancelled the deletion
-                logger.info(f"User cancelled deletion for ticket {ticket_number}")
-                await query.edit_message_text("تم إلغاء عملية الحذف")
-                
-        except (IndexError, ValueError) as e:
-            logger.error(f"Error extracting ticket number: {e}")
-            await query.edit_message_text("❌ عندنا مشكل في حذف الحجز. حاول مرة أخرى.")
-            
-    except Exception as e:
-        logger.error(f"Error in handle_delete_confirmation: {str(e)}")
-        logger.error(f"Error type: {type(e)}")
-        await query.edit_message_text("❌ عندنا مشكل. حاول مرة أخرى.")
+    data = decode_callback(query.data or "")
+    handler = CALLBACK_HANDLERS.get(data.action) if data else None
+    if handler is None:
+        logger.warning("Dropped unknown callback data from user %s: %s", query.from_user.id, query.data)
+        await query.answer("⌛ هاد الزر قديم، عاود من الأول.")
+        return
+    await handler(update, context)
 
 # Modify the main function to fix the event loop issue
 def main():
@@ -915,9 +2832,19 @@ def main():
         if not token:
             logger.error("No TELEGRAM_TOKEN found in environment variables")
             return None
+        if not GOOGLE_CREDS_JSON:
+            logger.error("GOOGLE_CREDENTIALS environment variable not found")
+            return None
+        outbox.open()
         
         # Create the Application with proper error handling
-        application = Application.builder().token(token).build()
+        application = (
+            Application.builder()
+            .token(token)
+            .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_WORKERS))
+            .post_shutdown(release_job_lease)
+            .build()
+        )
 
         # Create admin conversation handler
         admin_handler = ConversationHandler(
@@ -932,7 +2859,8 @@ def main():
             },
             fallbacks=[CommandHandler("cancel", cancel)],
             name="admin_conversation",
-            persistent=False
+            persistent=False,
+            conversation_timeout=CONVERSATION_TIMEOUT
         )
 
         # Create booking conversation handler
@@ -942,7 +2870,13 @@ def main():
             ],
             states={
                 SELECTING_BARBER: [
-                    CallbackQueryHandler(barber_selection, pattern="^barber_")
+                    CallbackQueryHandler(barber_selection, pattern=callback_pattern(CB_BARBER))
+                ],
+                SELECTING_MODE: [
+                    CallbackQueryHandler(handle_booking_mode, pattern=callback_pattern(CB_MODE_WALKIN, CB_MODE_SLOT))
+                ],
+                SELECTING_SLOT: [
+                    CallbackQueryHandler(handle_slot_selection, pattern=callback_pattern(CB_SLOT, CB_SLOT_AFTER))
                 ],
                 ENTERING_NAME: [
                     MessageHandler(filters.TEXT & ~filters.COMMAND, handle_name)
@@ -953,11 +2887,18 @@ def main():
             },
             fallbacks=[CommandHandler("cancel", cancel)],
             name="booking_conversation",
-            persistent=False
+            persistent=False,
+            conversation_timeout=CONVERSATION_TIMEOUT
         )
 
+        # Track who is active before anything else runs (group -1 is taken by /profile)
+        application.add_handler(TypeHandler(Update, track_user), group=-2)
+
         # Register handlers in the correct order
         application.add_handler(CommandHandler("start", start))
+        application.add_handler(CommandHandler("stats", view_stats))
+        application.add_handler(CommandHandler("report", view_report))
+        application.add_handler(CommandHandler("profile", start_profile))
         
         # Add admin button handlers first (before the conversation handlers)
         application.add_handler(MessageHandler(filters.Text([BTN_VIEW_WAITING]), view_waiting_bookings))
@@ -965,6 +2906,7 @@ def main():
         application.add_handler(MessageHandler(filters.Text([BTN_VIEW_BARBER1, BTN_VIEW_BARBER2]), view_barber_bookings))
         application.add_handler(MessageHandler(filters.Text([BTN_ADD]), choose_barber))
         application.add_handler(MessageHandler(filters.Text([BTN_REFRESH]), handle_refresh))
+        application.add_handler(MessageHandler(filters.Text([BTN_NEXT_CUSTOMER]), choose_next_customer))
         
         # Add conversation handlers
         application.add_handler(admin_handler)
@@ -974,18 +2916,21 @@ def main():
         application.add_handler(MessageHandler(filters.Text([BTN_VIEW_QUEUE]), check_queue))
         application.add_handler(MessageHandler(filters.Text([BTN_CHECK_WAIT]), estimated_wait_time))
         
-        # Add callback query handlers
-        application.add_handler(CallbackQueryHandler(handle_status_change, pattern="^status_"))
-        application.add_handler(CallbackQueryHandler(handle_delete_booking, pattern="^delete_[0-9]+$"))
-        application.add_handler(CallbackQueryHandler(handle_queue_view, pattern="^view_(all_queues|queue_)"))
-        application.add_handler(CallbackQueryHandler(handle_delete_done_booking, pattern="^delete_done_[0-9]+$"))
-        application.add_handler(CallbackQueryHandler(handle_delete_request, pattern="^delete_booking_"))
-        application.add_handler(CallbackQueryHandler(handle_done_request, pattern="^done_booking_"))
-        application.add_handler(CallbackQueryHandler(handle_queue_view, pattern="^view_queue_|^view_all_queues$"))
+        # Add the callback query dispatcher last so conversation buttons match first
+        application.add_handler(CallbackQueryHandler(dispatch_callback))
 
         # Initialize job queue for notifications with 1-minute interval
         if application.job_queue:
             application.job_queue.run_repeating(check_and_notify_users, interval=60, first=1)
+            # Retry applying logged changes the sheet couldn't take yet
+            application.job_queue.run_repeating(replay_outbox, interval=OUTBOX_REPLAY_INTERVAL, first=0)
+            # Not leader_only: every instance holds its own user_data
+            application.job_queue.run_repeating(sweep_user_data, interval=USER_DATA_SWEEP_INTERVAL)
+            application.job_queue.run_repeating(purge_expired_state, interval=STATE_PURGE_INTERVAL)
+            if ADMIN_CHAT_IDS:
+                application.job_queue.run_daily(send_daily_report, time=REPORT_TIME)
+            if PROFILE_ON_START:
+                start_profiler(application, PROFILE_ON_START)
             logger.info("Job queue initialized successfully")
         else:
             logger.error("Job queue not available")
@@ -1000,7 +2945,7 @@ def main():
         
         return application
     except Exception as e:
-        logger.error(f"Error in main: {e}")
+        logger.error("Error in main: %s", e)
         return None
 
 if __name__ == '__main__':
@@ -1018,6 +2963,6 @@ if __name__ == '__main__':
             logger.info("Bot stopped by user!")
             break
         except Exception as e:
-            logger.error(f"Fatal error: {e}")
+            logger.error("Fatal error: %s", e)
             time.sleep(30)  # Wait 30 seconds before retrying
             continue 
\ No newline at end of file
@@ -0,0 +1,94 @@
+"""Time handlers with logging on and off, against an in-memory sheet.
+
+    python benchmarks/bench_logging.py --rows 2000 --calls 300
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import barbershop_bot as bot
+
+MODES = {
+    "json": bot.JsonFormatter(bot.LOG_FIELD_LIMIT),
+    "text": bot.TextFormatter(bot.LOG_FIELD_LIMIT),
+    "off": None,
+}
+
+class MemorySheet:
+    """The worksheet calls made by /start and by the outbox replay."""
+
+    def __init__(self, rows):
+        self.rows = [["User ID", "Name", "Phone", "Barber", "Time", "Status", "Ticket Number", "Done Time"]] + rows
+
+    def get_all_values(self):
+        return [list(row) for row in self.rows]
+
+    def col_values(self, col):
+        return [row[col - 1] for row in self.rows]
+
+    def batch_update(self, data, **kwargs):
+        for item in data:
+            self.rows[int(item["range"].lstrip("A")) - 1] = list(item["values"][0])
+
+def synthetic_rows(count: int):
+    barbers = list(bot.BARBERS.values())
+    return [[str(1000 + i), f"C{i}", "0600000000", barbers[i % len(barbers)], "2026-10-19 09:00", "Waiting", str(i), ""]
+            for i in range(1, count + 1)]
+
+async def reply_text(text, **kwargs):
+    pass
+
+def start_update(chat_id: int):
+    message = types.SimpleNamespace(chat_id=chat_id, text="/start", reply_text=reply_text)
+    chat = types.SimpleNamespace(id=chat_id)
+    return types.SimpleNamespace(message=message, callback_query=None, effective_chat=chat, effective_user=chat)
+
+def time_calls(calls: int, call):
+    started = time.perf_counter()
+    for i in range(calls):
+        call(i)
+    return (time.perf_counter() - started) / calls * 1000
+
+def run(mode: str, rows: int, calls: int):
+    logging.disable(logging.NOTSET if MODES[mode] else logging.CRITICAL)
+    if MODES[mode]:
+        bot.log_handler.setFormatter(MODES[mode])
+    bot.sheets_service = bot.SheetsService()
+    bot.sheets_service._sheet = MemorySheet(synthetic_rows(rows))
+    bot.sheets_service.get_all_bookings()
+    context = types.SimpleNamespace(user_data={}, bot=None)
+
+    async def start_calls():
+        # The handler itself, without the per-chat rate limit around it
+        start = bot.start.__wrapped__
+        started = time.perf_counter()
+        for i in range(calls):
+            await start(start_update(1000 + i % rows), context)
+        return (time.perf_counter() - started) / calls * 1000
+
+    replay = time_calls(calls, lambda i: bot.sheets_service.apply_records(
+        [{"op": "status", "tickets": [str(i % rows + 1)], "status": "Waiting"}]))
+    return asyncio.run(start_calls()), replay
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--log-file", default=os.devnull, help="where logged lines go (default: discarded)")
+    args = parser.parse_args()
+
+    bot.log_handler.setStream(open(args.log_file, "w"))
+    bot.logger.setLevel(logging.INFO)
+    for mode in MODES:
+        start, replay = map(min, zip(*(run(mode, args.rows, args.calls) for _ in range(args.repeat))))
+        print(f"logging {mode:4}: /start {start:.3f} ms, status replay on {args.rows} rows {replay:.2f} ms (best of {args.repeat})")
+
+if __name__ == "__main__":
+    main()
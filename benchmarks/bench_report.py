@@ -0,0 +1,59 @@
+"""Time the booking report over a synthetic year of bookings.
+
+    python benchmarks/bench_report.py --days 365 --per-day 120
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from barbershop_bot import ANALYTICS_CHUNK_ROWS, BARBERS, BookingReport
+
+STATUSES = ["Done"] * 17 + ["No-show", "Waiting", "Done"]
+
+def synthetic_rows(days: int, per_day: int, seed: int = 1):
+    """Booking rows spread over the shop's day, mostly served, some no-shows."""
+    rng = random.Random(seed)
+    barbers = list(BARBERS.values())
+    first_day = date.today() - timedelta(days=days)
+    rows = []
+    for offset in range(days):
+        day = (first_day + timedelta(days=offset)).isoformat()
+        for i in range(per_day):
+            minute = 9 * 60 + rng.randrange(12 * 60)
+            status = rng.choice(STATUSES)
+            done = minute + rng.randrange(10, 90)
+            rows.append([
+                str(i), f"C{i}", "0600000000", rng.choice(barbers), f"{day} {minute // 60:02d}:{minute % 60:02d}",
+                status, str(offset * per_day + i), f"{day} {done // 60:02d}:{done % 60:02d}" if status == "Done" else ""
+            ])
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--per-day", type=int, default=120)
+    parser.add_argument("--chunk-rows", type=int, default=ANALYTICS_CHUNK_ROWS)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = synthetic_rows(args.days, args.per_day)
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        report = BookingReport(date.today().isoformat())
+        for start in range(0, len(rows), args.chunk_rows):
+            report.add_chunk(rows[start:start + args.chunk_rows])
+        summary = report.summary()
+        timings.append(time.perf_counter() - started)
+
+    print(f"{len(rows)} rows in chunks of {args.chunk_rows}: "
+          f"best {min(timings) * 1000:.0f} ms, median {sorted(timings)[len(timings) // 2] * 1000:.0f} ms")
+    print(f"no-show rate {summary['no_show_rate']:.1%}, p90 wait {summary['p90_wait']} min")
+
+if __name__ == "__main__":
+    main()
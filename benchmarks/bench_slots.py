@@ -0,0 +1,115 @@
+"""Time slot bookings and availability queries over a month of slots.
+
+Every barber gets a share of the month's slots booked one by one (a
+conflict check and an insert each), then free-slot and walk-in queries
+are run from random times of the month. The same bookings are then put
+in an in-memory sheet to time the handler path: slot_keyboard and
+claim_slot on the cached index, and rebuilding it after a change.
+
+    python benchmarks/bench_slots.py --barbers 50 --days 30 --fill 0.6
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import barbershop_bot as bot
+from barbershop_bot import (CLOSING_MINUTE, OPENING_MINUTE, SLOT_MINUTES, SLOTS_OFFERED, SheetsService, SlotIndex,
+                            current_minute, minutes_to_timestamp)
+
+DAY = 24 * 60
+
+def month_slots(first_day: int, days: int):
+    return [
+        day * DAY + minute
+        for day in range(first_day, first_day + days)
+        for minute in range(OPENING_MINUTE, CLOSING_MINUTE - SLOT_MINUTES + 1, SLOT_MINUTES)
+    ]
+
+class MemorySheet:
+    def __init__(self, rows):
+        self.rows = [["User ID", "Name", "Phone", "Barber", "Time", "Status", "Ticket Number", "Done Time", "Slot"]] + rows
+
+    def get_all_values(self):
+        return [list(row) for row in self.rows]
+
+def sheet_rows(index: SlotIndex):
+    return [
+        [str(1000 + ticket), f"C{ticket}", "0600000000", barber, minutes_to_timestamp(start - DAY), "Waiting",
+         str(ticket), "", minutes_to_timestamp(start)]
+        for ticket, (barber, start) in enumerate(
+            ((barber, start) for barber, starts in index.starts.items() for start in starts), 1)
+    ]
+
+def time_per_call(calls, call):
+    started = time.perf_counter()
+    for args in calls:
+        call(*args)
+    return (time.perf_counter() - started) / len(calls)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--barbers", type=int, default=50)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--fill", type=float, default=0.6, help="share of each barber's slots booked")
+    parser.add_argument("--queries", type=int, default=20000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    first_day = current_minute() // DAY
+    slots = month_slots(first_day, args.days)
+    barbers = [f"barber {i}" for i in range(args.barbers)]
+    index = SlotIndex()
+
+    started = time.perf_counter()
+    booked = 0
+    for barber in barbers:
+        for start in rng.sample(slots, int(len(slots) * args.fill)):
+            if not index.conflicts(barber, start):
+                index.add(barber, start)
+                booked += 1
+    booking_time = time.perf_counter() - started
+
+    starts = [rng.choice(slots) - rng.randrange(SLOT_MINUTES) for _ in range(args.queries)]
+    queried = [rng.choice(barbers) for _ in range(args.queries)]
+    started = time.perf_counter()
+    for barber, after in zip(queried, starts):
+        index.next_free(barber, after, SLOTS_OFFERED)
+    free_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for barber, now in zip(queried, starts):
+        index.walk_in_starts(barber, now, 10)
+    walk_in_time = time.perf_counter() - started
+
+    print(f"{args.barbers} barbers, {len(slots)} slots each over {args.days} days")
+    print(f"booked {booked} slots: {booking_time / booked * 1e6:.1f} us per conflict check and insert")
+    print(f"next {SLOTS_OFFERED} free slots: {free_time / args.queries * 1e6:.1f} us per query")
+    print(f"next 10 walk-in starts: {walk_in_time / args.queries * 1e6:.1f} us per query")
+
+    rows = sheet_rows(index)
+    bot.sheets_service = SheetsService()
+    bot.sheets_service._sheet = MemorySheet(rows)
+    bot.sheets_service.get_all_bookings()
+
+    keyboard_time = time_per_call(list(zip(queried, starts)), bot.slot_keyboard)
+    taken = [(row[3], row[8], "0") for row in rng.sample(rows, min(len(rows), args.queries))]
+    claim_time = time_per_call(taken, bot.claim_slot)
+    rebuilds = 20
+    started = time.perf_counter()
+    for _ in range(rebuilds):
+        # A new sheet read, as after any booking change
+        bot.sheets_service.last_values = list(bot.sheets_service.last_values)
+        bot.sheets_service.get_slot_index()
+    rebuild_time = (time.perf_counter() - started) / rebuilds
+
+    print(f"handler path over {len(rows)} booked rows:")
+    print(f"  slot_keyboard: {keyboard_time * 1e6:.1f} us per call")
+    print(f"  claim_slot of a taken slot: {claim_time * 1e6:.1f} us per call")
+    print(f"  index rebuild after a change: {rebuild_time * 1e3:.1f} ms")
+
+if __name__ == "__main__":
+    main()
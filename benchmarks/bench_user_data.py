@@ -0,0 +1,70 @@
+"""Soak the per-user state janitor with a stream of distinct users.
+
+Every simulated user sends one update through track_user on a real
+Application and leaves booking details in user_data and chat_data. Users
+arrive --arrival-seconds apart on a simulated clock, and the periodic
+sweep runs as it would in the bot. Resident memory is printed as the users
+go by and should level off once USER_DATA_MAX_USERS users are tracked.
+
+    python benchmarks/bench_user_data.py --users 1000000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import Application, CallbackContext
+
+import barbershop_bot as bot
+
+BATCH = 1000
+
+async def send(application, user_ids):
+    for user_id in user_ids:
+        update = Update(user_id, message=Message(user_id, datetime.now(), Chat(user_id, Chat.PRIVATE),
+                                                from_user=User(user_id, "C", False), text="📅 دير رنديفو"))
+        context = CallbackContext.from_update(update, application)
+        await bot.track_user(update, context)
+        context.user_data.update(barber="حلاق 1", name=f"C{user_id}", phone="0600000000")
+        context.chat_data["seen"] = True
+        application.mark_data_for_update_persistence(chat_ids=user_id, user_ids=user_id)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--max-users", type=int, default=bot.USER_DATA_MAX_USERS)
+    parser.add_argument("--arrival-seconds", type=float, default=1.0)
+    parser.add_argument("--report-every", type=int, default=100_000)
+    args = parser.parse_args()
+
+    # The janitor reads time.monotonic; the simulated clock only moves
+    # between batches, while no event loop is running
+    clock = [time.monotonic()]
+    time.monotonic = lambda: clock[0]
+    bot.user_data_janitor = bot.UserDataJanitor(args.max_users, bot.USER_DATA_TTL, bot.CONVERSATION_TIMEOUT)
+    bot.state_store = bot.SQLiteStore(os.path.join(tempfile.mkdtemp(), "state.db"))
+    application = Application.builder().token("123:BENCH").build()
+
+    started = time.perf_counter()
+    next_sweep = clock[0] + bot.USER_DATA_SWEEP_INTERVAL
+    for first in range(1, args.users + 1, BATCH):
+        asyncio.run(send(application, range(first, min(first + BATCH, args.users + 1))))
+        clock[0] += BATCH * args.arrival_seconds
+        if clock[0] >= next_sweep:
+            bot.user_data_janitor.evict(application)
+            next_sweep = clock[0] + bot.USER_DATA_SWEEP_INTERVAL
+
+        seen = min(first + BATCH - 1, args.users)
+        if seen % args.report_every < BATCH:
+            print(f"{seen:>9} users: RSS {bot.resident_memory_kb() / 1024:6.1f} MB, "
+                  f"user_data {len(application.user_data)}, tracked {len(bot.user_data_janitor.last_seen)}, "
+                  f"evicted {bot.user_data_janitor.evicted}, {time.perf_counter() - started:.0f} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""Discrete-event simulation of the barbershop queue for capacity planning.
+
+Customer arrivals and service times, synthetic or fitted from the booking
+history, are replayed through the bot's own queue logic: per-barber queues
+where the customer in the chair stays at the head until done, wait
+estimates from estimate_waits and warnings when the estimate drops to
+NOTIFICATION_LEADS minutes. Customers leave for the shop on their first
+warning, as the message asks them to, or right after booking if the wait
+shown is shorter than their trip. They lose their turn if they aren't there
+GRACE_MINUTES after being called while others are waiting.
+
+    python simulate.py --days 2000 --barbers 1 2 3 --policy min:10,20 min:15,30 pos:1,2
+    python simulate.py --fit --scale 1.5 --barbers 2 3
+"""
+import argparse
+import heapq
+import math
+import random
+import time
+from collections import Counter
+
+from barbershop_bot import (
+    ANALYTICS_CHUNK_ROWS, CLOSING_MINUTE, GOOGLE_CREDS_JSON, MINUTES_PER_CUSTOMER, NOTIFICATION_LEADS,
+    OPENING_MINUTE, TURN_EXPIRY_MINUTES, _timestamp_minutes, estimate_waits, iter_history_chunks,
+)
+
+# Minutes a called customer has to show up while others wait; with turn
+# expiry off the admin skips them by hand, assumed to take this long
+GRACE_MINUTES = TURN_EXPIRY_MINUTES or 15
+
+# Longest gap between a booking (or the previous customer) and "Done" that
+# is still counted as one service when fitting the history
+MAX_FITTED_SERVICE = 90
+
+def fit_history(chunks):
+    """Fit bookings per hour of day, service times and the no-show share from booking rows."""
+    bookings = Counter()   # hour of day -> bookings
+    days = set()
+    served = {}            # (barber, day) -> [(done minute, booked minute)]
+    done = no_shows = 0
+    for chunk in chunks:
+        for row in chunk:
+            booked = _timestamp_minutes(row[4])
+            if booked is None:
+                continue
+            days.add(row[4][:10])
+            bookings[booked // 60 % 24] += 1
+            if row[5] == "No-show":
+                no_shows += 1
+            elif row[5] == "Done":
+                done += 1
+                finished = _timestamp_minutes(row[7]) if len(row) > 7 else None
+                if finished is not None:
+                    served.setdefault((row[3], row[4][:10]), []).append((finished, booked))
+
+    # A service starts when the customer booked or the previous one was done,
+    # whichever is later
+    service_times = []
+    for finished_booked in served.values():
+        previous = None
+        for finished, booked in sorted(finished_booked):
+            start = booked if previous is None else max(booked, previous)
+            if 0 < finished - start <= MAX_FITTED_SERVICE:
+                service_times.append(finished - start)
+            previous = finished
+
+    return {
+        "hourly_arrivals": {hour: count / len(days) for hour, count in bookings.items()} if days else {},
+        "service_times": service_times,
+        "no_show": no_shows / (done + no_shows) if done + no_shows else 0.0,
+    }
+
+def parse_policy(spec: str):
+    """Parse "min:10,20" (warn when the estimated wait drops to these many
+    minutes, as the bot does) or "pos:1,2" (warn at these queue positions)."""
+    kind, _, values = spec.partition(":")
+    if kind not in ("pos", "min") or not values:
+        raise argparse.ArgumentTypeError(f"invalid policy {spec!r}, expected min:10,20 or pos:1,2")
+    return kind, tuple(sorted(int(value) for value in values.split(",")))
+
+def percentile(values, q: float):
+    """q-th percentile of a sorted list, or None if it is empty."""
+    return values[min(len(values) - 1, int(len(values) * q))] if values else None
+
+class Customer:
+    __slots__ = ("row", "booked", "travel", "never_shows", "departed", "called", "warned", "warnings")
+
+    def __init__(self, barber: str, booked: float, travel: float, never_shows: bool):
+        # Same columns as the sheet, as estimate_waits expects
+        self.row = ["", "", "", barber, "", "Waiting", "", "", ""]
+        self.booked = booked
+        self.travel = travel
+        self.never_shows = never_shows
+        self.departed = None
+        self.called = None
+        self.warned = set()
+        self.warnings = []     # (minute sent, minutes promised)
+
+    @property
+    def arrives(self):
+        return self.departed + self.travel
+
+class Simulation:
+    """Simulates days at the shop and collects waits, notification errors and no-shows."""
+    def __init__(self, barbers: int, policy, hourly_arrivals, service_times=None,
+                 service_mean: float = MINUTES_PER_CUSTOMER, service_sd: float = 3.0,
+                 no_show: float = 0.05, travel=(5, 20), grace: float = GRACE_MINUTES, seed: int = 0):
+        self.barbers = [f"barber_{i + 1}" for i in range(barbers)]
+        self.policy, self.warn_at = policy
+        self.hourly_arrivals = hourly_arrivals
+        self.service_times = service_times
+        sigma2 = math.log(1 + (service_sd / service_mean) ** 2)
+        self.service_mu, self.service_sigma = math.log(service_mean) - sigma2 / 2, math.sqrt(sigma2)
+        self.no_show = no_show
+        self.travel = travel
+        self.grace = grace
+        self.rng = random.Random(seed)
+
+        self.days = 0
+        self.waits = []            # booking until the barber starts
+        self.shop_waits = []       # arrival at the shop until the barber starts
+        self.warning_errors = []   # actual minus promised minutes until called
+        self.served = 0
+        self.never_came = 0
+        self.late = 0
+        self.idle = 0.0            # barber minutes spent waiting for called customers
+        self.overtime = 0.0
+
+    def service_time(self) -> float:
+        if self.service_times:
+            return self.rng.choice(self.service_times)
+        return self.rng.lognormvariate(self.service_mu, self.service_sigma)
+
+    def arrivals(self, day_start: float):
+        """Booking times of one day, a Poisson process with hourly rates."""
+        times = []
+        for hour, rate in self.hourly_arrivals.items():
+            if rate <= 0:
+                continue
+            t = self.rng.expovariate(rate / 60)
+            while t < 60:
+                times.append(day_start + hour * 60 + t)
+                t += self.rng.expovariate(rate / 60)
+        return sorted(times)
+
+    def warn(self, customer: Customer, key, promised: float, now: float):
+        if key in customer.warned:
+            return
+        customer.warned.add(key)
+        customer.warnings.append((now, promised))
+        if customer.departed is None:
+            customer.departed = now
+
+    def send_warnings(self, queue, now: float):
+        """Send the warnings the policy calls for after a queue changed."""
+        if self.policy == "pos":
+            for position in self.warn_at:
+                if 0 < position < len(queue):
+                    self.warn(queue[position], position, position * MINUTES_PER_CUSTOMER, now)
+            return
+        # Like the bot's ticket timers, only the closest due warning is sent
+        waits = estimate_waits([customer.row for customer in queue], int(now))
+        for customer, wait in zip(queue[1:], waits[1:]):
+            lead = next((lead for lead in self.warn_at if wait <= lead), None)
+            if lead is not None and not any(sent <= lead for sent in customer.warned):
+                customer.warned.update(sent for sent in self.warn_at if sent >= lead)
+                customer.warnings.append((now, wait))
+                if customer.departed is None:
+                    customer.departed = now
+
+    def call(self, events, index: int, queue, now: float):
+        """Call the head of a barber's queue and schedule when the barber is free again."""
+        customer = queue[0]
+        customer.called = now
+        if customer.departed is None:
+            customer.departed = now
+        # With nobody else waiting the barber waits for the customer
+        if not customer.never_shows and (len(queue) == 1 or customer.arrives <= now + self.grace):
+            start = max(now, customer.arrives)
+            self.idle += start - now
+            self.waits.append(start - customer.booked)
+            self.shop_waits.append(max(0.0, start - customer.arrives))
+            self.served += 1
+            heapq.heappush(events, (start + self.service_time(), index))
+        else:
+            self.idle += self.grace
+            if customer.never_shows:
+                self.never_came += 1
+            else:
+                self.late += 1
+            heapq.heappush(events, (now + self.grace, index))
+        self.warning_errors.extend(now - sent - promised for sent, promised in customer.warnings)
+
+    def run_day(self):
+        day_start = self.days * 24 * 60
+        self.days += 1
+        queues = [[] for _ in self.barbers]
+        events = []    # (minute the barber is free again, barber index)
+        last_free = day_start + CLOSING_MINUTE
+
+        for booked in self.arrivals(day_start):
+            # Serve everyone who is done before this booking comes in
+            while events and events[0][0] <= booked:
+                self.advance(events, queues)
+            index = min(range(len(queues)), key=lambda i: (len(queues[i]), self.rng.random()))
+            queue = queues[index]
+            customer = Customer(self.barbers[index], booked, self.rng.uniform(*self.travel), self.rng.random() < self.no_show)
+            queue.append(customer)
+            # The bot shows the estimated wait right after booking
+            if estimate_waits([c.row for c in queue], int(booked))[-1] <= customer.travel:
+                customer.departed = booked
+            self.send_warnings(queue, booked)
+            if len(queue) == 1:
+                self.call(events, index, queue, booked)
+
+        while events:
+            last_free = max(last_free, self.advance(events, queues))
+        self.overtime += max(0.0, last_free - day_start - CLOSING_MINUTE)
+
+    def advance(self, events, queues) -> float:
+        """The next barber finishes (or gives up on a customer) and calls the next one."""
+        now, index = heapq.heappop(events)
+        queue = queues[index]
+        queue.pop(0)
+        if queue:
+            self.send_warnings(queue, now)
+            self.call(events, index, queue, now)
+        return now
+
+    def run(self, days: int):
+        for _ in range(days):
+            self.run_day()
+        return self.summary()
+
+    def summary(self):
+        waits, shop_waits = sorted(self.waits), sorted(self.shop_waits)
+        errors = sorted(abs(error) for error in self.warning_errors)
+        called = self.served + self.never_came + self.late
+        return {
+            "served_per_day": self.served / self.days,
+            "wait_p50": percentile(waits, 0.5),
+            "wait_p90": percentile(waits, 0.9),
+            "shop_wait_p50": percentile(shop_waits, 0.5),
+            "shop_wait_p90": percentile(shop_waits, 0.9),
+            "never_came_rate": self.never_came / called if called else 0.0,
+            "late_rate": self.late / called if called else 0.0,
+            "idle_per_day": self.idle / self.days,
+            "overtime_per_day": self.overtime / self.days,
+            "warning_error_mean": sum(errors) / len(errors) if errors else None,
+            "warning_error_p90": percentile(errors, 0.9),
+        }
+
+def format_minutes(value) -> str:
+    return "-" if value is None else f"{value:.0f}"
+
+def main():
+    default_policy = "min:" + ",".join(str(lead) for lead in sorted(NOTIFICATION_LEADS.values()))
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--days", type=int, default=1000, help="simulated days per scenario")
+    parser.add_argument("--barbers", type=int, nargs="+", default=[2], help="rosters to compare")
+    parser.add_argument("--policy", type=parse_policy, nargs="+", default=[parse_policy(default_policy)],
+                        help=f"notification settings to compare (default {default_policy})")
+    parser.add_argument("--arrivals-per-hour", type=float, default=6.0, help="synthetic bookings per opening hour")
+    parser.add_argument("--service-mean", type=float, default=MINUTES_PER_CUSTOMER)
+    parser.add_argument("--service-sd", type=float, default=3.0)
+    parser.add_argument("--no-show", type=float, default=0.05, help="share of customers who never come")
+    parser.add_argument("--travel", type=float, nargs=2, default=(5, 20), metavar=("MIN", "MAX"),
+                        help="minutes customers need to get to the shop")
+    parser.add_argument("--grace", type=float, default=GRACE_MINUTES,
+                        help="minutes a called customer has to show up while others wait")
+    parser.add_argument("--fit", action="store_true", help="fit arrivals, service times and no-shows from the booking history")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the arrival rates, e.g. 1.2 for 20%% more customers")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    hourly_arrivals = {hour: args.arrivals_per_hour for hour in range(OPENING_MINUTE // 60, -(-CLOSING_MINUTE // 60))}
+    service_times, no_show = None, args.no_show
+    if args.fit:
+        fitted = fit_history(iter_history_chunks(ANALYTICS_CHUNK_ROWS, include_sheet=bool(GOOGLE_CREDS_JSON)))
+        if not fitted["hourly_arrivals"]:
+            parser.error("no booking history found; set HISTORY_DIR or GOOGLE_CREDENTIALS")
+        hourly_arrivals = fitted["hourly_arrivals"]
+        service_times = fitted["service_times"] or None
+        no_show = fitted["no_show"]
+        print(f"Fitted {sum(hourly_arrivals.values()):.1f} bookings/day, "
+              f"{len(fitted['service_times'])} service times, {no_show:.1%} no-shows")
+    hourly_arrivals = {hour: rate * args.scale for hour, rate in hourly_arrivals.items()}
+
+    print(f"{'barbers':>7} {'policy':>12} {'served/day':>10} {'wait p50/p90':>13} {'in shop p50/p90':>16} "
+          f"{'no-show':>8} {'late':>6} {'idle/day':>9} {'overtime':>9} {'warn err avg/p90':>17}")
+    for barbers in args.barbers:
+        for policy in args.policy:
+            started = time.perf_counter()
+            simulation = Simulation(
+                barbers, policy, hourly_arrivals, service_times, args.service_mean, args.service_sd,
+                no_show, args.travel, args.grace, args.seed,
+            )
+            result = simulation.run(args.days)
+            label = f"{policy[0]}:{','.join(map(str, policy[1]))}"
+            print(f"{barbers:>7} {label:>12} {result['served_per_day']:>10.1f} "
+                  f"{format_minutes(result['wait_p50']) + '/' + format_minutes(result['wait_p90']):>13} "
+                  f"{format_minutes(result['shop_wait_p50']) + '/' + format_minutes(result['shop_wait_p90']):>16} "
+                  f"{result['never_came_rate']:>8.1%} {result['late_rate']:>6.1%} "
+                  f"{result['idle_per_day']:>9.0f} {result['overtime_per_day']:>9.0f} "
+                  f"{format_minutes(result['warning_error_mean']) + '/' + format_minutes(result['warning_error_p90']):>17}"
+                  f"  ({time.perf_counter() - started:.1f}s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import barbershop_bot as bot
+
+HEADER = ["User ID", "Name", "Phone", "Barber", "Time", "Status", "Ticket Number", "Done Time"]
+
+
+class FakeSheet:
+    """In-memory stand-in for the gspread worksheet calls the bot makes."""
+    id = 0
+
+    def __init__(self, rows=()):
+        self.rows = [list(HEADER)] + [list(row) for row in rows]
+        self.spreadsheet = self
+        self.before_locate = None  # called once before the ticket column is read
+
+    def get_all_values(self):
+        return [list(row) for row in self.rows]
+
+    def col_values(self, col):
+        if self.before_locate:
+            hook, self.before_locate = self.before_locate, None
+            hook()
+        return [row[col - 1] if len(row) >= col else "" for row in self.rows]
+
+    def append_rows(self, rows, **kwargs):
+        self.rows.extend(list(row) for row in rows)
+
+    def batch_update(self, data, **kwargs):
+        if isinstance(data, dict):
+            # Row deletions, sent bottom-up
+            for request in data["requests"]:
+                span = request["deleteDimension"]["range"]
+                del self.rows[span["startIndex"]:span["endIndex"]]
+            return
+        for item in data:
+            index = int(item["range"].lstrip("A")) - 1
+            self.rows[index] = list(item["values"][0])
+
+    def get(self, cells, **kwargs):
+        first, last = (int(cell.lstrip("AH")) for cell in cells.split(":"))
+        return [list(row) for row in self.rows[first - 1:last]]
+
+    def tickets(self):
+        return [row[6] for row in self.rows[1:]]
+
+
+class Clock:
+    """Stand-in for time.monotonic that only moves when told to."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, data=None, name=None):
+        job = types.SimpleNamespace(callback=callback, when=when, data=data, name=name, removed=False)
+        job.schedule_removal = lambda: setattr(job, "removed", True)
+        self.jobs.append(job)
+        return job
+
+    def pending(self):
+        return {job.name for job in self.jobs if not job.removed}
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+        self.edits = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.edits.append((chat_id, text))
+
+
+class FakeMessage:
+    def __init__(self, chat_id, text=""):
+        self.chat_id = chat_id
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        self.replies.append((text, reply_markup))
+
+
+class FakeQuery:
+    def __init__(self, data, user_id):
+        self.data = data
+        self.from_user = types.SimpleNamespace(id=user_id)
+        self.message = types.SimpleNamespace(chat_id=user_id, message_id=1)
+        self.answers = []
+        self.edits = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+    async def edit_message_text(self, text, reply_markup=None, **kwargs):
+        self.edits.append((text, reply_markup))
+
+    async def edit_message_reply_markup(self, reply_markup=None, **kwargs):
+        self.edits.append((None, reply_markup))
+
+
+def callback_update(data, user_id=1):
+    chat = types.SimpleNamespace(id=user_id)
+    return types.SimpleNamespace(callback_query=FakeQuery(data, user_id), message=None,
+                                 effective_chat=chat, effective_user=chat)
+
+
+def make_context(user_data=None):
+    # Background sheet replays are left out; tests replay the outbox themselves
+    application = types.SimpleNamespace(create_task=lambda coro: coro.close())
+    return types.SimpleNamespace(user_data=user_data if user_data is not None else {}, bot=FakeBot(),
+                                 job_queue=FakeJobQueue(), application=application, job=None)
+
+
+def booking(ticket, barber="حلاق 1", status="Waiting", time="2026-10-19 09:00", user=None, slot=None):
+    row = [user or str(100 + int(ticket)), f"C{ticket}", "0600000000", barber, time, status, str(ticket), ""]
+    return row + [slot] if slot else row
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def sheet(monkeypatch):
+    fake = FakeSheet()
+    service = bot.SheetsService()
+    service._sheet = fake
+    monkeypatch.setattr(bot, "sheets_service", service)
+    return fake
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    state_store = bot.SQLiteStore(str(tmp_path / "state.db"))
+    monkeypatch.setattr(bot, "state_store", state_store)
+    monkeypatch.setattr(bot.notification_service, "store", state_store)
+    return state_store
+
+
+@pytest.fixture
+def outbox(tmp_path, monkeypatch):
+    log = bot.Outbox(str(tmp_path / "outbox.log"), 0)
+    log.open()
+    monkeypatch.setattr(bot, "outbox", log)
+    return log
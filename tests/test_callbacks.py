@@ -0,0 +1,81 @@
+import asyncio
+import base64
+
+import pytest
+
+import barbershop_bot as bot
+from conftest import callback_update, make_context
+
+ACTIONS = sorted(value for name, value in vars(bot).items() if name.startswith("CB_"))
+# Buttons of the booking conversation are matched by the conversation handler
+CONVERSATION_ACTIONS = {bot.CB_BARBER, bot.CB_MODE_WALKIN, bot.CB_MODE_SLOT, bot.CB_SLOT, bot.CB_SLOT_AFTER}
+
+
+def pack(payload: bytes) -> str:
+    return base64.urlsafe_b64encode(payload).rstrip(b"=").decode()
+
+
+def unpack(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+@pytest.mark.parametrize("action", ACTIONS)
+def test_every_action_round_trips(action):
+    barber = next(iter(bot.BARBERS))
+    data = bot.encode_callback(action, barber, 2 ** 32 - 1, 65535)
+    assert len(data) <= 24
+    assert bot.decode_callback(data) == bot.CallbackData(action, barber, 2 ** 32 - 1, 65535)
+    assert bot.decode_callback(bot.encode_callback(action)) == bot.CallbackData(action, None, 0, 0)
+
+
+def test_bad_signature_is_rejected():
+    raw = bytearray(unpack(bot.encode_callback(bot.CB_DELETE, number=12)))
+    raw[-1] ^= 1
+    assert bot.decode_callback(pack(bytes(raw))) is None
+
+    # Changing the ticket of a signed button breaks its signature
+    raw = bytearray(unpack(bot.encode_callback(bot.CB_DELETE, number=12)))
+    raw[bot.CALLBACK_STRUCT.size - 3] ^= 1
+    assert bot.decode_callback(pack(bytes(raw))) is None
+
+    unsigned = unpack(bot.encode_callback(bot.CB_DELETE, number=12))[:bot.CALLBACK_STRUCT.size]
+    assert bot.decode_callback(pack(unsigned)) is None
+
+
+def test_signature_on_an_unsigned_action_is_rejected():
+    payload = unpack(bot.encode_callback(bot.CB_QUEUE_VIEW))
+    assert bot.decode_callback(pack(payload + bot.callback_signature(payload))) is None
+
+
+@pytest.mark.parametrize("version, shop", [(bot.CALLBACK_VERSION + 1, bot.SHOP_ID), (bot.CALLBACK_VERSION, bot.SHOP_ID + 1)])
+def test_other_version_or_shop_is_rejected(version, shop):
+    payload = bot.CALLBACK_STRUCT.pack(version, bot.CB_DELETE, shop, 0, 12, 0)
+    assert bot.decode_callback(pack(payload + bot.callback_signature(payload))) is None
+
+
+@pytest.mark.parametrize("data", ["delete_12", "status_12", "queue_حلاق 1", "", "AAAA"])
+def test_old_and_malformed_data_is_rejected(data):
+    assert bot.decode_callback(data) is None
+
+
+def test_every_button_outside_the_conversation_has_a_handler():
+    assert set(bot.CALLBACK_HANDLERS) == set(ACTIONS) - CONVERSATION_ACTIONS
+
+
+def test_forged_button_is_answered_as_stale(monkeypatch):
+    calls = []
+
+    async def handler(update, context):
+        calls.append(update.callback_query.data)
+    monkeypatch.setitem(bot.CALLBACK_HANDLERS, bot.CB_DELETE, handler)
+
+    raw = bytearray(unpack(bot.encode_callback(bot.CB_DELETE, number=12)))
+    raw[-1] ^= 1
+    forged = callback_update(pack(bytes(raw)))
+    asyncio.run(bot.dispatch_callback(forged, make_context()))
+    assert calls == []
+    assert forged.callback_query.answers == ["⌛ هاد الزر قديم، عاود من الأول."]
+
+    genuine = callback_update(bot.encode_callback(bot.CB_DELETE, number=12))
+    asyncio.run(bot.dispatch_callback(genuine, make_context()))
+    assert calls == [genuine.callback_query.data]
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+from telegram.error import BadRequest
+
+import barbershop_bot as bot
+from conftest import booking, make_context
+
+BARBER = "حلاق 1"
+
+
+@pytest.fixture
+def live(sheet, clock, monkeypatch):
+    monkeypatch.setattr(bot, "metrics", bot.Metrics())
+    sheet.rows += [booking(t, user=str(t)) for t in range(1, 5)]
+    return bot.LiveQueue(debounce=3, min_interval=10, edits_per_flush=2, max_subscribers=3)
+
+
+def follow(live, *tickets, text="old"):
+    for ticket in tickets:
+        live.subscribe(ticket, booking(ticket, user=str(ticket)), 50 + ticket, text)
+
+
+def flush(live, context):
+    asyncio.run(live.flush(context))
+    return [chat_id for chat_id, _ in context.bot.edits]
+
+
+def test_changes_are_debounced(live):
+    context = make_context()
+    live.mark_changed(context.job_queue)
+    assert context.job_queue.jobs == []     # nobody follows the queue
+
+    follow(live, 1)
+    live.mark_changed(context.job_queue)
+    live.mark_changed(context.job_queue, [BARBER])
+    (job,) = context.job_queue.jobs
+    assert job.when == 3
+
+
+def test_unchanged_text_is_not_edited(live, clock):
+    context = make_context()
+    queue = bot.build_queue_index(bot.sheets_service.get_cached_bookings()[1:])[BARBER]
+    live.subscribe(2, queue[1], 52, bot.render_live_message(queue[1], queue))
+    clock.now += 10
+    live.mark_changed(context.job_queue)
+    assert flush(live, context) == []
+
+
+def test_recently_edited_message_is_retried_later(live, clock):
+    context = make_context()
+    follow(live, 1)
+    live.mark_changed(context.job_queue)
+    clock.now += 3
+    assert flush(live, context) == []
+    assert bot.metrics.values["live_queue.deferred_edits"] == 1
+    retry = context.job_queue.jobs[-1]
+    assert live.flush_job is retry and retry.when == 10
+
+    clock.now += 10
+    assert flush(live, context) == [1]
+    assert live.changed == set()
+
+
+def test_edits_per_flush_are_capped(live, clock):
+    context = make_context()
+    follow(live, 1, 2, 3)
+    clock.now += 10
+    live.mark_changed(context.job_queue)
+    assert flush(live, context) == [1, 2]
+    assert live.flush_job is not None
+
+    clock.now += 10
+    assert flush(live, context) == [1, 2, 3]
+    assert bot.metrics.values["live_queue.edits"] == 3
+
+
+@pytest.mark.parametrize("status", ["Done", None])
+def test_done_or_deleted_ticket_is_unfollowed(live, sheet, clock, status):
+    context = make_context()
+    follow(live, 1, 2)
+    if status:
+        sheet.rows[1][5] = status
+    else:
+        del sheet.rows[1]
+    bot.sheets_service.get_all_bookings()
+    clock.now += 10
+    live.mark_changed(context.job_queue)
+    flush(live, context)
+    assert list(live.subscribers) == [2]
+    assert context.bot.edits[0] == (1, "ℹ️ تيكيتك 1 ما بقاش في لاشان.")
+
+
+def test_failed_edit_unfollows(live, clock):
+    context = make_context()
+
+    async def deleted_message(text, chat_id=None, **kwargs):
+        raise BadRequest("Message to edit not found")
+    context.bot.edit_message_text = deleted_message
+    follow(live, 1)
+    clock.now += 10
+    live.mark_changed(context.job_queue)
+    asyncio.run(live.flush(context))
+    assert live.subscribers == {}
+
+
+def test_oldest_subscriber_is_dropped_at_the_cap(live):
+    follow(live, 1, 2, 3)
+    follow(live, 1)                         # following again moves it to the end
+    follow(live, 4)
+    assert list(live.subscribers) == [3, 1, 4]
+    assert bot.metrics.values["live_queue.subscribers"] == 3
@@ -0,0 +1,96 @@
+import asyncio
+
+import barbershop_bot as bot
+from conftest import booking
+
+
+def append_all(outbox, records):
+    async def run():
+        for record in records:
+            await outbox.append(record)
+    asyncio.run(run())
+
+
+def reopen(outbox):
+    """Open the log again as a restarted process would, after a crash released its lock."""
+    outbox.file.close()
+    recovered = bot.Outbox(outbox.path, 0)
+    recovered.open()
+    return recovered
+
+
+def test_records_logged_before_a_crash_reach_the_sheet_once(sheet, outbox):
+    append_all(outbox, [{"op": "book", "row": booking(t)} for t in (1, 2, 3)])
+
+    recovered = reopen(outbox)
+    assert len(recovered.pending) == 3
+    assert asyncio.run(recovered.replay(bot.sheets_service)) == 3
+    assert sheet.tickets() == ["1", "2", "3"]
+
+    # Nothing is left to replay after the next restart
+    assert reopen(recovered).pending == []
+
+
+def test_crash_between_sheet_write_and_checkpoint_does_not_duplicate(sheet, outbox):
+    records = [
+        {"op": "book", "row": booking(1)},
+        {"op": "book", "row": booking(2)},
+        {"op": "status", "tickets": ["1"], "status": "Done", "time": "2026-10-19 09:20"},
+    ]
+    append_all(outbox, records)
+    # The sheet took the records, then the process died before the checkpoint
+    bot.sheets_service.apply_records(records)
+
+    recovered = reopen(outbox)
+    assert len(recovered.pending) == 3
+    asyncio.run(recovered.replay(bot.sheets_service))
+    assert sheet.tickets() == ["1", "2"]
+    assert [row[5] for row in sheet.rows[1:]] == ["Done", "Waiting"]
+
+
+def test_torn_last_record_is_dropped(sheet, outbox):
+    append_all(outbox, [{"op": "book", "row": booking(1)}])
+    outbox.file.write(b'{"op": "book", "row": ["1')
+    outbox.file.flush()
+
+    recovered = reopen(outbox)
+    assert recovered.pending_records() == [{"op": "book", "row": booking(1)}]
+    append_all(recovered, [{"op": "book", "row": booking(2)}])
+    assert [record["row"][6] for record in reopen(recovered).pending_records()] == ["1", "2"]
+
+
+def test_tickets_are_not_reused_after_a_restart(outbox, store):
+    append_all(outbox, [{"op": "book", "row": booking(7)}])
+    assert reopen(outbox).allocate_ticket(store, 0) == 8
+
+
+def test_rows_moved_before_the_write_are_located_by_ticket(sheet):
+    sheet.rows += [booking(1), booking(2), booking(3)]
+    # Someone inserts a row at the top while the replay is computing
+    sheet.before_locate = lambda: sheet.rows.insert(1, booking(9))
+
+    bot.sheets_service.apply_records([
+        {"op": "status", "tickets": ["2"], "status": "Done"},
+        {"op": "delete", "tickets": ["3"]},
+    ])
+    assert sheet.tickets() == ["9", "1", "2"]
+    assert {row[6]: row[5] for row in sheet.rows[1:]} == {"9": "Waiting", "1": "Waiting", "2": "Done"}
+
+
+def test_read_finishing_after_a_replay_does_not_drop_its_rows(sheet, outbox):
+    sheet.rows += [booking(1)]
+    service = bot.sheets_service
+    read = sheet.get_all_values
+    calls = []
+
+    def slow_read():
+        values = read()
+        calls.append(1)
+        if len(calls) == 2:
+            # The replay finishes while this read is still in flight
+            service.apply_records([{"op": "book", "row": booking(2)}])
+        return values
+    sheet.get_all_values = slow_read
+
+    service.get_all_bookings()
+    assert [row[6] for row in service.get_cached_bookings()[1:]] == ["1", "2"]
@@ -0,0 +1,50 @@
+import asyncio
+import types
+
+import barbershop_bot as bot
+from conftest import FakeMessage, booking, callback_update, make_context
+
+
+def test_pages_are_measured_in_utf16_units():
+    # Each emoji is two UTF-16 units, so only two 5-emoji lines fit in 22
+    lines = ["😀" * 5] * 3
+    assert bot.message_length(lines[0]) == 10
+    assert list(bot.iter_pages(lines, 22)) == ["😀" * 5 + "\n" + "😀" * 5, "😀" * 5]
+
+
+def test_over_long_line_is_cut_to_fit():
+    pages = list(bot.iter_pages(["a", "😀" * 100, "b"], 50))
+    assert all(bot.message_length(page) <= 50 for page in pages)
+    assert pages[1].endswith("…")
+    assert pages[-1] == "b"
+
+
+def test_page_past_the_end():
+    lines = [f"line {i}" for i in range(10)]
+    assert bot.get_page(lines, 0, 30) == ("line 0\nline 1\nline 2\nline 3", True)
+    assert bot.get_page(lines, 2, 30) == ("line 8\nline 9", False)
+    assert bot.get_page(lines, 3, 30) == (None, False)
+    assert bot.get_page([], 0) == (None, False)
+
+
+def test_long_wait_list_is_paged(sheet):
+    barbers = list(bot.BARBERS.values())
+    sheet.rows += [booking(t, barber=barbers[t % 2], user=str(t)) for t in range(1, 151)]
+    message = FakeMessage(7, bot.BTN_CHECK_WAIT)
+    chat = types.SimpleNamespace(id=7)
+    update = types.SimpleNamespace(message=message, callback_query=None, effective_chat=chat, effective_user=chat)
+
+    asyncio.run(bot.estimated_wait_time.__wrapped__(update, make_context()))
+    (text, reply_markup), = message.replies
+    assert bot.message_length(text) <= bot.PAGE_LENGTH
+    assert text.startswith("⏳ وقت الانتظار:")
+    (next_button,), follow_row = reply_markup.inline_keyboard
+    assert list(follow_row) == bot.FOLLOW_KEYBOARD[0]
+    assert bot.decode_callback(next_button.callback_data) == bot.CallbackData(bot.CB_PAGE_WAIT, None, 0, 1)
+
+    # The next page carries on with the rest of the list
+    page_update = callback_update(next_button.callback_data, user_id=7)
+    asyncio.run(bot.handle_page.__wrapped__(page_update, make_context()))
+    (text, _), = page_update.callback_query.edits
+    assert bot.message_length(text) <= bot.PAGE_LENGTH
+    assert "⏳ وقت الانتظار:" not in text
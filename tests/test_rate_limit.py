@@ -0,0 +1,134 @@
+import asyncio
+import types
+
+import pytest
+from telegram.error import BadRequest
+
+import barbershop_bot as bot
+from conftest import FakeMessage, FakeQuery, callback_update, make_context
+
+BUSY = "⏳ بالشوية عليك، عاود من بعد شوية."
+
+
+@pytest.fixture
+def limits(monkeypatch, clock):
+    monkeypatch.setattr(bot, "rate_limiter", bot.RateLimiter(0.1, 1, 100))
+    monkeypatch.setattr(bot, "response_cache", bot.ResponseCache(60, 100))
+    monkeypatch.setattr(bot, "metrics", bot.Metrics())
+    return clock
+
+
+@bot.rate_limited
+async def view(update, context):
+    """Render a view and remember it, like the rate-limited handlers do."""
+    context.calls.append(update.effective_chat.id)
+    text, reply_markup = f"view {len(context.calls)}", bot.InlineKeyboardMarkup([])
+    bot.response_cache.put(update, text, reply_markup)
+    if update.callback_query:
+        await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(text, reply_markup=reply_markup)
+
+
+def message_update(chat_id=1, text=bot.BTN_VIEW_QUEUE):
+    chat = types.SimpleNamespace(id=chat_id)
+    return types.SimpleNamespace(message=FakeMessage(chat_id, text), callback_query=None,
+                                 effective_chat=chat, effective_user=chat)
+
+
+def run(update, context):
+    asyncio.run(view(update, context))
+
+
+@pytest.fixture
+def context():
+    context = make_context()
+    context.calls = []
+    return context
+
+
+def test_burst_then_refill(clock):
+    limiter = bot.RateLimiter(0.5, 3, 100)
+    assert [limiter.allow(1) for _ in range(4)] == [True, True, True, False]
+    clock.now += 1
+    assert not limiter.allow(1)      # half a token so far
+    clock.now += 1
+    assert limiter.allow(1)
+    clock.now += 100
+    assert [limiter.allow(1) for _ in range(4)] == [True, True, True, False]   # never above the burst
+    assert limiter.allow(2)          # other chats have their own bucket
+
+
+def test_oldest_bucket_is_dropped_at_max_chats(clock):
+    limiter = bot.RateLimiter(0.1, 1, 3)
+    for chat_id in (1, 2, 3):
+        limiter.allow(chat_id)
+    limiter.allow(1)                 # 1 is now the most recently used
+    limiter.allow(4)
+    assert list(limiter.buckets) == [3, 1, 4]
+    # A dropped chat starts over with a full bucket
+    assert limiter.allow(2)
+
+
+def test_limited_message_is_answered_from_the_cache(limits, context):
+    run(message_update(), context)
+    limited = message_update()
+    run(limited, context)
+    assert context.calls == [1]
+    assert [text for text, _ in limited.message.replies] == ["view 1"]
+
+    # The cached answer expires after the cache's ttl
+    limits.now += 61
+    bot.rate_limiter.buckets[1] = (0, limits.now)
+    limited = message_update()
+    run(limited, context)
+    assert [text for text, _ in limited.message.replies] == [BUSY]
+
+
+def test_limited_message_without_a_cached_answer(limits, context):
+    run(message_update(text="/start"), context)
+    limited = message_update(text=bot.BTN_CHECK_WAIT)
+    run(limited, context)
+    assert context.calls == [1]
+    assert limited.message.replies == [(BUSY, None)]
+
+
+def test_limited_button_is_answered_from_the_cache(limits, context):
+    data = bot.encode_callback(bot.CB_QUEUE_VIEW)
+    run(callback_update(data), context)
+    limited = callback_update(data)
+    run(limited, context)
+    assert context.calls == [1]
+    assert limited.callback_query.answers == [BUSY]
+    assert [text for text, _ in limited.callback_query.edits] == ["view 1"]
+
+
+def test_limited_button_without_a_cached_answer(limits, context):
+    run(callback_update(bot.encode_callback(bot.CB_QUEUE_VIEW)), context)
+    limited = callback_update(bot.encode_callback(bot.CB_QUEUE_VIEW, "barber_1"))
+    run(limited, context)
+    assert limited.callback_query.answers == [BUSY]
+    assert limited.callback_query.edits == []
+
+
+def test_unchanged_cached_answer_is_not_an_error(limits, context):
+    class UnchangedQuery(FakeQuery):
+        async def edit_message_text(self, text, reply_markup=None, **kwargs):
+            raise BadRequest("Message is not modified")
+
+    data = bot.encode_callback(bot.CB_QUEUE_VIEW)
+    run(callback_update(data), context)
+    limited = callback_update(data)
+    limited.callback_query = UnchangedQuery(data, 1)
+    run(limited, context)
+    assert limited.callback_query.answers == [BUSY]
+
+
+def test_metrics_count_allowed_limited_and_cache_hits(limits, context):
+    run(message_update(), context)
+    run(message_update(), context)
+    run(message_update(text="/start"), context)
+    run(message_update(chat_id=2), context)
+    assert {name: value for name, value in bot.metrics.snapshot().items() if name.startswith("rate_limit.")} == {
+        "rate_limit.allowed": 2, "rate_limit.limited": 2, "rate_limit.cache_hits": 1,
+    }
@@ -0,0 +1,33 @@
+import barbershop_bot as bot
+from conftest import booking
+
+TODAY = "2026-10-19"
+
+
+def summary(rows):
+    report = bot.BookingReport(TODAY)
+    report.add_chunk(rows)
+    return report.summary()
+
+
+def test_no_show_today_counts_in_the_rate():
+    assert summary([booking(1, status="No-show", time=f"{TODAY} 09:00")])["no_show_rate"] == 1
+
+
+def test_no_show_rate_over_several_days():
+    rows = [
+        booking(1, status="Done", time="2026-10-18 09:00"),
+        booking(2, status="Waiting", time="2026-10-18 09:10"),   # never served
+        booking(3, status="No-show", time=f"{TODAY} 09:00"),
+        booking(4, status="Done", time=f"{TODAY} 09:10"),
+        booking(5, status="Waiting", time=f"{TODAY} 09:20"),     # still open
+    ]
+    assert summary(rows)["no_show_rate"] == 2 / 4
+
+
+def test_rows_without_a_done_time_column():
+    rows = [booking(1, status="Waiting", time="2026-10-18 09:00")[:7],
+            booking(2, status="No-show", time=f"{TODAY} 09:00")[:7]]
+    result = summary(rows)
+    assert result["no_show_rate"] == 1
+    assert result["average_wait"] is None
@@ -0,0 +1,86 @@
+import asyncio
+
+import barbershop_bot as bot
+from conftest import booking, callback_update, make_context, FakeJobQueue
+
+DAY = 24 * 60
+
+
+def at(minutes):
+    return bot.minutes_to_timestamp(bot.current_minute() + minutes)
+
+
+def slot_day_after_tomorrow():
+    return (bot.current_minute() // DAY + 2) * DAY + bot.OPENING_MINUTE
+
+
+def queue_with_future_slot_first():
+    return [
+        booking(1, time=at(-5), slot=bot.minutes_to_timestamp(slot_day_after_tomorrow())),
+        booking(2, time=at(-1)),
+    ]
+
+
+def test_walk_in_is_served_before_a_later_slot():
+    queue = queue_with_future_slot_first()
+    assert [row[6] for row in bot.serving_order(queue)] == ["2", "1"]
+    assert bot.find_position(queue, "102") == (1, 0)
+    assert bot.find_position(queue, "101")[0] == 2
+
+
+def test_only_the_walk_in_gets_the_turn(sheet, store):
+    job_queue = FakeJobQueue()
+    bot.TicketTimers().sync(job_queue, queue_with_future_slot_first())
+    assert {"ticket_2_turn", "ticket_1_20min", "ticket_1_10min"} == job_queue.pending()
+
+
+def test_next_customer_takes_the_walk_in(sheet, store, outbox):
+    sheet.rows += queue_with_future_slot_first()
+    store.set("admin_sessions", "9", "1", 60)
+    update = callback_update(bot.encode_callback(bot.CB_NEXT_CUSTOMER, "barber_1"), 9)
+
+    asyncio.run(bot.handle_next_customer(update, make_context()))
+    assert outbox.pending_records()[-1]["tickets"] == ["2"]
+
+
+def test_bookable_slots():
+    start = slot_day_after_tomorrow()
+    assert bot.is_bookable_slot(start)
+    assert not bot.is_bookable_slot(start + 1)                                   # off the grid
+    assert not bot.is_bookable_slot(start - bot.SLOT_MINUTES)                    # before opening
+    assert not bot.is_bookable_slot(start - bot.OPENING_MINUTE + bot.CLOSING_MINUTE)  # at closing
+    assert not bot.is_bookable_slot(start - 3 * DAY)                              # in the past
+    assert not bot.is_bookable_slot(start + bot.SLOT_DAYS_AHEAD * DAY)            # too far ahead
+    assert not bot.is_bookable_slot(0)
+
+
+def test_crafted_slot_is_rejected(sheet, store):
+    sheet.rows += [booking(1)]
+    context = make_context({"barber": "حلاق 1"})
+    for start in (0, bot.current_minute() - 600):
+        update = callback_update(bot.encode_callback(bot.CB_SLOT, number=start), 7)
+        assert asyncio.run(bot.handle_slot_selection(update, context)) == bot.SELECTING_SLOT
+        assert "slot" not in context.user_data
+
+    update = callback_update(bot.encode_callback(bot.CB_SLOT, number=slot_day_after_tomorrow()), 7)
+    assert asyncio.run(bot.handle_slot_selection(update, context)) == bot.ENTERING_NAME
+    assert context.user_data["slot"] == bot.minutes_to_timestamp(slot_day_after_tomorrow())
+
+
+def test_slot_index_is_rebuilt_only_after_bookings_change(sheet, store, outbox):
+    first, second = slot_day_after_tomorrow(), slot_day_after_tomorrow() + bot.SLOT_MINUTES
+    sheet.rows += [booking(1, slot=bot.minutes_to_timestamp(first))]
+    service = bot.sheets_service
+
+    index = service.get_slot_index()
+    assert service.get_slot_index() is index
+    assert not bot.claim_slot("حلاق 1", bot.minutes_to_timestamp(first), "2")
+
+    assert bot.claim_slot("حلاق 1", bot.minutes_to_timestamp(second), "2")
+    asyncio.run(outbox.append({"op": "book", "row": booking(2, slot=bot.minutes_to_timestamp(second))}))
+    index = service.get_slot_index()
+    assert index.conflicts("حلاق 1", second)
+
+    asyncio.run(outbox.replay(service))
+    assert service.get_slot_index() is not index
+    assert service.get_slot_index().starts == {"حلاق 1": [first, second]}
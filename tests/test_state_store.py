@@ -0,0 +1,107 @@
+import asyncio
+import threading
+import time
+import types
+
+import pytest
+
+import barbershop_bot as bot
+from conftest import booking
+
+
+def two_instances(tmp_path):
+    """Two stores on one database file, as two bot processes would open it."""
+    path = str(tmp_path / "state.db")
+    return bot.SQLiteStore(path), bot.SQLiteStore(path)
+
+
+def test_only_one_instance_holds_the_jobs_lease(tmp_path):
+    a, b = two_instances(tmp_path)
+    assert a.acquire_lease("jobs", "a", 0.2)
+    assert not b.acquire_lease("jobs", "b", 0.2)
+    assert a.acquire_lease("jobs", "a", 0.2)  # renewal
+
+    time.sleep(0.25)
+    assert b.acquire_lease("jobs", "b", 0.2)
+    assert not a.acquire_lease("jobs", "a", 0.2)
+
+    b.release_lease("jobs", "b")
+    assert a.acquire_lease("jobs", "a", 0.2)
+
+
+def test_leader_only_jobs_run_on_one_instance(tmp_path, monkeypatch):
+    instances = dict(zip("ab", two_instances(tmp_path)))
+    runs = []
+
+    def use(instance_id):
+        monkeypatch.setattr(bot, "state_store", instances[instance_id])
+        monkeypatch.setattr(bot, "INSTANCE_ID", instance_id)
+
+    @bot.leader_only
+    async def job(context):
+        runs.append(bot.INSTANCE_ID)
+
+    for _ in range(3):
+        for instance_id in instances:
+            use(instance_id)
+            asyncio.run(job(types.SimpleNamespace()))
+    assert runs == ["a", "a", "a"]
+
+    # Once the leader shuts down, the other instance runs the next job
+    use("a")
+    asyncio.run(bot.release_job_lease(None))
+    use("b")
+    asyncio.run(job(types.SimpleNamespace()))
+    assert runs[-1] == "b"
+
+
+def test_instances_allocate_distinct_tickets(tmp_path):
+    stores = two_instances(tmp_path)
+    outboxes = [bot.Outbox(str(tmp_path / f"outbox-{i}.log"), 0) for i in range(2)]
+    tickets = [[], []]
+
+    def allocate(i):
+        for _ in range(200):
+            tickets[i].append(outboxes[i].allocate_ticket(stores[i], 10))
+
+    threads = [threading.Thread(target=allocate, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(tickets[0] + tickets[1]) == list(range(11, 411))
+
+
+def test_instances_do_not_share_an_outbox_log(tmp_path):
+    path = str(tmp_path / "outbox.log")
+    a, b = bot.Outbox(path, 0), bot.Outbox(path, 0)
+    a.open()
+    with pytest.raises(RuntimeError):
+        b.open()
+
+    async def book(ticket):
+        await a.append({"op": "book", "row": booking(ticket)})
+    asyncio.run(book(1))
+
+    # Once the first instance exits, the next one recovers its records
+    a.file.close()
+    b.open()
+    assert b.pending_records() == [{"op": "book", "row": booking(1)}]
+
+
+def test_a_notification_is_claimed_by_one_instance(tmp_path):
+    a, b = (bot.NotificationService(store) for store in two_instances(tmp_path))
+    assert a.claim_notification("42", "turn-7", 60)
+    assert not b.claim_notification("42", "turn-7", 60)
+    assert b.claim_notification("42", "10min-7", 60)
+
+
+def test_sessions_are_shared_and_expired_keys_purged(tmp_path):
+    a, b = two_instances(tmp_path)
+    a.set("admin_sessions", "9", "1", 60)
+    a.set("checkins", "7", "1", 0.05)
+    assert b.get("admin_sessions", "9") == "1"
+
+    time.sleep(0.1)
+    b.purge_expired()
+    assert a.db.execute("SELECT namespace, key FROM kv").fetchall() == [("admin_sessions", "9")]
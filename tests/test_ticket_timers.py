@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+import barbershop_bot as bot
+from conftest import booking, make_context
+
+
+def run_jobs(context, kind):
+    """Run the pending jobs of one kind, as the job queue would once they are due."""
+    for job in [job for job in context.job_queue.jobs if not job.removed and job.data[1] == kind]:
+        job.removed = True
+        context.job = job
+        asyncio.run(job.callback(context))
+
+
+def restart_after_calling_ticket_1(sheet, store, checked_in=False):
+    sheet.rows += [booking(1, time="2026-10-19 09:00"), booking(2, time="2026-10-19 09:01")]
+    # Ticket 1 was called ten minutes ago by the process that just stopped
+    store.set("notifications", "101_turn-1", str(time.time() - 10 * 60), bot.TICKET_STATE_TTL)
+    if checked_in:
+        store.set("checkins", "1", "1", bot.TICKET_STATE_TTL)
+
+    context = make_context()
+    timers = bot.TicketTimers()
+    timers.sync(context.job_queue, bot.sheets_service.get_all_bookings()[1:])
+    run_jobs(context, "turn")
+    return context
+
+
+def test_turn_called_before_a_restart_still_expires(sheet, store, outbox):
+    context = restart_after_calling_ticket_1(sheet, store)
+    assert context.bot.sent == []  # not called twice
+
+    expiry = next(job for job in context.job_queue.jobs if job.data == ("1", "expire"))
+    assert expiry.when == 0  # the five minutes ran out during the restart
+    run_jobs(context, "expire")
+    assert outbox.pending_records()[-1] == {"op": "status", "tickets": ["1"], "status": "No-show",
+                                            "time": outbox.pending_records()[-1]["time"]}
+
+
+def test_checked_in_customer_is_not_expired_after_a_restart(sheet, store, outbox):
+    context = restart_after_calling_ticket_1(sheet, store, checked_in=True)
+    assert all(job.data[1] != "expire" for job in context.job_queue.jobs)
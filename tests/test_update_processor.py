@@ -0,0 +1,68 @@
+import asyncio
+import random
+import time
+from datetime import datetime
+
+from telegram import Chat, Message, Update
+
+import barbershop_bot as bot
+
+
+def update(update_id, chat_id):
+    chat = Chat(id=chat_id, type=Chat.PRIVATE)
+    return Update(update_id, message=Message(update_id, datetime.now(), chat))
+
+
+def process(processor, updates, handle):
+    """Feed updates to the processor as Application does, one task each, and wait for all."""
+    async def run():
+        await asyncio.gather(*(processor.process_update(u, handle(u)) for u in updates))
+    started = time.perf_counter()
+    asyncio.run(run())
+    return time.perf_counter() - started
+
+
+def test_updates_of_one_chat_run_in_order_within_the_worker_limit():
+    processor = bot.ChatOrderedUpdateProcessor(4)
+    rng = random.Random(1)
+    updates = [update(i, chat_id=i % 5) for i in range(60)]
+    seen, running, peak = {}, [0], [0]
+
+    async def handle(u):
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        await asyncio.sleep(rng.random() / 100)
+        seen.setdefault(u.effective_chat.id, []).append(u.update_id)
+        running[0] -= 1
+
+    process(processor, updates, handle)
+    for chat_id, update_ids in seen.items():
+        assert update_ids == sorted(update_ids)
+    assert peak[0] == 4
+    assert processor.chat_locks == {}
+
+
+def test_a_busy_chat_does_not_hold_up_other_chats():
+    processor = bot.ChatOrderedUpdateProcessor(4)
+    finished = {}
+
+    async def handle(u):
+        await asyncio.sleep(0.2 if u.effective_chat.id == 1 else 0.01)
+        finished[u.update_id] = time.perf_counter()
+
+    started = time.perf_counter()
+    process(processor, [update(i, chat_id=1) for i in range(6)] + [update(99, chat_id=2)], handle)
+    assert finished[99] - started < 0.15
+
+
+def test_throughput_with_a_slow_backend():
+    # Each update waits 50 ms on the "sheet", 40 updates from 20 chats
+    async def handle(u):
+        await asyncio.sleep(0.05)
+
+    updates = [update(i, chat_id=i % 20) for i in range(40)]
+    sequential = process(bot.ChatOrderedUpdateProcessor(1), updates, handle)
+    concurrent = process(bot.ChatOrderedUpdateProcessor(16), updates, handle)
+    print(f"sequential {sequential:.2f}s, concurrent {concurrent:.2f}s")
+    assert sequential > 1.9
+    assert concurrent < sequential / 5
@@ -0,0 +1,78 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from telegram import Chat, Message, Update, User
+from telegram.ext import Application, CallbackContext
+
+import barbershop_bot as bot
+
+PERSISTENCE_IDS = ("_user_ids_to_be_updated_in_persistence", "_user_ids_to_be_deleted_in_persistence",
+                   "_chat_ids_to_be_updated_in_persistence", "_chat_ids_to_be_deleted_in_persistence")
+
+
+@pytest.fixture
+def application():
+    return Application.builder().token("123:TEST").build()
+
+
+def use_janitor(monkeypatch, max_users, ttl=24 * 60 * 60, protect=bot.CONVERSATION_TIMEOUT):
+    janitor = bot.UserDataJanitor(max_users, ttl, protect)
+    monkeypatch.setattr(bot, "user_data_janitor", janitor)
+    return janitor
+
+
+def send(application, *user_ids):
+    """Run updates from these users the way PTB does: track_user, a handler, then the persistence marks."""
+    async def run():
+        for user_id in user_ids:
+            update = Update(user_id, message=Message(user_id, datetime.now(), Chat(user_id, Chat.PRIVATE),
+                                                    from_user=User(user_id, "C", False), text="📅 دير رنديفو"))
+            context = CallbackContext.from_update(update, application)
+            await bot.track_user(update, context)
+            context.user_data.update(barber="حلاق 1", name=f"C{user_id}", phone="0600000000")
+            context.chat_data["seen"] = True
+            application.mark_data_for_update_persistence(chat_ids=user_id, user_ids=user_id)
+    asyncio.run(run())
+
+
+def test_ptb_persistence_queues_exist(application):
+    # The janitor empties these private PTB sets; a rename would silently leak
+    for name in PERSISTENCE_IDS:
+        assert isinstance(getattr(application, name), set)
+
+
+def test_user_data_stays_bounded(application, monkeypatch, clock, store):
+    use_janitor(monkeypatch, max_users=100, protect=0)
+    for start in range(1, 5001, 500):
+        send(application, *range(start, start + 500))
+        assert len(application.user_data) <= 101
+        assert len(application.chat_data) <= 101
+        assert all(len(getattr(application, name)) <= 1 for name in PERSISTENCE_IDS)
+        clock.now += 1
+
+    bot.user_data_janitor.evict(application)
+    assert sorted(application.user_data) == list(range(4901, 5001))
+    assert all(not getattr(application, name) for name in PERSISTENCE_IDS)
+
+
+def test_recent_users_and_admins_are_kept(application, monkeypatch, clock, store):
+    janitor = use_janitor(monkeypatch, max_users=10, ttl=3 * bot.CONVERSATION_TIMEOUT)
+    store.set("admin_sessions", "1", "1", bot.ADMIN_SESSION_TTL)
+    send(application, *range(1, 11))
+
+    # Users still inside the conversation timeout are kept over the limit
+    send(application, *range(11, 21))
+    assert sorted(application.user_data) == list(range(1, 21))
+
+    # Once they are idle longer than that, the oldest go first
+    clock.now += bot.CONVERSATION_TIMEOUT + 1
+    send(application, 21)
+    assert sorted(application.user_data) == [1, *range(13, 22)]
+    assert janitor.evicted == 11
+
+    # The sweep drops idle users once their ttl is up, never the admin
+    clock.now += 3 * bot.CONVERSATION_TIMEOUT
+    janitor.evict(application)
+    assert sorted(application.user_data) == [1]
+    assert sorted(application.chat_data) == [1]
@@ -0,0 +1,27 @@
+import asyncio
+import types
+
+import barbershop_bot as bot
+from conftest import FakeMessage, booking, make_context
+
+
+def test_panel_with_long_names_fits_one_message():
+    rows = [booking(t, slot="2026-10-19 10:00") for t in range(1, 41)]
+    for row in rows:
+        row[1] = "ن" * 4000
+    text, reply_markup = bot.render_waiting_panel(rows, set(), 1, "✅ تم حذف الحجز بنجاح")
+    assert bot.message_length(text) <= bot.PAGE_LENGTH
+    assert text.count("…") == bot.WAITING_PANEL_SIZE
+
+
+def test_long_name_is_asked_again():
+    context = make_context()
+    update = types.SimpleNamespace(message=FakeMessage(7))
+
+    update.message.text = "ن" * (bot.MAX_NAME_LENGTH + 1)
+    assert asyncio.run(bot.handle_name(update, context)) == bot.ENTERING_NAME
+    assert "name" not in context.user_data
+
+    update.message.text = "ن" * bot.MAX_NAME_LENGTH
+    assert asyncio.run(bot.handle_name(update, context)) == bot.ENTERING_PHONE
+    assert context.user_data["name"] == update.message.text